@@ -0,0 +1,143 @@
+"""account_store.py
+Persistent SQLite-backed store of players' account types, used to avoid
+re-checking the highscores every time a player's EHB is looked up.
+
+Entries expire after ACCOUNT_TYPE_TTL seconds, since account types change when
+players de-iron. Players who couldn't be found are cached for NOT_FOUND_TTL seconds.
+"""
+import ast
+import os
+import sqlite3
+import threading
+import time
+
+from config import *
+from logging_ import log_message
+
+"""Account type recorded for players who aren't listed on the highscores
+"""
+NOT_FOUND = 'not_found'
+
+"""Name of the file account types were cached in by previous versions
+"""
+LEGACY_IRON_DICT_NAME = 'ironmen_dictionary.txt'
+
+
+class AccountTypeStore:
+    """Maps lower-cased RSNs to account types (GameMode values from osrs_utils, or NOT_FOUND).
+
+    The database is only opened on first use, and a legacy ironmen_dictionary.txt
+    is migrated into it at that point if one exists.
+    """
+
+    def __init__(self, path=ACCOUNT_DB_NAME, ttl=ACCOUNT_TYPE_TTL, not_found_ttl=NOT_FOUND_TTL,
+                 legacy_path=LEGACY_IRON_DICT_NAME):
+        """
+        :param path: Path of the SQLite database file.
+        :param ttl: Number of seconds an account type stays valid for.
+        :param not_found_ttl: Number of seconds a player stays marked as not found.
+        :param legacy_path: Path of a legacy ironmen dictionary to migrate, if present.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.not_found_ttl = not_found_ttl
+        self.legacy_path = legacy_path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Opens the database, creating its table and migrating legacy data if needed.
+        Must be called with self._lock held.
+
+        :return: sqlite3.Connection
+        """
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS account_types ('
+                         'rsn TEXT PRIMARY KEY, '
+                         'account_type TEXT NOT NULL, '
+                         'expires REAL NOT NULL)')
+            conn.commit()
+            self._conn = conn
+            self._migrate_legacy()
+        return self._conn
+
+    def _migrate_legacy(self):
+        """Imports entries from a legacy ironmen dictionary file, then renames the file
+        so it is only migrated once.
+
+        :return: None
+        """
+        if not os.path.exists(self.legacy_path):
+            return
+        if os.path.getsize(self.legacy_path) != 0:
+            with open(self.legacy_path, 'r') as legacy_file:
+                # The legacy file holds the repr of a {rsn: is_ironman} dict
+                iron_dict = ast.literal_eval(legacy_file.read())
+            expires = time.time() + self.ttl
+            rows = [(rsn.lower(), 'iron' if is_ironman else 'main', expires)
+                    for rsn, is_ironman in iron_dict.items()]
+            self._conn.executemany('INSERT OR IGNORE INTO account_types VALUES (?, ?, ?)', rows)
+            self._conn.commit()
+            log_message(f'Migrated {len(rows)} account types from {self.legacy_path}')
+        os.replace(self.legacy_path, self.legacy_path + '.migrated')
+
+    def get(self, rsn):
+        """Returns a player's cached account type.
+
+        :param rsn: String of player's OSRS username.
+        :return: String account type, NOT_FOUND, or None if the player isn't cached or
+        their entry has expired.
+        """
+        with self._lock:
+            row = self._connect().execute('SELECT account_type, expires FROM account_types WHERE rsn = ?',
+                                          (rsn.lower(),)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0]
+
+    def set(self, rsn, account_type, ttl=None):
+        """Inserts or updates a player's account type.
+
+        :param rsn: String of player's OSRS username.
+        :param account_type: String account type to record.
+        :param ttl: Optional number of seconds the entry is valid for, defaults to self.ttl
+        :return: None
+        """
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT OR REPLACE INTO account_types VALUES (?, ?, ?)',
+                         (rsn.lower(), account_type, time.time() + ttl))
+            conn.commit()
+
+    def set_not_found(self, rsn):
+        """Records that a player couldn't be found on the highscores.
+
+        :param rsn: String of player's OSRS username.
+        :return: None
+        """
+        self.set(rsn, NOT_FOUND, self.not_found_ttl)
+
+    def purge_expired(self):
+        """Deletes all expired entries.
+
+        :return: int number of entries deleted
+        """
+        with self._lock:
+            conn = self._connect()
+            deleted = conn.execute('DELETE FROM account_types WHERE expires < ?', (time.time(),)).rowcount
+            conn.commit()
+        return deleted
+
+    def close(self):
+        """Closes the database connection, it will be reopened on next use.
+
+        :return: None
+        """
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
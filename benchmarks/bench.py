@@ -0,0 +1,279 @@
+"""bench.py
+Micro-benchmarks for the report and calculation hot paths of Clockwork Penguin.
+
+Highscores lookups are served from the recorded fixtures in benchmarks/fixtures,
+so no requests are made. Each benchmark reports its time per call and the peak
+memory allocated during a call, and results can be saved as a JSON baseline and
+compared against a baseline from another commit.
+
+Usage, from the repository root (config.py must exist, see sample_config.py):
+    python benchmarks/bench.py                        # run and print results
+    python benchmarks/bench.py --save baseline        # also save benchmarks/baselines/baseline.json
+    python benchmarks/bench.py --compare baseline     # exit with status 1 on a regression
+    python benchmarks/bench.py --record "<rsn>"       # record a new fixture from the live highscores
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import hs_wrapper
+from command_router import parse_command
+from hs_wrapper import HighscoreSnapshot
+from osrs_utils import *
+
+FIXTURE_DIR = os.path.join(BENCH_DIR, 'fixtures')
+BASELINE_DIR = os.path.join(BENCH_DIR, 'baselines')
+
+
+def load_fixtures(directory=FIXTURE_DIR):
+    """Loads every recorded fixture.
+
+    :param directory: str path of directory holding fixture files
+    :return: dict mapping lowercase RSNs to dicts of board names to HighscoreSnapshots
+    """
+    fixtures = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(directory, name)) as file:
+            data = json.load(file)
+        fixtures[data['rsn'].lower()] = {board: HighscoreSnapshot.from_dict(entry)
+                                         for board, entry in data['boards'].items()}
+    return fixtures
+
+
+def use_fixtures(fixtures):
+    """Serves all highscores lookups from fixtures instead of the OSRS Highscores.
+
+    Caching is turned off so every call builds its snapshot the way a cache miss would.
+
+    :param fixtures: dict as returned by load_fixtures()
+    :return: None
+    """
+    def fetch(rsn, board):
+        snapshot = fixtures.get(rsn.lower(), {}).get(board)
+        if snapshot is None:
+            # Same error osrs_highscores raises for players not on a board
+            raise ValueError(f'{rsn} not found on {board}')
+        return HighscoreSnapshot.from_dict(snapshot.to_dict())
+
+    hs_wrapper.snapshot_cache._fetch = fetch
+    hs_wrapper.snapshot_cache.ttl = 0
+    hs_wrapper.snapshot_cache.stale_ttl = 0
+    hs_wrapper.snapshot_cache.clear()
+
+
+def record_fixture(rsn, directory=FIXTURE_DIR):
+    """Fetches a player from every highscores board they are listed on and saves them as a fixture.
+
+    :param rsn: str value of a player's OSRS username
+    :param directory: str path of directory to save the fixture in
+    :return: str path of the saved fixture
+    """
+    boards = {}
+    for board in ['default', 'ironman', 'hardcore_ironman', 'ultimate']:
+        try:
+            boards[board] = hs_wrapper._fetch_user(rsn, board).to_dict()
+        except ValueError:
+            continue
+    path = os.path.join(directory, rsn.lower().replace(' ', '_') + '.json')
+    with open(path, 'w') as file:
+        json.dump({'rsn': rsn, 'boards': boards}, file, indent=1)
+    return path
+
+
+def benchmarks(fixtures):
+    """Lists the benchmarks to run, one per hot path and fixture player.
+
+    :param fixtures: dict as returned by load_fixtures()
+    :return: list of (str name, callable) tuples
+    """
+    cases = []
+    for rsn in [fixture['default'].rsn for fixture in fixtures.values()]:
+        key = rsn.lower().replace(' ', '_')
+        for func in [get_hs, get_skills, get_bosses, get_activities, calc_ehb, calc_cmb_lvl, is_iron]:
+            cases.append((f'{func.__name__}[{key}]', lambda func=func, rsn=rsn: func(rsn)))
+        # Parsing of the index_lite CSV, done once per fetch by the csv backend
+        csv = fixtures[rsn.lower()]['default'].to_csv()
+        cases.append((f'from_csv[{key}]', lambda csv=csv, rsn=rsn: HighscoreSnapshot.from_csv(csv, rsn)))
+    for content in ['!hs Lynx Titan', '!top zulrah 10', '!version']:
+        cases.append((f'parse_command[{content}]', lambda content=content: parse_command(content)))
+    return cases
+
+
+def time_call(func, min_time=0.2, repeat=5):
+    """Times a callable, running it in loops long enough to be measured reliably.
+
+    :param func: Callable taking no arguments
+    :param min_time: Minimum number of seconds each timed loop should take
+    :param repeat: Number of timed loops
+    :return: dict with the median and minimum seconds per call, and the number of calls per loop
+    """
+    func()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / repeat:
+            break
+        number *= 2
+
+    per_call = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        per_call.append((time.perf_counter() - start) / number)
+    return {'median': statistics.median(per_call), 'min': min(per_call), 'loops': number}
+
+
+def measure_allocations(func, calls=20):
+    """Measures the memory a callable allocates, using tracemalloc.
+
+    :param func: Callable taking no arguments
+    :param calls: Number of calls to average over
+    :return: dict with the peak bytes allocated during a call and the number of
+    memory blocks allocated per call
+    """
+    func()
+    tracemalloc.start()
+    try:
+        peaks = []
+        blocks = 0
+        for _ in range(calls):
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            func()
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+            after = tracemalloc.take_snapshot()
+            blocks += sum(max(stat.count_diff, 0) for stat in after.compare_to(before, 'lineno'))
+    finally:
+        tracemalloc.stop()
+    return {'peak_bytes': max(peaks), 'blocks': blocks // calls}
+
+
+def run(names=None, min_time=0.2, repeat=5):
+    """Runs the benchmarks inside a temporary directory, so report files don't pile up.
+
+    :param names: Optional list of substrings, only benchmarks whose names contain one are run
+    :param min_time: Minimum number of seconds each timed loop should take
+    :param repeat: Number of timed loops per benchmark
+    :return: dict mapping benchmark names to results
+    """
+    fixtures = load_fixtures()
+    use_fixtures(fixtures)
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            for name, func in benchmarks(fixtures):
+                if names and not any(part in name for part in names):
+                    continue
+                result = time_call(func, min_time, repeat)
+                result.update(measure_allocations(func))
+                results[name] = result
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def print_results(results):
+    """Prints results as a table.
+
+    :param results: dict as returned by run()
+    :return: None
+    """
+    print(f'{"benchmark":<40} {"median us":>12} {"min us":>12} {"peak KiB":>10} {"blocks":>8}')
+    for name, result in results.items():
+        print(f'{name:<40} {result["median"] * 1e6:>12.1f} {result["min"] * 1e6:>12.1f} '
+              f'{result["peak_bytes"] / 1024:>10.1f} {result["blocks"]:>8}')
+
+
+def save_baseline(results, name):
+    """Saves results as benchmarks/baselines/{name}.json
+
+    :param results: dict as returned by run()
+    :param name: str name of baseline
+    :return: str path of saved baseline
+    """
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    path = os.path.join(BASELINE_DIR, name + '.json')
+    with open(path, 'w') as file:
+        json.dump({'python': sys.version.split()[0], 'results': results}, file, indent=2, sort_keys=True)
+    return path
+
+
+def compare(results, name, threshold=0.25):
+    """Compares results against a saved baseline.
+
+    A benchmark regresses if its median time or peak allocation grows by more than threshold.
+
+    :param results: dict as returned by run()
+    :param name: str name of baseline to compare against
+    :param threshold: float allowed relative growth, e.g. 0.25 for 25%
+    :return: list of str descriptions of regressions, empty if there were none
+    """
+    with open(os.path.join(BASELINE_DIR, name + '.json')) as file:
+        baseline = json.load(file)['results']
+
+    regressions = []
+    print(f'\n{"benchmark":<40} {"time":>8} {"peak":>8}')
+    for bench, result in results.items():
+        old = baseline.get(bench)
+        if old is None:
+            print(f'{bench:<40} {"new":>8} {"new":>8}')
+            continue
+        time_ratio = result['median'] / old['median']
+        peak_ratio = result['peak_bytes'] / old['peak_bytes'] if old['peak_bytes'] else 1.0
+        print(f'{bench:<40} {time_ratio:>7.2f}x {peak_ratio:>7.2f}x')
+        if time_ratio > 1 + threshold:
+            regressions.append(f'{bench}: {time_ratio:.2f}x slower')
+        if peak_ratio > 1 + threshold:
+            regressions.append(f'{bench}: {peak_ratio:.2f}x more memory')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks Clockwork Penguin against recorded highscores.')
+    parser.add_argument('names', nargs='*', help='only run benchmarks whose names contain one of these')
+    parser.add_argument('--save', metavar='NAME', help='save results as baseline NAME')
+    parser.add_argument('--compare', metavar='NAME', help='compare results against baseline NAME')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed relative slowdown before a comparison fails (default 0.25)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum seconds per timed loop (default 0.2)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed loops per benchmark (default 5)')
+    parser.add_argument('--record', metavar='RSN', help='record a fixture for RSN from the live highscores')
+    args = parser.parse_args()
+
+    if args.record:
+        print(f'Saved {record_fixture(args.record)}')
+        return 0
+
+    results = run(args.names, args.min_time, args.repeat)
+    print_results(results)
+    if args.save:
+        print(f'\nSaved {save_baseline(results, args.save)}')
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print('\nRegressions:\n' + '\n'.join(regressions))
+            return 1
+        print('\nNo regressions')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
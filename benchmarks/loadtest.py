@@ -0,0 +1,430 @@
+"""loadtest.py
+End-to-end load generator for the Clockwork Penguin Discord bot.
+
+Replays a mix of commands through discord_bot.on_message with no Discord or
+Jagex connection: highscores are served as index_lite CSV by a local stub
+server with configurable latency and error injection, and replies are captured
+by fake channels. Reports throughput, latency percentiles and how many requests
+reached the stub, and with --check compares upstream calls with and without
+caching and request sharing.
+
+Usage, from the repository root (config.py must exist, see sample_config.py):
+    python benchmarks/loadtest.py --messages 2000 --rate 100
+    python benchmarks/loadtest.py --latency 0.2 --error-rate 0.05 --throttle-rate 0.01
+    python benchmarks/loadtest.py --check                 # exit with status 1 if caching doesn't help
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import discord_bot
+import hs_wrapper
+from account_store import AccountTypeStore
+from bench import load_fixtures
+from config import *
+from hs_wrapper import BOARD_PATHS, CsvBackend, SnapshotCache
+from rate_limiter import RateLimiter
+
+"""Relative frequency of each command in generated traffic
+"""
+DEFAULT_MIX = {'!hs': 25, '!skills': 15, '!bosses': 10, '!activities': 5, '!ehb': 20, '!cmb': 20, '!version': 5}
+
+
+class StubHighscores:
+    """Local HTTP server answering index_lite requests from a fixed set of players.
+
+    Every response is delayed by latency seconds, +/- jitter as a fraction of latency.
+    A fraction error_rate of requests get a 503, and throttle_rate a 429 with Retry-After.
+    """
+
+    def __init__(self, players, latency=0.05, jitter=0.5, error_rate=0.0, throttle_rate=0.0, seed=None):
+        """
+        :param players: dict mapping lowercase RSNs to dicts of board names to CSV bodies
+        :param latency: Mean number of seconds to wait before responding
+        :param jitter: Fraction of latency that response times vary by
+        :param error_rate: Fraction of requests answered with a 503
+        :param throttle_rate: Fraction of requests answered with a 429
+        :param seed: Optional random seed
+        """
+        self.players = players
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.calls = Counter()
+        self.responses = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, body, headers = stub.respond(self.path)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def respond(self, path):
+        """Works out the response to a request, sleeping to simulate latency.
+
+        :param path: str request path including query string
+        :return: tuple (int status, bytes body, dict headers)
+        """
+        url = urlparse(path)
+        board = next((board for board, segment in BOARD_PATHS.items() if url.path == f'/m={segment}/index_lite.ws'),
+                     None)
+        rsn = parse_qs(url.query).get('player', [''])[0]
+        with self._lock:
+            self.calls[board] += 1
+            roll = self._random.random()
+            delay = self.latency * (1 + self._random.uniform(-self.jitter, self.jitter))
+        time.sleep(max(0.0, delay))
+
+        if roll < self.error_rate:
+            status, body, headers = 503, b'', {}
+        elif roll < self.error_rate + self.throttle_rate:
+            status, body, headers = 429, b'', {'Retry-After': '1'}
+        else:
+            csv = self.players.get(rsn.lower(), {}).get(board)
+            if csv is None:
+                status, body, headers = 404, b'', {}
+            else:
+                status, body, headers = 200, csv.encode('utf-8'), {'Content-Type': 'text/csv'}
+        with self._lock:
+            self.responses[status] += 1
+        return status, body, headers
+
+    def reset_counts(self):
+        with self._lock:
+            self.calls.clear()
+            self.responses.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='stub-highscores', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeAuthor:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeChannel:
+    """Stands in for a Discord channel, recording everything sent to it.
+    """
+
+    def __init__(self):
+        self.sends = []
+
+    async def send(self, content=None, **kwargs):
+        self.sends.append((content, kwargs))
+        return FakeMessage(self, content or '', FakeAuthor(0))
+
+
+class FakeMessage:
+    """Stands in for a Discord message.
+    """
+
+    def __init__(self, channel, content, author):
+        self.channel = channel
+        self.content = content
+        self.author = author
+
+    async def edit(self, content=None):
+        self.content = content
+
+
+def make_players(fixtures, count, seed=None):
+    """Generates players for the stub by copying the recorded fixtures under new names.
+
+    :param fixtures: dict as returned by bench.load_fixtures()
+    :param count: int number of players to generate
+    :param seed: Optional random seed
+    :return: tuple (list of str RSNs, dict of players for StubHighscores)
+    """
+    rng = random.Random(seed)
+    templates = list(fixtures.values())
+    rsns = []
+    players = {}
+    for i in range(count):
+        rsn = f'Player {i:04d}'
+        rsns.append(rsn)
+        template = rng.choice(templates)
+        players[rsn.lower()] = {board: snapshot.to_csv() for board, snapshot in template.items()}
+    return rsns, players
+
+
+def make_commands(rsns, count, mix=None, missing_rate=0.02, seed=None):
+    """Generates command messages, with players picked by a Zipf-like popularity so
+    that a few players are looked up often and most rarely.
+
+    :param rsns: list of str RSNs known to the stub
+    :param count: int number of commands to generate
+    :param mix: Optional dict of command names to relative frequencies, defaults to DEFAULT_MIX
+    :param missing_rate: Fraction of lookups for players that don't exist
+    :param seed: Optional random seed
+    :return: list of str message contents
+    """
+    rng = random.Random(seed)
+    mix = DEFAULT_MIX if mix is None else mix
+    names = list(mix)
+    popularity = [1 / (rank + 1) for rank in range(len(rsns))]
+    commands = []
+    for cmd in rng.choices(names, weights=[mix[name] for name in names], k=count):
+        if cmd == '!version':
+            commands.append(cmd)
+        elif rng.random() < missing_rate:
+            commands.append(f'{cmd} Missing {rng.randrange(10000):04d}')
+        else:
+            commands.append(f'{cmd} {rng.choices(rsns, weights=popularity)[0]}')
+    return commands
+
+
+def classify(channel):
+    """Works out how a command went from the replies it sent.
+
+    :param channel: FakeChannel the command was sent in
+    :return: str outcome
+    """
+    if not channel.sends:
+        return 'no_reply'
+    content = channel.sends[0][0] or ''
+    if content.startswith('Please wait'):
+        return 'cooldown'
+    if content.startswith('Timed out'):
+        return 'timeout'
+    if 'not found' in content:
+        return 'not_found'
+    return 'ok'
+
+
+def percentile(values, q):
+    """Returns the q-th percentile of values, by the nearest rank method.
+
+    :param values: sorted list of numbers
+    :param q: float percentile between 0 and 100
+    :return: number, 0.0 if values is empty
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+async def drive(commands, rate=0.0, users=0, seed=None):
+    """Sends commands through discord_bot.on_message, as if they arrived from Discord.
+
+    :param commands: list of str message contents
+    :param rate: Messages per second to send at, 0 to send all at once
+    :param users: Number of distinct users sending messages, 0 for a new user per message
+    :param seed: Optional random seed
+    :return: dict with the duration, per command latencies and outcome counts
+    """
+    rng = random.Random(seed)
+    latencies = {}
+    outcomes = Counter()
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+
+    async def send(i, content):
+        if rate > 0:
+            await asyncio.sleep(max(0.0, start + i / rate - loop.time()))
+        author = FakeAuthor(rng.randrange(users) + 1 if users else i + 1)
+        channel = FakeChannel()
+        sent_at = time.perf_counter()
+        try:
+            await discord_bot.on_message(FakeMessage(channel, content, author))
+            outcome = classify(channel)
+        except Exception:
+            outcome = 'error'
+        latencies.setdefault(content.split(' ', 1)[0], []).append(time.perf_counter() - sent_at)
+        outcomes[outcome] += 1
+
+    await asyncio.gather(*(send(i, content) for i, content in enumerate(commands)))
+    return {'duration': loop.time() - start, 'latencies': latencies, 'outcomes': outcomes}
+
+
+def reset_bot(directory, fetch, cached=True, hs_rate=HS_RATE_LIMIT, hs_burst=HS_RATE_BURST):
+    """Gives the bot a fresh snapshot cache, rate limiter and account type store, and
+    clears cooldowns, so every run starts cold with its own counters.
+
+    :param directory: str directory to keep the account type store in
+    :param fetch: Callable taking (rsn, board) which fetches a HighscoreSnapshot
+    :param cached: boolean, False turns off the snapshot cache, account type store
+    and sharing of identical in-flight commands
+    :param hs_rate: Highscores requests per second allowed by the rate limiter
+    :param hs_burst: Highscores request burst allowed by the rate limiter
+    :return: None
+    """
+    hs_wrapper.hs_limiter = RateLimiter(hs_rate, hs_burst, max_retries=HS_MAX_RETRIES,
+                                        base_delay=HS_RETRY_BASE_DELAY, max_delay=HS_RETRY_MAX_DELAY)
+    hs_wrapper.snapshot_cache = SnapshotCache(lambda rsn, board: hs_wrapper.hs_limiter.call(fetch, rsn, board),
+                                              ttl=HS_CACHE_TTL if cached else 0,
+                                              stale_ttl=HS_CACHE_STALE_TTL if cached else 0)
+    discord_bot.account_store.close()
+    discord_bot.account_store = AccountTypeStore(
+        path=os.path.join(directory, f'accounts-{time.monotonic_ns()}.db'),
+        ttl=ACCOUNT_TYPE_TTL if cached else 0, not_found_ttl=NOT_FOUND_TTL if cached else 0)
+    discord_bot.router._last_used.clear()
+    if cached:
+        discord_bot.router.__dict__.pop('shared', None)
+    else:
+        async def unshared(key, func, *args):
+            return await func(*args)
+        discord_bot.router.shared = unshared
+
+
+def summarize(result, stub, label):
+    """Builds a report of one run.
+
+    :param result: dict as returned by drive()
+    :param stub: StubHighscores the run was served by
+    :param label: str name of the run
+    :return: dict report
+    """
+    all_latencies = sorted(value for values in result['latencies'].values() for value in values)
+    messages = len(all_latencies)
+    upstream = sum(stub.calls.values())
+    return {
+        'run': label,
+        'messages': messages,
+        'duration_s': round(result['duration'], 3),
+        'throughput_per_s': round(messages / result['duration'], 1) if result['duration'] else 0.0,
+        'outcomes': dict(result['outcomes']),
+        'latency_ms': {name: {'count': len(values),
+                              'p50': round(percentile(values, 50) * 1000, 1),
+                              'p95': round(percentile(values, 95) * 1000, 1),
+                              'p99': round(percentile(values, 99) * 1000, 1),
+                              'max': round(values[-1] * 1000, 1)}
+                       for name, values in [('all', all_latencies)] +
+                       sorted((name, sorted(values)) for name, values in result['latencies'].items())},
+        'upstream_calls': upstream,
+        'upstream_calls_by_board': {board: count for board, count in stub.calls.items()},
+        'upstream_responses': {str(status): count for status, count in stub.responses.items()},
+        'upstream_calls_per_message': round(upstream / messages, 3) if messages else 0.0,
+        'cache': hs_wrapper.cache_stats(),
+        'limiter': hs_wrapper.limiter_stats(),
+    }
+
+
+def print_report(report):
+    """Prints a report from summarize().
+
+    :param report: dict report
+    :return: None
+    """
+    print(f'\n== {report["run"]} ==')
+    print(f'{report["messages"]} messages in {report["duration_s"]}s ({report["throughput_per_s"]}/s)')
+    print('Outcomes: ' + ', '.join(f'{name}={count}' for name, count in sorted(report['outcomes'].items())))
+    print(f'{"command":<14} {"count":>7} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+    for name, stats in report['latency_ms'].items():
+        print(f'{name:<14} {stats["count"]:>7} {stats["p50"]:>9} {stats["p95"]:>9} {stats["p99"]:>9} '
+              f'{stats["max"]:>9}')
+    print(f'Upstream calls: {report["upstream_calls"]} ({report["upstream_calls_per_message"]} per message) '
+          + ', '.join(f'{board}={count}' for board, count in sorted(report['upstream_calls_by_board'].items())))
+    print('Upstream responses: ' + ', '.join(f'{status}={count}' for status, count
+                                             in sorted(report['upstream_responses'].items())))
+    print(f'Cache hit ratio: {report["cache"]["hit_ratio"]:.3f}, '
+          f'limiter avg wait: {report["limiter"]["avg_wait"]:.3f}s, retries: {report["limiter"]["retries"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays generated traffic through the bot against a stub '
+                                                 'highscores server.')
+    parser.add_argument('--messages', type=int, default=2000, help='number of commands to send (default 2000)')
+    parser.add_argument('--rate', type=float, default=100.0,
+                        help='messages per second, 0 to send all at once (default 100)')
+    parser.add_argument('--players', type=int, default=200, help='number of distinct players (default 200)')
+    parser.add_argument('--users', type=int, default=0,
+                        help='number of distinct Discord users, 0 for one per message (default 0)')
+    parser.add_argument('--latency', type=float, default=0.05, help='stub response time in seconds (default 0.05)')
+    parser.add_argument('--jitter', type=float, default=0.5, help='stub response time jitter fraction (default 0.5)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 503 responses (default 0)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of 429 responses (default 0)')
+    parser.add_argument('--missing-rate', type=float, default=0.02,
+                        help='fraction of lookups for players that do not exist (default 0.02)')
+    parser.add_argument('--hs-rate', type=float, default=HS_RATE_LIMIT,
+                        help=f'highscores requests per second (default HS_RATE_LIMIT, {HS_RATE_LIMIT})')
+    parser.add_argument('--hs-burst', type=int, default=HS_RATE_BURST,
+                        help=f'highscores request burst (default HS_RATE_BURST, {HS_RATE_BURST})')
+    parser.add_argument('--seed', type=int, default=1, help='random seed (default 1)')
+    parser.add_argument('--check', action='store_true',
+                        help='also run without caching and fail unless caching reduces upstream calls')
+    parser.add_argument('--json', metavar='PATH', help='save the reports as JSON')
+    args = parser.parse_args()
+
+    rsns, players = make_players(load_fixtures(), args.players, args.seed)
+    commands = make_commands(rsns, args.messages, missing_rate=args.missing_rate, seed=args.seed)
+    stub = StubHighscores(players, args.latency, args.jitter, args.error_rate, args.throttle_rate, args.seed)
+    stub.start()
+    client = CsvBackend(stub.url)
+
+    reports = []
+    runs = [('uncached', False), ('cached', True)] if args.check else [('cached', True)]
+
+    # All runs share one event loop, since the router's semaphores are bound to the loop they're first used in
+    async def run_all(directory):
+        for label, cached in runs:
+            reset_bot(directory, client.fetch, cached, args.hs_rate, args.hs_burst)
+            stub.reset_counts()
+            result = await drive(commands, args.rate, args.users, args.seed)
+            reports.append(summarize(result, stub, label))
+            print_report(reports[-1])
+
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            asyncio.run(run_all(directory))
+        finally:
+            discord_bot.account_store.close()
+            client.close()
+            stub.stop()
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(reports, file, indent=2)
+
+    if args.check:
+        uncached, cached = reports
+        saved = uncached['upstream_calls'] - cached['upstream_calls']
+        print(f'\nCaching saved {saved} of {uncached["upstream_calls"]} upstream calls')
+        if cached['upstream_calls'] >= uncached['upstream_calls']:
+            print('Check failed: caching did not reduce upstream calls')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
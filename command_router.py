@@ -0,0 +1,195 @@
+"""command_router.py
+Table-driven command router for the Clockwork Penguin Discord bot.
+
+Commands are registered with CommandRouter.command, along with a parser for
+their arguments, an optional cap on how many may run at once and an optional
+per-user cooldown. Dispatch is a single dict lookup on the command name.
+"""
+import asyncio
+import time
+
+from metrics import metrics
+from profiler import profiler
+
+
+class ArgumentError(ValueError):
+    """Raised by argument parsers when a command's arguments are missing or invalid.
+    """
+
+
+def no_args(body):
+    """Argument parser for commands that take no arguments, anything after the command is ignored.
+
+    :param body: string arguments parsed from message
+    :return: empty tuple
+    """
+    return ()
+
+
+def required_arg(body):
+    """Argument parser for commands that take the rest of the message as one argument, e.g. an RSN.
+
+    :param body: string arguments parsed from message
+    :return: tuple (body,)
+    @:raises ArgumentError if body is empty
+    """
+    if len(body.strip()) == 0:
+        raise ArgumentError('Missing argument')
+    return (body,)
+
+
+def parse_command(content):
+    """Breaks message.content into command and body of arguments
+
+    :param content: string message.content to parse
+    :return: string cmd, string body. If content has no arguments,
+    body returns an empty string.
+    """
+    if ' ' not in content:
+        return content.lower(), ''
+    else:
+        cmd, body = content.split(' ', maxsplit=1)
+        return cmd.lower(), body
+
+
+class Command:
+    """A registered command and its limits.
+    """
+    __slots__ = ('name', 'handler', 'parse', 'usage', 'semaphore', 'cooldown')
+
+    def __init__(self, name, handler, parse=no_args, usage=None, concurrency=None, cooldown=0):
+        """
+        :param name: str command name including prefix, e.g. '!hs'
+        :param handler: Coroutine function called as handler(message, *args)
+        :param parse: Callable turning the message body into a tuple of args for handler
+        :param usage: Optional str usage message sent when parse raises ArgumentError
+        :param concurrency: Optional maximum number of invocations that may run at once
+        :param cooldown: Number of seconds a user must wait between invocations
+        """
+        self.name = name
+        self.handler = handler
+        self.parse = parse
+        self.usage = usage
+        self.semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+        self.cooldown = cooldown
+
+
+class CommandRouter:
+    """Maps command names to Commands and runs them.
+    """
+
+    def __init__(self, prefix='!'):
+        """
+        :param prefix: str prefix that all commands start with
+        """
+        self.prefix = prefix
+        self._commands = {}
+        self._last_used = {}
+        self._in_flight = {}
+        metrics.register_gauges('router', lambda: {'shared_in_flight': len(self._in_flight)})
+
+    def command(self, *names, parse=no_args, usage=None, concurrency=None, cooldown=0):
+        """Decorator registering a coroutine function as the handler for one or more command names.
+
+        :param names: str command names including prefix, e.g. '!hs'
+        :param parse: Callable turning the message body into a tuple of args for the handler
+        :param usage: Optional str usage message sent when parse raises ArgumentError
+        :param concurrency: Optional maximum number of invocations that may run at once
+        :param cooldown: Number of seconds a user must wait between invocations
+        :return: decorator
+        """
+        def register(handler):
+            command = Command(names[0], handler, parse, usage, concurrency, cooldown)
+            for name in names:
+                self._commands[name] = command
+            return handler
+        return register
+
+    def names(self):
+        """Returns the names of all registered commands.
+
+        :return: list of str
+        """
+        return list(self._commands)
+
+    def _cooldown_remaining(self, command, user_id):
+        """Checks a user's cooldown on a command, starting a new one if it has expired.
+
+        :return: float number of seconds left on the cooldown, 0 if the command may run
+        """
+        if command.cooldown <= 0:
+            return 0.0
+        now = time.monotonic()
+        key = (command.name, user_id)
+        last_used = self._last_used.get(key)
+        if last_used is not None and now - last_used < command.cooldown:
+            return command.cooldown - (now - last_used)
+        self._last_used[key] = now
+        # Drop expired cooldowns every so often so this doesn't grow forever
+        if len(self._last_used) > 10000:
+            self._last_used = {k: t for k, t in self._last_used.items()
+                               if now - t < self._commands[k[0]].cooldown}
+        return 0.0
+
+    async def shared(self, key, func, *args):
+        """Awaits func(*args), sharing the result with any other caller using the same key
+        while it is in flight, so identical commands only do their work once.
+
+        :param key: Hashable key identifying the work, e.g. ('!hs', rsn.lower())
+        :param func: Coroutine function to run
+        :param args: Arguments passed to func
+        :return: Return value of func
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._in_flight.pop(key, None))
+        # Shield the shared task so one caller being cancelled doesn't cancel it for the others
+        return await asyncio.shield(task)
+
+    async def dispatch(self, message, prefix=None):
+        """Runs the command in a message, if it contains one.
+
+        :param message: Message sent in server
+        :param prefix: Optional str prefix commands start with in the message's guild, used in
+        place of self.prefix, e.g. '?' to run '!hs' as '?hs'
+        :return: boolean, True if the message was a registered command
+        """
+        prefix = self.prefix if prefix is None else prefix
+        if not message.content.startswith(prefix):
+            return False
+
+        name, body = parse_command(message.content)
+        command = self._commands.get(self.prefix + name[len(prefix):])
+        if command is None:
+            return False
+
+        try:
+            args = command.parse(body)
+        except ArgumentError:
+            if command.usage is not None:
+                await message.channel.send(f'Usage: {prefix}{command.usage[len(self.prefix):]}\n')
+            return True
+
+        remaining = self._cooldown_remaining(command, message.author.id)
+        if remaining > 0:
+            await message.channel.send(f'Please wait {remaining:.0f}s before using {name} again.\n')
+            return True
+
+        # Latency includes any time spent waiting on the command's concurrency cap
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            if command.semaphore is None:
+                async with profiler.invocation(command.name):
+                    await command.handler(message, *args)
+            else:
+                async with command.semaphore:
+                    async with profiler.invocation(command.name):
+                        await command.handler(message, *args)
+            status = 'ok'
+        finally:
+            metrics.observe('command_latency_seconds', time.perf_counter() - start, command=command.name)
+            metrics.inc('commands_total', command=command.name, status=status)
+        return True
@@ -1,15 +1,33 @@
 """discord_bot.py
 Main file for the Clockwork Penguin Discord bot
-Contains event handlers, command parser and list of
-commands/responses.
+Contains event handlers and the list of commands/responses,
+which are registered with a CommandRouter.
 """
 
-import os
+import io
+import time
+import asyncio
+import argparse
 import discord
+import requests
 
 from config import *
 from osrs_utils import *
+from executor import run_blocking
+from command_router import CommandRouter, ArgumentError, required_arg, parse_command
+from account_store import AccountTypeStore
+from history_store import HistoryStore, SnapshotStore, parse_period, render_gains, render_kc_gains
+from resource_registry import ResourceRegistry
+from group_utils import (fetch_group, fetch_member_with_mode, lookup_game_mode, render_group_ehb,
+                         render_group_ehp, render_group_cmb)
+from guild_registry import GuildRegistry, ClanDirectory
+from leaderboard import LEADERBOARD_ENTRIES, entry_name, entry_unit, render_leaderboard
 from webhook_handler import WebhookHandler
+from tracker import Tracker
+from metrics import metrics, serve_metrics
+from logging_ import log_message, log_stats
+from profiler import PROFILE_MODES, profiler
+from rate_limiter import UpstreamError
 
 
 # If in test mode, use test values for token, guild, and webhooks
@@ -22,32 +40,132 @@ else:
     GUILD = DISCORD_GUILD
     WH = WEBHOOK
 
-IRON_DICT_NAME = 'ironmen_dictionary.txt'
-
 intents = discord.Intents.default()
 intents.members = True
 intents.messages = True
 
-client = discord.Client(intents=intents)
 
-# If a file caching iron/main status exists, open it and read as a dict. Otherwise, create it as an empty file.
-if os.path.exists(IRON_DICT_NAME) and os.path.getsize(IRON_DICT_NAME) != 0:
-    with open(IRON_DICT_NAME, 'r') as iron_file:
-        iron_dict = eval(iron_file.read())
+def check_shards(shard_ids, shard_count):
+    """Checks that a process's shards are valid before it runs only some of them.
+
+    :param shard_ids: list of int IDs of the shards to run
+    :param shard_count: int total number of shards across all processes
+    :return: None
+    @:raises ValueError if shard_count isn't a positive number of shards or a shard ID is out of range
+    """
+    if not isinstance(shard_count, int) or shard_count < 1:
+        raise ValueError(f'Running only some shards needs the total number of shards, got {shard_count!r}')
+    invalid = [shard_id for shard_id in shard_ids if not 0 <= shard_id < shard_count]
+    if invalid:
+        raise ValueError(f'Shard IDs {invalid} are out of range for {shard_count} shards, '
+                         f'IDs go from 0 to {shard_count - 1}')
+
+
+if MULTI_GUILD:
+    if SHARD_IDS:
+        try:
+            check_shards(SHARD_IDS, SHARD_COUNT)
+        except ValueError as err:
+            raise ValueError(f'Invalid SHARD_IDS / SHARD_COUNT in config: {err}') from None
+    # Shards may be split across processes, see configure_shards
+    client = discord.AutoShardedClient(intents=intents, shard_count=SHARD_COUNT or None,
+                                       shard_ids=SHARD_IDS or None)
 else:
+    client = discord.Client(intents=intents)
+
+# Cache of iron/main status, opened on first use
+account_store = AccountTypeStore()
+
+# Highscores lookups are persisted so the cache is warm after a restart, unless HS_CACHE_DB_NAME is ''
+snapshot_store = SnapshotStore() if HS_CACHE_DB_NAME else None
+snapshot_cache.store = snapshot_store
+
+# Every snapshot fetched from the main highscores board is recorded for !gains and !kc-gains
+history = HistoryStore()
+add_fetch_listener(history.record)
+
+
+def latest_snapshot(rsn):
+    """Returns a player's last known main board snapshot, used to warm clan leaderboards.
+    The lookup cache's store is keyed by board so it is checked first, falling back to the
+    history for players who haven't been looked up within HS_CACHE_DEGRADED_TTL.
+
+    :param rsn: str value of a player's OSRS username
+    :return: HighscoreSnapshot, or None if the player has never been looked up
+    """
+    if snapshot_store is not None:
+        user = snapshot_store.load(rsn, 'default')
+        if user is not None:
+            return user
+    return history.latest(rsn)
 
-    iron_file = open(IRON_DICT_NAME, 'w')
-    iron_file.close()
-    iron_dict = dict()
+
+# Shared so that webhook posts reuse the same connections
+webhook = WebhookHandler()
+metrics.register_gauges('webhook', webhook.stats)
+
+# Settings and member lists of every server, used in multi-guild mode
+guild_registry = GuildRegistry()
+
+# Each server's member list, webhook and leaderboards. Leaderboards are kept up to date from
+# every snapshot fetched for a member
+clans = ClanDirectory(guild_registry, account_store, latest_snapshot, webhook)
+add_fetch_listener(clans.update)
+metrics.register_gauges('clans', clans.stats)
+
+# Announces clan members' level ups and boss KC milestones when TRACKER_ENABLED is set.
+# Players in several clans are only refreshed once, and announced to each of their clans
+tracker = Tracker(webhook, members=lambda: clans.tracked_members(served_guild_ids()), route=clans.webhooks_for)
+tracker_task = None
+metrics.register_gauges('tracker', tracker.stats)
+
+# Static images, loaded into memory once at startup
+resources = ResourceRegistry()
+resource_watcher = None
+history_downsampler = None
+metrics_server = None
+
+router = CommandRouter()
+
+# Commands profiled from startup, more can be armed with !profile
+for name, count in PROFILE_COMMANDS.items():
+    profiler.arm(name, count, PROFILE_MODE)
+metrics.register_gauges('profiler', profiler.stats)
+metrics.register_gauges('log', log_stats)
 
 
 @client.event
 async def on_ready():
-    guild = discord.utils.get(client.guilds, name=GUILD)
-    print(
-        f'{client.user} has connected to the following server:\n'
-        f'{guild.name} (id: {guild.id})'
-    )
+    global resource_watcher, history_downsampler, tracker_task, metrics_server
+    if MULTI_GUILD:
+        print(f'{client.user} has connected to {len(client.guilds)} servers '
+              f'(shards {client.shard_ids or "all"} of {client.shard_count})')
+    else:
+        guild = discord.utils.get(client.guilds, name=GUILD)
+        print(
+            f'{client.user} has connected to the following server:\n'
+            f'{guild.name} (id: {guild.id})'
+        )
+        # Rank members from their last recorded snapshots, so !top works without fetching everyone.
+        # In multi-guild mode each server's clan is loaded the first time it is used instead.
+        # A failure here mustn't stop the background tasks below from starting
+        try:
+            await run_blocking(clans.get, None, timeout=None)
+        except Exception as err:
+            log_message(f'Could not load clan leaderboards: {err!r}')
+
+    # on_ready fires again after reconnects, so only start watching resources once
+    if RESOURCE_RELOAD_INTERVAL > 0 and resource_watcher is None:
+        resource_watcher = client.loop.create_task(resources.watch())
+
+    if history_downsampler is None:
+        history_downsampler = client.loop.create_task(downsample_history())
+
+    if TRACKER_ENABLED and tracker_task is None:
+        tracker_task = client.loop.create_task(tracker.run())
+
+    if METRICS_PORT and metrics_server is None:
+        metrics_server = await serve_metrics()
 
 
 @client.event
@@ -63,159 +181,648 @@ async def on_message(message):
     if message.author == client.user:
         return
 
-    # If message is not a command, don't do anything else
-    if message.content[0] != '!':
-        return
+    prefix = None
+    if MULTI_GUILD and message.guild is not None:
+        # Settings are read on every message, so only go to the database when the cache misses
+        guild_config = guild_registry.cached(message.guild.id)
+        if guild_config is None:
+            guild_config = await run_blocking(guild_registry.get, message.guild.id, timeout=None)
+        prefix = guild_config.prefix
+
+    try:
+        handled = await router.dispatch(message, prefix)
+        # !prefix always works with the default prefix too, so a server can't lock itself out
+        if not handled and prefix is not None and parse_command(message.content)[0] == router.prefix + 'prefix':
+            await router.dispatch(message)
+    except asyncio.TimeoutError:
+        await message.channel.send('Timed out waiting on the OSRS Highscores, please try again later.\n')
+    except (UpstreamError, requests.exceptions.RequestException) as err:
+        log_message(f'Highscores lookup for {message.content!r} failed: {err!r}')
+        await message.channel.send('OSRS Highscores unavailable, please try again later.\n')
+
+
+def is_admin(message):
+    """Checks if a message was sent by one of the bot's admins.
 
-    # Break out message into command
-    cmd, body = parse_command(message.content)
+    :param message: Message sent in server
+    :return: boolean, True if the author's ID is listed in ADMIN_IDS
+    """
+    return message.author.id in ADMIN_IDS
 
-    # if/elif tree that handles all commands
-    if cmd == '!cmb':
-        # If the required argument is missing, stop here
-        if len(body) == 0:
-            return
-        rsn = body
 
-        levels = calc_cmb_lvl(rsn)
+def can_configure(message):
+    """Checks if a message was sent by someone allowed to change their server's settings.
 
-        if levels[0] == [-1]:
-            response = f'User {rsn} not found!'
-            await message.channel.send(response)
-        elif levels[0] == [-2]:
-            response = f'Cannot calculate user {rsn}\'s combat' \
-                       f'level as not all skills are listed on the highscores.\n'
-            await message.channel.send(response)
-        else:
-            embed = discord.Embed(title=rsn + "\'s Combat level:", description=levels[0], color=0xff0000)
-            embed.add_field(name="Attack", value=levels[1])
-            embed.add_field(name="Defence", value=levels[2])
-            embed.add_field(name="Strength", value=levels[3])
-            embed.add_field(name="Hitpoints", value=levels[4])
-            embed.add_field(name="Ranged", value=levels[5])
-            embed.add_field(name="Prayer", value=levels[6])
-            embed.add_field(name="Magic", value=levels[7])
-
-            await message.channel.send(embed=embed)
-
-    elif cmd == '!hs':
-        # If the required argument is missing, stop here
-        if len(body) == 0:
-            return
+    :param message: Message sent in server
+    :return: boolean, True for the bot's admins and members with the Manage Server permission
+    """
+    permissions = getattr(message.author, 'guild_permissions', None)
+    return is_admin(message) or (permissions is not None and permissions.manage_guild)
 
-        rsn = body
-        get_hs(rsn)
 
-        file = rsn + '.txt'
-        file_payload = discord.File(file, filename=(rsn + '.txt'))
-        await message.channel.send(f'{rsn}\'s OSRS Highscores:\n', file=file_payload)
-        os.remove(file)
+def served_guild_ids():
+    """Returns the IDs of the servers this process serves.
 
-    elif cmd == '!skills':
-        # If the required argument is missing, stop here
-        if len(body) == 0:
-            return
+    :return: list of int guild IDs, or [None] in single guild mode
+    """
+    if not MULTI_GUILD:
+        return [None]
+    return [guild.id for guild in client.guilds]
 
-        rsn = body
-        get_skills(rsn)
 
-        file = rsn + '.txt'
-        file_payload = discord.File(file, filename=(rsn + '.txt'))
-        await message.channel.send(f'{rsn}\'s OSRS Skills:\n', file=file_payload)
-        os.remove(file)
+async def message_clan(message):
+    """Returns the clan of the server a message was sent in, replying with an error if it
+    wasn't sent in a server in multi-guild mode.
 
-    elif cmd == '!bosses':
-        # If the required argument is missing, stop here
-        if len(body) == 0:
-            return
-        rsn = body
+    :param message: Message sent in server
+    :return: guild_registry.Clan, or None
+    """
+    # Warming a large clan's leaderboards can outlast a single lookup's timeout
+    if not MULTI_GUILD:
+        return await run_blocking(clans.get, None, timeout=None)
+    if message.guild is None:
+        await message.channel.send('This command can only be used in a server.\n')
+        return None
+    return await run_blocking(clans.get, message.guild.id, timeout=None)
 
-        get_bosses(rsn)
 
-        file = rsn + '.txt'
-        file_payload = discord.File(file, filename=(rsn + '.txt'))
-        await message.channel.send(f'{rsn}\'s OSRS Boss KC:\n', file=file_payload)
-        os.remove(file)
+def top_args(body):
+    """Argument parser for !top, takes an entry name and an optional number of members to list.
+
+    :param body: string arguments parsed from message
+    :return: tuple (entry, n)
+    @:raises ArgumentError if the entry is missing
+    """
+    args = body.split()
+    if len(args) == 0:
+        raise ArgumentError('Missing entry')
+    n = min(int(args[1]), TOP_MAX) if len(args) > 1 and args[1].isdigit() else TOP_DEFAULT
+    return args[0].lower(), n
+
+
+def rank_args(body):
+    """Argument parser for !rank, takes an RSN and an entry name.
+
+    :param body: string arguments parsed from message
+    :return: tuple (rsn, entry)
+    @:raises ArgumentError if the RSN or entry is missing
+    """
+    args = body.split()
+    if len(args) < 2:
+        raise ArgumentError('Missing RSN or entry')
+    return ' '.join(args[:-1]), args[-1].lower()
 
-    elif cmd == '!ehb':
-        # If the required argument is missing, stop here
-        if len(body) == 0:
-            return
 
-        rsn = body
+def gains_args(body):
+    """Argument parser for !gains, takes an RSN and an optional period such as '7d'.
 
-        # Check cached list of iron/main status to speed things up immensely.
-        if rsn.lower() in iron_dict:
-            is_ironman = iron_dict[rsn.lower()]
+    :param body: string arguments parsed from message
+    :return: tuple (rsn, period)
+    @:raises ArgumentError if the RSN is missing
+    """
+    args = body.split()
+    if len(args) == 0:
+        raise ArgumentError('Missing RSN')
+    if len(args) > 1 and parse_period(args[-1]) is not None:
+        return ' '.join(args[:-1]), args[-1].lower()
+    return ' '.join(args), GAINS_DEFAULT_PERIOD
+
+
+def kc_gains_args(body):
+    """Argument parser for !kc-gains, takes an RSN, a boss and an optional period such as '30d'.
+
+    :param body: string arguments parsed from message
+    :return: tuple (rsn, boss, period)
+    @:raises ArgumentError if the RSN or boss is missing
+    """
+    args = body.split()
+    period = KC_GAINS_DEFAULT_PERIOD
+    if len(args) > 2 and parse_period(args[-1]) is not None:
+        period = args.pop().lower()
+    if len(args) < 2:
+        raise ArgumentError('Missing RSN or boss')
+    return ' '.join(args[:-1]), args[-1].lower(), period
+
+
+def profile_args(body):
+    """Argument parser for !profile, takes an optional command, number of invocations and mode.
+
+    :param body: string arguments parsed from message
+    :return: tuple (command, n, mode), command is None if no arguments were given
+    @:raises ArgumentError if the number of invocations or mode is invalid
+    """
+    args = body.lower().split()
+    if len(args) == 0:
+        return None, 0, PROFILE_MODE
+    command = args[0] if args[0].startswith(router.prefix) else router.prefix + args[0]
+    n, mode = 1, PROFILE_MODE
+    for arg in args[1:]:
+        if arg.isdigit() and int(arg) > 0:
+            n = int(arg)
+        elif arg in PROFILE_MODES:
+            mode = arg
         else:
-            is_ironman = is_iron(rsn.lower())
-            iron_dict[rsn.lower()] = is_ironman
+            raise ArgumentError(f'Invalid argument {arg}')
+    return command, n, mode
 
-            # Write updated copy of dictionary to file
-            with open(IRON_DICT_NAME, 'w') as iron_outfile:
-                iron_outfile.write(str(iron_dict))
 
-        calc_ehb(rsn, is_ironman)
+def prefix_args(body):
+    """Argument parser for !prefix, takes a short prefix without any whitespace.
 
-        file = rsn + '_ehb.txt'
-        file_payload = discord.File(file, filename=(rsn + '_ehb.txt'))
-        await message.channel.send(f'{rsn}\'s OSRS efficient hours bossed:\n', file=file_payload)
-        os.remove(file)
+    :param body: string arguments parsed from message
+    :return: tuple (prefix,)
+    @:raises ArgumentError if the prefix is missing, contains whitespace or is longer than MAX_PREFIX_LENGTH
+    """
+    prefix = body.strip()
+    # Commands are split from their arguments at the first space, so a prefix can't contain one
+    if not prefix or len(prefix) > MAX_PREFIX_LENGTH or any(char.isspace() for char in prefix):
+        raise ArgumentError('Invalid prefix')
+    return (prefix,)
 
-    elif cmd == '!activities':
-        # If the required argument is missing, stop here
-        if len(body) == 0:
-            return
 
-        rsn = body
-        get_activities(rsn)
+def cracker_args(body):
+    """Argument parser for !christmas-cracker, takes two users separated by '+'.
 
-        file = rsn + '.txt'
-        file_payload = discord.File(file, filename=(rsn + '.txt'))
-        await message.channel.send(f'{rsn}\'s OSRS Activities:\n', file=file_payload)
-        os.remove(file)
+    :param body: string arguments parsed from message
+    :return: tuple (user_1, user_2)
+    @:raises ArgumentError if there aren't two users
+    """
+    if '+' not in body:
+        raise ArgumentError('Missing second user')
+    user_1, user_2 = body.split('+', maxsplit=1)
+    return user_1, user_2
 
-    elif cmd == '!:p':
-        await message.channel.send(':stuck_out_tongue_winking_eye:\n'
-                                   '***__THBBBBBBBBBBBBBBBT!!!!__***')
 
-    elif cmd == '!version':
-        await message.channel.send(f'Running Clockwork Penguin {VERSION}\n')
+async def shared_user(message, rsn):
+    """Fetches a player's snapshot for a lookup command, sharing one fetch between everyone
+    looking the same player up at once. Reports are then rendered from the snapshot per
+    caller, so each reply uses the caller's own spelling of the RSN.
 
-    elif cmd == '!birdmen':
-        wh = WebhookHandler()
-        wh.send_file('#birdmen!\n ***S C R E E E E E***\n', filename='resources/birdman.png', name='Kree\'arra',
-                     avatar=BIRDMAN_AVATAR)
-    elif cmd == '!christmas-cracker':
-        user_1, user_2 = body.split('+', maxsplit=1)
-        users = [user_1, user_2]
-        winner = np.random.choice(users)
-        users.remove(winner)
-        loser = users[0]
+    :param message: Message sent in server
+    :param rsn: str value of a player's OSRS username
+    :return: HighscoreSnapshot, or None if the player isn't on the highscores, after replying so
+    """
+    try:
+        return await router.shared(('user', rsn.lower()), run_blocking, get_user, rsn)
+    except ValueError:
+        await message.channel.send(f'User {rsn} not found!')
+        return None
+
+
+@router.command('!cmb', parse=required_arg, usage='!cmb <rsn>',
+                concurrency=LOOKUP_CONCURRENCY, cooldown=LOOKUP_COOLDOWN)
+async def cmb_command(message, rsn):
+    levels = await router.shared(('!cmb', rsn.lower()), run_blocking, calc_cmb_lvl, rsn)
+
+    if levels == [-1]:
+        response = f'User {rsn} not found!'
+        await message.channel.send(response)
+    elif levels == [-2]:
+        response = f'Cannot calculate user {rsn}\'s combat' \
+                   f'level as not all skills are listed on the highscores.\n'
+        await message.channel.send(response)
+    else:
+        embed = discord.Embed(title=rsn + "\'s Combat level:", description=levels[0], color=0xff0000)
+        embed.add_field(name="Attack", value=levels[1])
+        embed.add_field(name="Defence", value=levels[2])
+        embed.add_field(name="Strength", value=levels[3])
+        embed.add_field(name="Hitpoints", value=levels[4])
+        embed.add_field(name="Ranged", value=levels[5])
+        embed.add_field(name="Prayer", value=levels[6])
+        embed.add_field(name="Magic", value=levels[7])
+
+        await message.channel.send(embed=embed)
+
+
+@router.command('!cmb-next', parse=required_arg, usage='!cmb-next <rsn>',
+                concurrency=LOOKUP_CONCURRENCY, cooldown=LOOKUP_COOLDOWN)
+async def cmb_next_command(message, rsn):
+    user = await shared_user(message, rsn)
+    if user is None:
+        return
+    report = await run_blocking(render_cmb_next, rsn, user)
 
-        color = partyhat()
-        other_prize = cc_other_prize()
-        msg = f'{winner} got a {color} partyhat! Sweet!\n' \
-              f'{loser} got {other_prize}. Scam game!\n'
+    if report is None:
+        await message.channel.send(f'Cannot calculate user {rsn}\'s next combat level as not all '
+                                   f'combat skills are listed on the highscores.\n')
+    else:
+        await message.channel.send(f'```{report}```')
 
-        file = color + '_partyhat.png'
-        filepath = 'resources/' + file
-        file_payload = discord.File(filepath, filename=file)
-        await message.channel.send(msg, file=file_payload)
 
+@router.command('!hs', parse=required_arg, usage='!hs <rsn>',
+                concurrency=LOOKUP_CONCURRENCY, cooldown=LOOKUP_COOLDOWN)
+async def hs_command(message, rsn):
+    user = await shared_user(message, rsn)
+    if user is None:
+        return
+    report = await run_blocking(render_hs, rsn, user)
+
+    file_payload = report_file(report, rsn + '.txt')
+    await message.channel.send(f'{rsn}\'s OSRS Highscores:\n', file=file_payload)
+
+
+@router.command('!skills', parse=required_arg, usage='!skills <rsn>',
+                concurrency=LOOKUP_CONCURRENCY, cooldown=LOOKUP_COOLDOWN)
+async def skills_command(message, rsn):
+    user = await shared_user(message, rsn)
+    if user is None:
+        return
+    report = await run_blocking(render_skills, rsn, user)
 
-def parse_command(content):
-    """Breaks message.content into command and body of arguments
+    file_payload = report_file(report, rsn + '.txt')
+    await message.channel.send(f'{rsn}\'s OSRS Skills:\n', file=file_payload)
 
-    :param content: string message.content to parse
-    :return: string cmd, string body. If content has no arguments,
-    body returns an empty string.
+
+@router.command('!bosses', parse=required_arg, usage='!bosses <rsn>',
+                concurrency=LOOKUP_CONCURRENCY, cooldown=LOOKUP_COOLDOWN)
+async def bosses_command(message, rsn):
+    user = await shared_user(message, rsn)
+    if user is None:
+        return
+    report = await run_blocking(render_bosses, rsn, user)
+
+    file_payload = report_file(report, rsn + '.txt')
+    await message.channel.send(f'{rsn}\'s OSRS Boss KC:\n', file=file_payload)
+
+
+async def lookup_rates(rsn):
+    """Looks up what a player's EHB and EHP reports are rendered from: their game mode, checking
+    account_store first, and their snapshot.
+
+    :param rsn: str value of a player's OSRS username
+    :return: tuple of GameMode and HighscoreSnapshot, or None if the player is not found on the highscores
     """
-    if ' ' not in content:
-        return content.lower(), ''
+    # Check cached game mode to speed things up immensely. The store is only opened, and
+    # any legacy ironmen file migrated, off the event loop
+    try:
+        mode = await run_blocking(lookup_game_mode, rsn, account_store)
+        user = await run_blocking(get_user, rsn)
+    except ValueError:
+        return None
+    return mode, user
+
+
+@router.command('!ehb', parse=required_arg, usage='!ehb <rsn>',
+                concurrency=LOOKUP_CONCURRENCY, cooldown=LOOKUP_COOLDOWN)
+async def ehb_command(message, rsn):
+    # The lookup is shared between everyone looking the same player up at once, and between
+    # !ehb and !ehp, but each caller's report uses their own spelling of the RSN
+    rates = await router.shared(('rates', rsn.lower()), lookup_rates, rsn)
+    if rates is None:
+        await message.channel.send(f'User {rsn} not found!')
+        return
+    report = await run_blocking(render_ehb, rsn, *rates)
+
+    file_payload = report_file(report, rsn + '_ehb.txt')
+    await message.channel.send(f'{rsn}\'s OSRS efficient hours bossed:\n', file=file_payload)
+
+
+@router.command('!ehp', parse=required_arg, usage='!ehp <rsn>',
+                concurrency=LOOKUP_CONCURRENCY, cooldown=LOOKUP_COOLDOWN)
+async def ehp_command(message, rsn):
+    rates = await router.shared(('rates', rsn.lower()), lookup_rates, rsn)
+    if rates is None:
+        await message.channel.send(f'User {rsn} not found!')
+        return
+    report = await run_blocking(render_ehp, rsn, *rates)
+
+    file_payload = report_file(report, rsn + '_ehp.txt')
+    await message.channel.send(f'{rsn}\'s OSRS efficient hours played:\n', file=file_payload)
+
+
+@router.command('!activities', parse=required_arg, usage='!activities <rsn>',
+                concurrency=LOOKUP_CONCURRENCY, cooldown=LOOKUP_COOLDOWN)
+async def activities_command(message, rsn):
+    user = await shared_user(message, rsn)
+    if user is None:
+        return
+    report = await run_blocking(render_activities, rsn, user)
+
+    file_payload = report_file(report, rsn + '.txt')
+    await message.channel.send(f'{rsn}\'s OSRS Activities:\n', file=file_payload)
+
+
+@router.command('!gains', parse=gains_args, usage='!gains <rsn> [period, e.g. 12h, 7d, 2w or 1m]',
+                concurrency=LOOKUP_CONCURRENCY, cooldown=LOOKUP_COOLDOWN)
+async def gains_command(message, rsn, period):
+    snapshots = await run_blocking(history.gains, rsn, parse_period(period))
+    if snapshots is None:
+        await message.channel.send(f'No history recorded for {rsn} yet, look them up with !hs first.\n')
+        return
+
+    file_payload = report_file(render_gains(rsn, *snapshots, period), rsn + '_gains.txt')
+    await message.channel.send(f'{rsn}\'s gains over {period}:\n', file=file_payload)
+
+
+@router.command('!kc-gains', parse=kc_gains_args, usage='!kc-gains <rsn> <boss> [period, e.g. 30d]',
+                concurrency=LOOKUP_CONCURRENCY, cooldown=LOOKUP_COOLDOWN)
+async def kc_gains_command(message, rsn, boss, period):
+    if boss not in BOSS_INDEX:
+        await message.channel.send(f'{boss} is not a boss on the highscores.\n')
+        return
+
+    snapshots = await run_blocking(history.gains, rsn, parse_period(period))
+    if snapshots is None:
+        await message.channel.send(f'No history recorded for {rsn} yet, look them up with !hs first.\n')
+        return
+    await message.channel.send(render_kc_gains(rsn, boss, *snapshots, period))
+
+
+@router.command('!members')
+async def members_command(message):
+    clan = await message_clan(message)
+    if clan is None:
+        return
+    await message.channel.send(f'{len(clan.members())} members saved.\n')
+
+
+@router.command('!members-add', parse=required_arg, usage='!members-add <rsn>')
+async def members_add_command(message, rsn):
+    if not can_configure(message):
+        return
+    clan = await message_clan(message)
+    if clan is None:
+        return
+    try:
+        added = clan.add_member(rsn)
+    except ValueError:
+        await message.channel.send(f'The member list is full, it can hold up to {MAX_CLAN_MEMBERS} players.\n')
+        return
+    if added:
+        await message.channel.send(f'Added {rsn} to the member list.\n')
+    else:
+        await message.channel.send(f'{rsn} is already on the member list.\n')
+
+
+@router.command('!members-remove', parse=required_arg, usage='!members-remove <rsn>')
+async def members_remove_command(message, rsn):
+    if not can_configure(message):
+        return
+    clan = await message_clan(message)
+    if clan is None:
+        return
+    if clan.remove_member(rsn):
+        await message.channel.send(f'Removed {rsn} from the member list.\n')
+    else:
+        await message.channel.send(f'{rsn} is not on the member list.\n')
+
+
+@router.command('!ehb-group', concurrency=GROUP_COMMAND_CONCURRENCY, cooldown=GROUP_COMMAND_COOLDOWN)
+async def ehb_group_command(message):
+    results, failures = await fetch_members(message, fetch_member_with_mode, account_store)
+    if results is None:
+        return
+
+    file_payload = report_file(render_group_ehb(results, failures), 'clan_ehb.txt')
+    await message.channel.send('Clan efficient hours bossed:\n', file=file_payload)
+
+
+@router.command('!ehp-group', concurrency=GROUP_COMMAND_CONCURRENCY, cooldown=GROUP_COMMAND_COOLDOWN)
+async def ehp_group_command(message):
+    results, failures = await fetch_members(message, fetch_member_with_mode, account_store)
+    if results is None:
+        return
+
+    file_payload = report_file(render_group_ehp(results, failures), 'clan_ehp.txt')
+    await message.channel.send('Clan efficient hours played:\n', file=file_payload)
+
+
+@router.command('!cmb-group', concurrency=GROUP_COMMAND_CONCURRENCY, cooldown=GROUP_COMMAND_COOLDOWN)
+async def cmb_group_command(message):
+    results, failures = await fetch_members(message, get_user)
+    if results is None:
+        return
+
+    file_payload = report_file(render_group_cmb(results, failures), 'clan_cmb.txt')
+    await message.channel.send('Clan combat levels:\n', file=file_payload)
+
+
+@router.command('!top', parse=top_args, usage='!top <skill|activity|boss|ehb> [n]')
+async def top_command(message, entry, n):
+    if entry not in LEADERBOARD_ENTRIES:
+        await message.channel.send(f'{entry} is not a skill, activity or boss on the highscores.\n')
+        return
+
+    clan = await message_clan(message)
+    if clan is None:
+        return
+    await message.channel.send(f'```{render_leaderboard(clan.leaderboards, entry, n)}```')
+
+
+@router.command('!rank', parse=rank_args, usage='!rank <rsn> <skill|activity|boss|ehb>')
+async def rank_command(message, rsn, entry):
+    if entry not in LEADERBOARD_ENTRIES:
+        await message.channel.send(f'{entry} is not a skill, activity or boss on the highscores.\n')
+        return
+
+    clan = await message_clan(message)
+    if clan is None:
+        return
+    ranking = clan.leaderboards.rank(rsn, entry)
+    if ranking is None:
+        await message.channel.send(f'{rsn} is not ranked in the clan for {entry_name(entry)}.\n')
+        return
+    rank, value, ranked = ranking
+    score = f'{value} {entry_unit(entry)}'.strip()
+    await message.channel.send(f'{rsn} is ranked #{rank} of {ranked} in the clan for {entry_name(entry)} '
+                               f'with {score}.\n')
+
+
+@router.command('!:p')
+async def tongue_command(message):
+    await message.channel.send(':stuck_out_tongue_winking_eye:\n'
+                               '***__THBBBBBBBBBBBBBBBT!!!!__***')
+
+
+@router.command('!version')
+async def version_command(message):
+    await message.channel.send(f'Running Clockwork Penguin {VERSION}\n')
+
+
+@router.command('!stats')
+async def stats_command(message):
+    if not is_admin(message):
+        return
+    # The summary grows with every labelled series, so it is sent as a file like the other long reports
+    file_payload = report_file(metrics.render_summary(), 'stats.txt')
+    await message.channel.send('Bot stats:\n', file=file_payload)
+
+
+@router.command('!profile', parse=profile_args, usage=f'!profile [command] [n] [{"|".join(PROFILE_MODES)}]')
+async def profile_command(message, command, n, mode):
+    if not is_admin(message):
+        return
+    if command is None:
+        sessions = [session.describe() for session in profiler.sessions()]
+        written = [f'Wrote {path}' for path in profiler.written]
+        await message.channel.send('```{}```'.format('\n'.join(sessions + written) or 'No commands being profiled'))
+        return
+    if command not in router.names():
+        await message.channel.send(f'{command} is not a command.\n')
+        return
+    profiler.arm(command, n, mode)
+    await message.channel.send(f'Profiling the next {n} invocation(s) of {command} ({mode}), '
+                               f'written to {profiler.directory}/ when done.\n')
+
+
+@router.command('!profile-stop', parse=required_arg, usage='!profile-stop <command>')
+async def profile_stop_command(message, command):
+    if not is_admin(message):
+        return
+    command = command.strip().lower()
+    command = command if command.startswith(router.prefix) else router.prefix + command
+    if profiler.disarm(command):
+        await message.channel.send(f'Stopped profiling {command}.\n')
     else:
-        cmd, body = content.split(' ', maxsplit=1)
-        return cmd.lower(), body
+        await message.channel.send(f'{command} is not being profiled.\n')
+
+
+@router.command('!prefix', parse=prefix_args,
+                usage=f'!prefix <prefix of up to {MAX_PREFIX_LENGTH} characters, without spaces>')
+async def prefix_command(message, prefix):
+    if not MULTI_GUILD or message.guild is None or not can_configure(message):
+        return
+    guild_registry.set_prefix(message.guild.id, prefix)
+    await message.channel.send(f'Commands in this server now start with {prefix}\n')
 
 
-client.run(TOKEN)
+@router.command('!webhook-set', parse=required_arg, usage='!webhook-set <webhook URL>')
+async def webhook_set_command(message, url):
+    if not MULTI_GUILD or message.guild is None or not can_configure(message):
+        return
+    try:
+        # The URL is all anyone needs to post through the webhook, so don't leave it in the channel
+        await message.delete()
+    except discord.HTTPException:
+        pass
+    try:
+        clans.set_webhook(message.guild.id, url.strip())
+    except ValueError:
+        await message.channel.send('That isn\'t a Discord webhook URL, it should look like '
+                                   'https://discord.com/api/webhooks/<id>/<token>\n')
+        return
+    await message.channel.send('Webhook set for this server.\n')
+
+
+@router.command('!birdmen')
+async def birdmen_command(message):
+    clan = await message_clan(message)
+    if clan is None:
+        return
+    if clan.webhook is None:
+        await message.channel.send('No webhook set for this server, set one with !webhook-set <webhook URL>\n')
+        return
+    clan.webhook.send_file('#birdmen!\n ***S C R E E E E E***\n', filename='birdman.png', name='Kree\'arra',
+                           avatar=BIRDMAN_AVATAR, content=resources.get('birdman.png'))
+
+
+@router.command('!christmas-cracker', parse=cracker_args, usage='!christmas-cracker <user1>+<user2>')
+async def christmas_cracker_command(message, user_1, user_2):
+    users = [user_1, user_2]
+    winner = np.random.choice(users)
+    users.remove(winner)
+    loser = users[0]
+
+    color = partyhat()
+    other_prize = cc_other_prize()
+    msg = f'{winner} got a {color} partyhat! Sweet!\n' \
+          f'{loser} got {other_prize}. Scam game!\n'
+
+    file = color + '_partyhat.png'
+    file_payload = discord.File(resources.open(file), filename=file)
+    await message.channel.send(msg, file=file_payload)
+
+
+async def fetch_members(message, func, *args):
+    """Runs a lookup for every member of the message's clan, posting a progress message
+    in the channel which is updated at most every GROUP_PROGRESS_INTERVAL seconds.
+
+    :param message: Message the group command was sent in
+    :param func: Blocking callable taking (rsn, *args), run once per member
+    :param args: Additional arguments passed to func
+    :return: tuple (results, failures) as returned by group_utils.fetch_group, or
+    (None, None) if no members are saved or the message wasn't sent in a server
+    """
+    clan = await message_clan(message)
+    if clan is None:
+        return None, None
+    members = clan.members()
+    if len(members) == 0:
+        await message.channel.send('No members saved, add some with !members-add <rsn>\n')
+        return None, None
+
+    progress_msg = await message.channel.send(f'Fetching {len(members)} members...\n')
+    last_update = time.monotonic()
+
+    async def progress(done, failed):
+        nonlocal last_update
+        if done < len(members) and time.monotonic() - last_update < GROUP_PROGRESS_INTERVAL:
+            return
+        last_update = time.monotonic()
+        await progress_msg.edit(content=f'Fetched {done}/{len(members)} members ({failed} failed)\n')
+
+    return await fetch_group(members, func, *args, progress=progress)
+
+
+async def downsample_history():
+    """Thins out old snapshot history, and prunes persisted lookups too old to be served,
+    every HISTORY_DOWNSAMPLE_INTERVAL seconds, forever.
+
+    :return: None
+    """
+    while True:
+        # Maintenance isn't bound by HS_REQUEST_TIMEOUT, and a failed pass is retried next interval
+        try:
+            await run_blocking(history.downsample, timeout=None)
+            if snapshot_store is not None:
+                await run_blocking(snapshot_store.prune, timeout=None)
+        except Exception as err:
+            log_message(f'History downsampling failed: {err!r}')
+        await asyncio.sleep(HISTORY_DOWNSAMPLE_INTERVAL)
+
+
+def report_file(report, filename):
+    """Wraps a rendered report as a Discord attachment without writing it to disk.
+
+    :param report: str report as returned by one of the osrs_utils render_* functions
+    :param filename: str name to give the attachment
+    :return: discord.File
+    """
+    return discord.File(io.BytesIO(report.encode('utf-8')), filename=filename)
+
+
+def configure_shards(shard_ids, shard_count):
+    """Runs only some of the bot's shards in this process, with a matching share of
+    HS_RATE_LIMIT, so that the processes together stay within it.
+
+    :param shard_ids: list of int IDs of the shards to run
+    :param shard_count: int total number of shards across all processes
+    :return: None
+    @:raises ValueError if the shards are invalid, see check_shards
+    """
+    check_shards(shard_ids, shard_count)
+    client.shard_ids = shard_ids
+    client.shard_count = shard_count
+    share = len(shard_ids) / shard_count
+    hs_limiter.rate = HS_RATE_LIMIT * share
+    hs_limiter.burst = max(1, int(HS_RATE_BURST * share))
+
+
+if MULTI_GUILD and SHARD_IDS:
+    configure_shards(SHARD_IDS, SHARD_COUNT)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the Clockwork Penguin Discord bot.')
+    parser.add_argument('--shard-ids', type=int, nargs='+', help='in multi-guild mode, only run these shards')
+    parser.add_argument('--shard-count', type=int, help='total number of shards across all processes')
+    args = parser.parse_args()
+    if args.shard_ids:
+        if not MULTI_GUILD or not args.shard_count:
+            parser.error('--shard-ids needs MULTI_GUILD = True and --shard-count')
+        try:
+            configure_shards(args.shard_ids, args.shard_count)
+        except ValueError as err:
+            parser.error(str(err))
+
+    client.run(TOKEN)
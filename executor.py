@@ -0,0 +1,66 @@
+"""executor.py
+Bounded thread pool used to run blocking highscores lookups off of the
+Discord event loop, so that one slow lookup doesn't stall every other command.
+"""
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from config import *
+from metrics import metrics
+from profiler import profiler
+from rate_limiter import RetryLater, requeue_attempt
+
+_pool = ThreadPoolExecutor(max_workers=HS_MAX_WORKERS, thread_name_prefix='hs-lookup')
+
+# Number of lookups submitted to the pool that haven't finished yet. Only touched
+# from the event loop thread so it needs no lock.
+_pending = 0
+metrics.register_gauges('hs_pool', lambda: {'pending': _pending, 'workers': HS_MAX_WORKERS})
+
+
+async def run_blocking(func, *args, timeout=HS_REQUEST_TIMEOUT, **kwargs):
+    """Runs a blocking function on the lookup pool and waits for its result
+    without blocking the event loop.
+
+    At most HS_MAX_WORKERS calls run at once, any further calls are queued until
+    a worker frees up. If the highscores ask us to back off, func is re-queued once the
+    rate limiter's pause is over rather than holding a worker while it waits.
+
+    :param func: Blocking callable to run, e.g. osrs_utils.get_hs
+    :param args: Positional arguments passed to func
+    :param timeout: Seconds to wait for func to finish, including time queued behind other calls,
+    or None to wait indefinitely. The default suits a single highscores lookup, so pass None
+    for maintenance work such as downsampling the history.
+    :param kwargs: Keyword arguments passed to func
+    :return: Return value of func
+    @:raises asyncio.TimeoutError if func does not finish within timeout
+    """
+    global _pending
+    loop = asyncio.get_event_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    requeues = 0
+    _pending += 1
+    try:
+        while True:
+            # Copy the caller's context so that context variables set by the command
+            # handler are visible to func in the worker thread, including the profiling session of
+            # a command being profiled.
+            ctx = contextvars.copy_context()
+            ctx.run(requeue_attempt.set, requeues)
+            future = loop.run_in_executor(_pool, partial(ctx.run, profiler.run, func, *args, **kwargs))
+            try:
+                return await asyncio.wait_for(future, None if deadline is None else deadline - loop.time())
+            except RetryLater as err:
+                if deadline is not None and loop.time() + err.delay >= deadline:
+                    raise asyncio.TimeoutError from err
+                metrics.inc('hs_lookup_requeues_total')
+                requeues += 1
+                await asyncio.sleep(err.delay)
+    except asyncio.TimeoutError:
+        metrics.inc('hs_lookup_timeouts_total')
+        raise
+    finally:
+        _pending -= 1
+
@@ -0,0 +1,210 @@
+"""group_utils.py
+Clan member list and commands that run over every member at once.
+
+Members are fetched through fetch_group, which runs at most GROUP_CONCURRENCY
+lookups at a time at BATCH priority by default, and records failed lookups instead of
+aborting the batch.
+"""
+import asyncio
+import os
+
+from config import *
+from osrs_utils import *
+from executor import run_blocking
+from account_store import NOT_FOUND
+from logging_ import log_message
+from rate_limiter import request_priority, BATCH
+
+
+def load_members(path=MEMBER_LIST_NAME):
+    """Reads the saved member list.
+
+    :param path: str path of member list file
+    :return: list of str RSNs, empty if no list has been saved
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as member_file:
+        return [line.strip() for line in member_file if line.strip()]
+
+
+def save_members(members, path=MEMBER_LIST_NAME):
+    """Writes the member list, one RSN per line.
+
+    :param members: list of str RSNs
+    :param path: str path of member list file
+    :return: None
+    """
+    with open(path, 'w') as member_file:
+        member_file.writelines(f'{rsn}\n' for rsn in members)
+
+
+def add_member(rsn, path=MEMBER_LIST_NAME):
+    """Adds a player to the member list.
+
+    :param rsn: str value of a player's OSRS username
+    :param path: str path of member list file
+    :return: boolean, False if the player was already a member
+    """
+    members = load_members(path)
+    if rsn.lower() in (member.lower() for member in members):
+        return False
+    members.append(rsn)
+    save_members(members, path)
+    return True
+
+
+def remove_member(rsn, path=MEMBER_LIST_NAME):
+    """Removes a player from the member list.
+
+    :param rsn: str value of a player's OSRS username
+    :param path: str path of member list file
+    :return: boolean, False if the player wasn't a member
+    """
+    members = load_members(path)
+    remaining = [member for member in members if member.lower() != rsn.lower()]
+    if len(remaining) == len(members):
+        return False
+    save_members(remaining, path)
+    return True
+
+
+def lookup_game_mode(rsn, account_store):
+    """Returns a player's game mode, using account_store to avoid re-detecting it where
+    possible. Blocking, since the store is a SQLite database, so run it with
+    executor.run_blocking.
+
+    :param rsn: str value of a player's OSRS username
+    :param account_store: AccountTypeStore used to cache game modes
+    :return: GameMode
+    @:raises ValueError if player is not found on highscores
+    """
+    account_type = account_store.get(rsn)
+    if account_type is None:
+        try:
+            mode = get_game_mode(rsn)
+        except ValueError:
+            account_store.set_not_found(rsn)
+            raise
+        account_store.set(rsn, mode.value)
+        return mode
+    if account_type == NOT_FOUND:
+        raise ValueError(f'User {rsn} not found!')
+    return GameMode(account_type)
+
+
+def fetch_member_with_mode(rsn, account_store):
+    """Fetches a member's snapshot along with their game mode, see lookup_game_mode.
+
+    :param rsn: str value of a player's OSRS username
+    :param account_store: AccountTypeStore used to cache game modes
+    :return: tuple (HighscoreSnapshot, GameMode)
+    @:raises ValueError if player is not found on highscores
+    """
+    mode = lookup_game_mode(rsn, account_store)
+    return get_user(rsn), mode
+
+
+async def fetch_group(rsns, func, *args, concurrency=GROUP_CONCURRENCY, progress=None, priority=BATCH):
+    """Runs a blocking lookup for every member, at most concurrency at a time.
+
+    :param rsns: list of str RSNs
+    :param func: Blocking callable taking (rsn, *args), e.g. hs_wrapper.get_user
+    :param args: Additional arguments passed to func
+    :param concurrency: Maximum number of lookups to run at once
+    :param progress: Optional coroutine function called as progress(done, failed) after each lookup
+    :param priority: Priority the lookups are made at, from rate_limiter
+    :return: tuple (results, failures), dicts mapping RSNs to func's return value and to the
+    exception raised for members whose lookup failed. results keeps the order of rsns.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(rsn):
+        # Each fetch runs as its own task, so this only lowers the priority of group lookups
+        request_priority.set(priority)
+        async with semaphore:
+            try:
+                return rsn, await run_blocking(func, rsn, *args), None
+            except Exception as err:
+                return rsn, None, err
+
+    results = {}
+    failures = {}
+    for done, task in enumerate(asyncio.as_completed([fetch(rsn) for rsn in rsns]), 1):
+        rsn, result, err = await task
+        if err is None:
+            results[rsn] = result
+        else:
+            failures[rsn] = err
+            log_message(f'Group lookup for {rsn} failed: {err!r}')
+        if progress is not None:
+            await progress(done, len(failures))
+
+    return {rsn: results[rsn] for rsn in rsns if rsn in results}, failures
+
+
+def _render_failures(failures):
+    """Renders a footer listing members whose lookups failed.
+
+    :param failures: dict mapping RSNs to the exception raised for them
+    :return: list of str lines
+    """
+    if not failures:
+        return []
+    return ['\nCould not fetch {} member(s): {}\n'.format(len(failures), ', '.join(failures))]
+
+
+def render_group_ehb(results, failures):
+    """Renders a ranking of members by efficient hours bossed.
+
+    :param results: dict mapping RSNs to (HighscoreSnapshot, GameMode) tuples
+    :param failures: dict mapping RSNs to the exception raised for them
+    :return: str report
+    """
+    lines = ['Clan efficient hours bossed:\n'
+             '---------------------------------------------------\n']
+    if results:
+        rsns = list(results)
+        _, totals = calc_ehb_batch(kc_matrix([results[rsn][0] for rsn in rsns]),
+                                   [results[rsn][1] for rsn in rsns])
+        for rank, i in enumerate(np.argsort(-totals, kind='stable'), 1):
+            lines.append('{:>4}. {:<12} {:>10} EHB\n'.format(rank, rsns[i], round(float(totals[i]), 2)))
+    return ''.join(lines + _render_failures(failures))
+
+
+def render_group_ehp(results, failures):
+    """Renders a ranking of members by efficient hours played.
+
+    :param results: dict mapping RSNs to (HighscoreSnapshot, GameMode) tuples
+    :param failures: dict mapping RSNs to the exception raised for them
+    :return: str report
+    """
+    lines = ['Clan efficient hours played:\n'
+             '---------------------------------------------------\n']
+    if results:
+        rsns = list(results)
+        _, totals = calc_ehp_batch(xp_matrix([results[rsn][0] for rsn in rsns]),
+                                   [results[rsn][1] for rsn in rsns])
+        for rank, i in enumerate(np.argsort(-totals, kind='stable'), 1):
+            lines.append('{:>4}. {:<12} {:>10} EHP\n'.format(rank, rsns[i], round(float(totals[i]), 2)))
+    return ''.join(lines + _render_failures(failures))
+
+
+def render_group_cmb(results, failures):
+    """Renders a ranking of members by combat level.
+
+    :param results: dict mapping RSNs to HighscoreSnapshots
+    :param failures: dict mapping RSNs to the exception raised for them
+    :return: str report
+    """
+    lines = ['Clan combat levels:\n'
+             '---------------------------------------------------\n']
+    combat = calc_cmb_batch(combat_matrix(list(results.values()))) if results else []
+    levels = [(rsn, int(level)) for rsn, level in zip(results, combat)]
+    ranked = sorted((entry for entry in levels if entry[1] > 0), key=lambda entry: -entry[1])
+    for rank, (rsn, level) in enumerate(ranked, 1):
+        lines.append('{:>4}. {:<12} {:>4}\n'.format(rank, rsn, level))
+    unranked = [rsn for rsn, level in levels if level <= 0]
+    if unranked:
+        lines.append('\nNot all combat skills listed for: {}\n'.format(', '.join(unranked)))
+    return ''.join(lines + _render_failures(failures))
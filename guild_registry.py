@@ -0,0 +1,393 @@
+"""guild_registry.py
+Per-guild state for multi-guild deployments, where one bot serves any number of
+Discord servers, possibly split into shards across several processes.
+
+GuildRegistry keeps each guild's command prefix, webhook and clan member list in a
+SQLite database that every process shares. Each guild is only served by the process
+running its shard, so that process is the only one writing its rows. ClanDirectory
+holds what a process builds from that per guild it serves: leaderboards and a webhook
+handler. It also merges member lists across guilds, so a player in many clans is still
+only tracked once.
+
+In single guild mode the directory holds one clan, with key None, backed by
+MEMBER_LIST_NAME and WEBHOOK as before.
+"""
+import re
+import sqlite3
+import threading
+import time
+
+from config import *
+from group_utils import load_members, add_member, remove_member
+from leaderboard import LeaderboardIndex
+from webhook_handler import WebhookHandler
+
+"""Discord webhook URLs, the only URLs accepted as a guild's webhook
+"""
+WEBHOOK_URL_PATTERN = re.compile(r'https://(?:discord|discordapp)\.com/api/(?:v\d+/)?webhooks/\d+/[\w-]+')
+
+
+class GuildConfig:
+    """A guild's settings.
+    """
+    __slots__ = ('guild_id', 'prefix', 'webhook_url')
+
+    def __init__(self, guild_id, prefix, webhook_url):
+        """
+        :param guild_id: int Discord guild ID
+        :param prefix: str prefix the guild's commands start with
+        :param webhook_url: str URL of the guild's webhook, '' if none is set
+        """
+        self.guild_id = guild_id
+        self.prefix = prefix
+        self.webhook_url = webhook_url
+
+
+class GuildRegistry:
+    """Settings and member lists of every guild. The database is only opened on first use.
+    """
+
+    def __init__(self, path=GUILD_DB_NAME, default_prefix='!', ttl=GUILD_CONFIG_TTL, max_members=MAX_CLAN_MEMBERS):
+        """
+        :param path: Path of the SQLite database file.
+        :param default_prefix: Prefix used by guilds that haven't set their own.
+        :param ttl: Number of seconds a guild's settings are cached in memory for, since they
+        are read on every message.
+        :param max_members: Maximum number of members on each guild's member list, since every
+        member is tracked against the shared highscores rate limit.
+        """
+        self.path = path
+        self.default_prefix = default_prefix
+        self.ttl = ttl
+        self.max_members = max_members
+        self._conn = None
+        self._lock = threading.Lock()
+        self._configs = {}
+
+    def _connect(self):
+        """Opens the database, creating its tables if needed. Must be called with self._lock held.
+
+        :return: sqlite3.Connection
+        """
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS guilds ('
+                         'guild_id INTEGER PRIMARY KEY, '
+                         'prefix TEXT NOT NULL, '
+                         'webhook TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS members ('
+                         'guild_id INTEGER NOT NULL, '
+                         'rsn_key TEXT NOT NULL, '
+                         'rsn TEXT NOT NULL, '
+                         'PRIMARY KEY (guild_id, rsn_key)) WITHOUT ROWID')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, guild_id):
+        """Returns a guild's settings, with defaults for any it hasn't set. Reads the database
+        if they aren't cached, so run it with executor.run_blocking.
+
+        :param guild_id: int Discord guild ID
+        :return: GuildConfig
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._configs.get(guild_id)
+            if cached is not None and now - cached[0] < self.ttl:
+                return cached[1]
+            row = self._connect().execute('SELECT prefix, webhook FROM guilds WHERE guild_id = ?',
+                                          (guild_id,)).fetchone()
+            config = GuildConfig(guild_id, *row) if row else GuildConfig(guild_id, self.default_prefix, '')
+            self._configs[guild_id] = (now, config)
+            return config
+
+    def cached(self, guild_id):
+        """Returns a guild's settings if they are cached and fresh, without reading the database,
+        so it is safe to call on the event loop.
+
+        :param guild_id: int Discord guild ID
+        :return: GuildConfig, or None if get() needs to read them from the database
+        """
+        with self._lock:
+            cached = self._configs.get(guild_id)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        return None
+
+    def _update(self, guild_id, column, value):
+        """Sets one of a guild's settings.
+
+        :param guild_id: int Discord guild ID
+        :param column: str 'prefix' or 'webhook'
+        :param value: str new value
+        :return: None
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT OR IGNORE INTO guilds VALUES (?, ?, ?)', (guild_id, self.default_prefix, ''))
+            conn.execute(f'UPDATE guilds SET {column} = ? WHERE guild_id = ?', (value, guild_id))
+            conn.commit()
+            self._configs.pop(guild_id, None)
+
+    def set_prefix(self, guild_id, prefix):
+        """Sets the prefix a guild's commands start with.
+
+        :param guild_id: int Discord guild ID
+        :param prefix: str prefix, e.g. '?'
+        :return: None
+        """
+        self._update(guild_id, 'prefix', prefix)
+
+    def set_webhook(self, guild_id, url):
+        """Sets the webhook a guild's announcements are sent through.
+
+        :param guild_id: int Discord guild ID
+        :param url: str webhook URL, '' to unset it
+        :return: None
+        """
+        self._update(guild_id, 'webhook', url)
+
+    def members(self, guild_id):
+        """Returns a guild's member list.
+
+        :param guild_id: int Discord guild ID
+        :return: list of str RSNs, sorted by name
+        """
+        with self._lock:
+            rows = self._connect().execute('SELECT rsn FROM members WHERE guild_id = ? ORDER BY rsn_key',
+                                           (guild_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def add_member(self, guild_id, rsn):
+        """Adds a player to a guild's member list.
+
+        :param guild_id: int Discord guild ID
+        :param rsn: str value of a player's OSRS username
+        :return: boolean, False if the player was already a member
+        @:raises ValueError if the guild's member list already has max_members players
+        """
+        with self._lock:
+            conn = self._connect()
+            if conn.execute('SELECT 1 FROM members WHERE guild_id = ? AND rsn_key = ?',
+                            (guild_id, rsn.lower())).fetchone() is not None:
+                return False
+            count, = conn.execute('SELECT COUNT(*) FROM members WHERE guild_id = ?', (guild_id,)).fetchone()
+            if count >= self.max_members:
+                raise ValueError(f'Member list is full ({self.max_members} members)')
+            conn.execute('INSERT INTO members VALUES (?, ?, ?)', (guild_id, rsn.lower(), rsn))
+            conn.commit()
+        return True
+
+    def remove_member(self, guild_id, rsn):
+        """Removes a player from a guild's member list.
+
+        :param guild_id: int Discord guild ID
+        :param rsn: str value of a player's OSRS username
+        :return: boolean, False if the player wasn't a member
+        """
+        with self._lock:
+            conn = self._connect()
+            removed = conn.execute('DELETE FROM members WHERE guild_id = ? AND rsn_key = ?',
+                                   (guild_id, rsn.lower())).rowcount
+            conn.commit()
+        return removed > 0
+
+    def members_by_player(self, guild_ids):
+        """Merges the member lists of several guilds.
+
+        :param guild_ids: Iterable of int Discord guild IDs
+        :return: dict mapping lower-cased RSNs to tuples (rsn, list of guild IDs they are a member of)
+        """
+        guild_ids = list(guild_ids)
+        if not guild_ids:
+            return {}
+        with self._lock:
+            rows = self._connect().execute(
+                f'SELECT rsn_key, rsn, guild_id FROM members WHERE guild_id IN ({",".join("?" * len(guild_ids))})',
+                guild_ids).fetchall()
+        players = {}
+        for key, rsn, guild_id in rows:
+            players.setdefault(key, (rsn, []))[1].append(guild_id)
+        return players
+
+    def close(self):
+        """Closes the database connection, it will be reopened on next use.
+
+        :return: None
+        """
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class Clan:
+    """The member list, leaderboards and webhook of one guild, or of the single guild
+    served in single guild mode.
+    """
+
+    def __init__(self, guild_id, registry, account_store, webhook=None):
+        """
+        :param guild_id: int Discord guild ID, or None for the single guild backed by MEMBER_LIST_NAME
+        :param registry: GuildRegistry holding the guild's member list
+        :param account_store: AccountTypeStore used to rank members by EHB
+        :param webhook: Optional WebhookHandler the guild's announcements are sent through
+        """
+        self.guild_id = guild_id
+        self.registry = registry
+        self.webhook = webhook
+        self.leaderboards = LeaderboardIndex(account_store, self.members())
+
+    def members(self):
+        """Returns the clan's member list.
+
+        :return: list of str RSNs
+        """
+        if self.guild_id is None:
+            return load_members()
+        return self.registry.members(self.guild_id)
+
+    def add_member(self, rsn):
+        """Adds a player to the clan's member list.
+
+        :param rsn: str value of a player's OSRS username
+        :return: boolean, False if the player was already a member
+        @:raises ValueError if the guild's member list is full
+        """
+        added = add_member(rsn) if self.guild_id is None else self.registry.add_member(self.guild_id, rsn)
+        if added:
+            self.leaderboards.set_members(self.members())
+        return added
+
+    def remove_member(self, rsn):
+        """Removes a player from the clan's member list.
+
+        :param rsn: str value of a player's OSRS username
+        :return: boolean, False if the player wasn't a member
+        """
+        removed = remove_member(rsn) if self.guild_id is None else self.registry.remove_member(self.guild_id, rsn)
+        if removed:
+            self.leaderboards.set_members(self.members())
+        return removed
+
+
+class ClanDirectory:
+    """Clans of every guild this process serves, created the first time each is used.
+    """
+
+    def __init__(self, registry, account_store, latest, default_webhook=None):
+        """
+        :param registry: GuildRegistry holding guilds' settings and member lists
+        :param account_store: AccountTypeStore used to rank members by EHB
+        :param latest: Callable taking an RSN and returning their last known main board HighscoreSnapshot
+        or None, used to warm new clans' leaderboards, e.g. HistoryStore.latest
+        :param default_webhook: WebhookHandler of the single guild served in single guild mode
+        """
+        self.registry = registry
+        self.account_store = account_store
+        self.latest = latest
+        self.default_webhook = default_webhook
+        self._clans = {}
+        self._webhooks = {}
+        self._tracked = {}
+        self._lock = threading.Lock()
+
+    def get(self, guild_id):
+        """Returns a guild's clan, creating it and warming its leaderboards if needed. Blocking,
+        so run it with executor.run_blocking.
+
+        :param guild_id: int Discord guild ID, or None in single guild mode
+        :return: Clan
+        """
+        with self._lock:
+            clan = self._clans.get(guild_id)
+            if clan is not None:
+                return clan
+        webhook = self.default_webhook if guild_id is None else self.webhook(guild_id)
+        clan = Clan(guild_id, self.registry, self.account_store, webhook)
+        clan.leaderboards.warm(self.latest)
+        with self._lock:
+            # Keep whichever clan was created first if two lookups raced
+            return self._clans.setdefault(guild_id, clan)
+
+    def webhook(self, guild_id):
+        """Returns a handler for a guild's webhook. Handlers are shared so posts reuse connections.
+
+        :param guild_id: int Discord guild ID
+        :return: WebhookHandler, or None if the guild hasn't set a webhook
+        """
+        url = self.registry.get(guild_id).webhook_url
+        if not url:
+            return None
+        with self._lock:
+            webhook = self._webhooks.get(url)
+            if webhook is None:
+                webhook = self._webhooks[url] = WebhookHandler(url)
+            return webhook
+
+    def set_webhook(self, guild_id, url):
+        """Sets a guild's webhook.
+
+        :param guild_id: int Discord guild ID
+        :param url: str webhook URL, '' to unset it
+        :return: None
+        @:raises ValueError if url isn't a Discord webhook URL
+        """
+        if url and not WEBHOOK_URL_PATTERN.fullmatch(url):
+            raise ValueError('Not a Discord webhook URL')
+        self.registry.set_webhook(guild_id, url)
+        with self._lock:
+            clan = self._clans.get(guild_id)
+        if clan is not None:
+            clan.webhook = self.webhook(guild_id)
+
+    def update(self, user):
+        """Re-ranks a player in every clan they are a member of. Suitable for use with
+        hs_wrapper.add_fetch_listener.
+
+        :param user: HighscoreSnapshot
+        :return: None
+        """
+        with self._lock:
+            clans = list(self._clans.values())
+        for clan in clans:
+            clan.leaderboards.update(user)
+
+    def tracked_members(self, guild_ids):
+        """Returns the members of every given guild, each player only once however many
+        clans they are in. Used as the tracker's member list.
+
+        :param guild_ids: Iterable of int Discord guild IDs, or [None] in single guild mode
+        :return: list of str RSNs
+        """
+        guild_ids = list(guild_ids)
+        if guild_ids == [None]:
+            tracked = {rsn.lower(): (rsn, [None]) for rsn in load_members()}
+        else:
+            tracked = self.registry.members_by_player(guild_ids)
+        self._tracked = tracked
+        return [rsn for rsn, _ in tracked.values()]
+
+    def webhooks_for(self, rsn):
+        """Returns the webhooks of every clan a tracked player is a member of, as of the last
+        call to tracked_members. Used to route the tracker's announcements.
+
+        :param rsn: str value of a player's OSRS username
+        :return: list of WebhookHandlers
+        """
+        _, guild_ids = self._tracked.get(rsn.lower(), (rsn, []))
+        webhooks = [self.default_webhook if guild_id is None else self.webhook(guild_id) for guild_id in guild_ids]
+        return [webhook for webhook in webhooks if webhook is not None]
+
+    def stats(self):
+        """Returns the number of clans loaded and members tracked.
+
+        :return: dict of counters
+        """
+        with self._lock:
+            return {'clans': len(self._clans),
+                    'webhooks': len(self._webhooks),
+                    'tracked': len(self._tracked),
+                    'members': sum(clan.leaderboards.stats()['members'] for clan in self._clans.values())}
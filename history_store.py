@@ -0,0 +1,366 @@
+"""history_store.py
+Persistent SQLite-backed history of players' highscores snapshots, used to answer
+!gains and !kc-gains without fetching anything.
+
+Every snapshot fetched from the main highscores board is recorded, unless nothing
+changed since the player's last recorded snapshot. Snapshots from the ironman boards
+are skipped, since those boards stop updating for players who de-iron and would be
+diffed against main board rows. Rows are keyed by (rsn, taken_at) so a player's
+snapshot at any point in time is a single indexed lookup. To keep the database small,
+snapshots are stored as compressed arrays and downsample() thins out old history:
+everything is kept for HISTORY_FULL_RESOLUTION seconds, then one snapshot per hour
+until HISTORY_HOURLY_UNTIL, then one per day until HISTORY_MAX_AGE.
+
+SnapshotStore persists the highscores lookup cache in the same compressed format,
+keeping only the latest snapshot per player and board.
+"""
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from config import *
+from hs_wrapper import *
+from logging_ import log_message
+
+"""Number of seconds in each unit accepted by parse_period
+"""
+PERIOD_UNITS = {'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60, 'm': 30 * 24 * 60 * 60}
+
+_PERIOD_PATTERN = re.compile(r'^(\d+)([hdwm])$')
+
+
+def parse_period(period):
+    """Parses a period such as '12h', '7d', '2w' or '1m' (30 days).
+
+    :param period: str period
+    :return: int number of seconds, or None if period isn't valid
+    """
+    match = _PERIOD_PATTERN.match(period.lower())
+    if match is None or int(match.group(1)) == 0:
+        return None
+    return int(match.group(1)) * PERIOD_UNITS[match.group(2)]
+
+
+def encode_snapshot(snapshot):
+    """Packs a snapshot's entries into a compressed blob.
+
+    :param snapshot: HighscoreSnapshot
+    :return: bytes
+    """
+    arrays = (snapshot.levels, snapshot.xp, snapshot.scores, snapshot.kc)
+    # The array lengths go first, so blobs stay readable if entries are added to the highscores
+    header = np.array([len(array) for array in arrays], dtype='<i8')
+    return zlib.compress(np.concatenate((header,) + arrays).astype('<i8').tobytes())
+
+
+def decode_snapshot(rsn, taken_at, blob, board='default'):
+    """Unpacks a blob written by encode_snapshot.
+
+    :param rsn: String of player's OSRS username.
+    :param taken_at: UNIX timestamp the snapshot was taken at
+    :param blob: bytes
+    :param board: String of the highscores board the snapshot was fetched from.
+    :return: HighscoreSnapshot
+    """
+    values = np.frombuffer(zlib.decompress(blob), dtype='<i8')
+    lengths = values[:4]
+    bounds = np.cumsum(np.concatenate(([4], lengths)))
+    levels, xp, scores, kc = (values[bounds[i]:bounds[i + 1]] for i in range(4))
+    return HighscoreSnapshot(rsn, board, levels, xp, scores, kc, fetched_at=taken_at)
+
+
+class HistoryStore:
+    """Time series of snapshots per lower-cased RSN. The database is only opened on first use.
+    """
+
+    def __init__(self, path=HISTORY_DB_NAME, full_resolution=HISTORY_FULL_RESOLUTION,
+                 hourly_until=HISTORY_HOURLY_UNTIL, max_age=HISTORY_MAX_AGE):
+        """
+        :param path: Path of the SQLite database file.
+        :param full_resolution: Number of seconds every recorded snapshot is kept for.
+        :param hourly_until: Age in seconds after which only one snapshot per day is kept.
+        :param max_age: Age in seconds after which snapshots are deleted, 0 to keep them forever.
+        """
+        self.path = path
+        self.full_resolution = full_resolution
+        self.hourly_until = hourly_until
+        self.max_age = max_age
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Opens the database, creating its table if needed. Must be called with self._lock held.
+
+        :return: sqlite3.Connection
+        """
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS snapshots ('
+                         'rsn TEXT NOT NULL, '
+                         'taken_at REAL NOT NULL, '
+                         'data BLOB NOT NULL, '
+                         'PRIMARY KEY (rsn, taken_at)) WITHOUT ROWID')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def record(self, snapshot):
+        """Records a snapshot, unless the player's entries haven't changed since their
+        last recorded snapshot or it was fetched from one of the ironman boards.
+        Suitable for use with hs_wrapper.add_fetch_listener.
+
+        :param snapshot: HighscoreSnapshot
+        :return: boolean, True if a new row was written
+        """
+        if snapshot.board != 'default':
+            return False
+        blob = encode_snapshot(snapshot)
+        rsn = snapshot.rsn.lower()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT data FROM snapshots WHERE rsn = ? ORDER BY taken_at DESC LIMIT 1',
+                               (rsn,)).fetchone()
+            if row is not None and row[0] == blob:
+                return False
+            conn.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)', (rsn, snapshot.fetched_at, blob))
+            conn.commit()
+        return True
+
+    def _query_one(self, sql, args):
+        with self._lock:
+            row = self._connect().execute(sql, args).fetchone()
+        if row is None:
+            return None
+        return decode_snapshot(*row)
+
+    def latest(self, rsn):
+        """Returns a player's most recently recorded snapshot.
+
+        :param rsn: String of player's OSRS username.
+        :return: HighscoreSnapshot, or None if nothing is recorded for the player
+        """
+        return self._query_one('SELECT rsn, taken_at, data FROM snapshots WHERE rsn = ? '
+                               'ORDER BY taken_at DESC LIMIT 1', (rsn.lower(),))
+
+    def at(self, rsn, timestamp):
+        """Returns a player's snapshot as of a point in time: the last one recorded at or
+        before timestamp, or failing that the first one recorded after it.
+
+        :param rsn: String of player's OSRS username.
+        :param timestamp: UNIX timestamp
+        :return: HighscoreSnapshot, or None if nothing is recorded for the player
+        """
+        snapshot = self._query_one('SELECT rsn, taken_at, data FROM snapshots WHERE rsn = ? AND taken_at <= ? '
+                                   'ORDER BY taken_at DESC LIMIT 1', (rsn.lower(), timestamp))
+        if snapshot is None:
+            snapshot = self._query_one('SELECT rsn, taken_at, data FROM snapshots WHERE rsn = ? AND taken_at > ? '
+                                       'ORDER BY taken_at ASC LIMIT 1', (rsn.lower(), timestamp))
+        return snapshot
+
+    def gains(self, rsn, period):
+        """Returns the snapshots at the start and end of a player's most recent period.
+
+        :param rsn: String of player's OSRS username.
+        :param period: Number of seconds to look back from now
+        :return: tuple (start, end) of HighscoreSnapshots, or None if nothing is recorded for the player
+        """
+        end = self.latest(rsn)
+        if end is None:
+            return None
+        return self.at(rsn, time.time() - period), end
+
+    def downsample(self, now=None):
+        """Thins out old snapshots, keeping the latest snapshot in each hour once they are
+        older than full_resolution, and in each day once they are older than hourly_until.
+        Snapshots older than max_age are deleted.
+
+        :param now: Optional UNIX timestamp to measure ages from, defaults to now
+        :return: int number of snapshots deleted
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute('SELECT rsn, taken_at FROM snapshots WHERE taken_at < ? ORDER BY rsn, taken_at',
+                                (now - self.full_resolution,)).fetchall()
+            doomed = []
+            kept = {}
+            for rsn, taken_at in rows:
+                age = now - taken_at
+                if self.max_age and age >= self.max_age:
+                    doomed.append((rsn, taken_at))
+                    continue
+                bucket_size = PERIOD_UNITS['h'] if age < self.hourly_until else PERIOD_UNITS['d']
+                key = (rsn, bucket_size, int(taken_at // bucket_size))
+                # Rows are in time order, so a later row in the same bucket replaces the earlier one
+                if key in kept:
+                    doomed.append((rsn, kept[key]))
+                kept[key] = taken_at
+            conn.executemany('DELETE FROM snapshots WHERE rsn = ? AND taken_at = ?', doomed)
+            conn.commit()
+        if doomed:
+            log_message(f'Downsampled snapshot history, deleted {len(doomed)} snapshots')
+        return len(doomed)
+
+    def close(self):
+        """Closes the database connection, it will be reopened on next use.
+
+        :return: None
+        """
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class SnapshotStore:
+    """Latest snapshot per lower-cased RSN and board, used as the persistent layer of
+    hs_wrapper.SnapshotCache so cached lookups survive restarts. The database is only
+    opened on first use, and snapshots are only read back when they are looked up.
+    """
+
+    def __init__(self, path=HS_CACHE_DB_NAME, max_age=HS_CACHE_DEGRADED_TTL):
+        """
+        :param path: Path of the SQLite database file.
+        :param max_age: Age in seconds after which snapshots are no longer loaded, and are deleted by prune().
+        """
+        self.path = path
+        self.max_age = max_age
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Opens the database, creating its table if needed. Must be called with self._lock held.
+
+        :return: sqlite3.Connection
+        """
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS latest ('
+                         'rsn TEXT NOT NULL, '
+                         'board TEXT NOT NULL, '
+                         'fetched_at REAL NOT NULL, '
+                         'data BLOB NOT NULL, '
+                         'PRIMARY KEY (rsn, board)) WITHOUT ROWID')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def load(self, rsn, board):
+        """Returns the latest snapshot saved for a player on a board.
+
+        :param rsn: String of player's OSRS username.
+        :param board: String of the highscores board.
+        :return: HighscoreSnapshot, or None if none was saved within max_age
+        """
+        with self._lock:
+            row = self._connect().execute('SELECT fetched_at, data FROM latest WHERE rsn = ? AND board = ? '
+                                          'AND fetched_at >= ?',
+                                          (rsn.lower(), board, time.time() - self.max_age)).fetchone()
+        if row is None:
+            return None
+        return decode_snapshot(rsn, row[0], row[1], board)
+
+    def save(self, snapshot):
+        """Saves a snapshot, replacing the one saved for the same player and board.
+
+        :param snapshot: HighscoreSnapshot
+        :return: None
+        """
+        blob = encode_snapshot(snapshot)
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT OR REPLACE INTO latest VALUES (?, ?, ?, ?)',
+                         (snapshot.rsn.lower(), snapshot.board, snapshot.fetched_at, blob))
+            conn.commit()
+
+    def delete(self, rsn, board=None):
+        """Deletes the snapshots saved for a player.
+
+        :param rsn: String of player's OSRS username.
+        :param board: Board to delete the snapshot for, or None to delete it for all boards.
+        :return: None
+        """
+        with self._lock:
+            conn = self._connect()
+            if board is None:
+                conn.execute('DELETE FROM latest WHERE rsn = ?', (rsn.lower(),))
+            else:
+                conn.execute('DELETE FROM latest WHERE rsn = ? AND board = ?', (rsn.lower(), board))
+            conn.commit()
+
+    def prune(self, now=None):
+        """Deletes snapshots older than max_age.
+
+        :param now: Optional UNIX timestamp to measure ages from, defaults to now
+        :return: int number of snapshots deleted
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            conn = self._connect()
+            deleted = conn.execute('DELETE FROM latest WHERE fetched_at < ?', (now - self.max_age,)).rowcount
+            conn.commit()
+        return deleted
+
+    def close(self):
+        """Closes the database connection, it will be reopened on next use.
+
+        :return: None
+        """
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def render_gains(rsn, start, end, period):
+    """Renders a player's XP and level gains between two snapshots.
+
+    :param rsn: str value of a player's OSRS username
+    :param start: HighscoreSnapshot at the start of the period
+    :param end: HighscoreSnapshot at the end of the period
+    :param period: str period as given by the user, e.g. '7d'
+    :return: str report
+    """
+    lines = [f'{rsn}\'s gains over {period} (tracked over {format_age(end.fetched_at - start.fetched_at)}, '
+             f'last updated {format_age(time.time() - end.fetched_at)} ago):\n'
+             '---------------------------------------------------\n']
+    # Skills that weren't listed at the start count from 0 XP
+    xp_gained = end.xp - np.maximum(start.xp, 0)
+    levels_gained = end.levels - np.maximum(start.levels, 1)
+    gained = np.flatnonzero((end.xp >= 0) & (xp_gained > 0))
+    if len(gained) == 0:
+        lines.append('No XP gained\n')
+    for i in gained:
+        lines.append(f'{FORMATTED_SKILLS[i]:<15}: {int(xp_gained[i]):>+12,} XP {int(levels_gained[i]):>+4} levels\n')
+
+    kc_gained = end.kc - np.maximum(start.kc, 0)
+    bosses = np.flatnonzero((end.kc >= 0) & (kc_gained > 0))
+    if len(bosses) > 0:
+        lines.append('\nBoss KC:\n'
+                     '---------------------------------------------------\n')
+    for i in bosses:
+        lines.append(f'{FORMATTED_BOSSES[i]:<34}: {int(kc_gained[i]):>+7} KC\n')
+    return ''.join(lines)
+
+
+def render_kc_gains(rsn, boss, start, end, period):
+    """Renders a player's kill count gained at one boss between two snapshots.
+
+    :param rsn: str value of a player's OSRS username
+    :param boss: str boss name, as listed in BOSSES
+    :param start: HighscoreSnapshot at the start of the period
+    :param end: HighscoreSnapshot at the end of the period
+    :param period: str period as given by the user, e.g. '30d'
+    :return: str report
+    """
+    i = BOSS_INDEX[boss]
+    start_kc = max(int(start.kc[i]), 0)
+    end_kc = max(int(end.kc[i]), 0)
+    return (f'{rsn} has gained {end_kc - start_kc} {FORMATTED_BOSSES[i]} KC over {period} '
+            f'({start_kc} -> {end_kc} KC, tracked over {format_age(end.fetched_at - start.fetched_at)}).\n')
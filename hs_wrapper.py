@@ -8,7 +8,27 @@ Wrapper file adapted from my project Gold Partyhat: https://github.com/cdfisher/
 updated with specific features for this project.
 """
 
-from osrs_highscores import Highscores
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import *
+from logging_ import log_message
+from metrics import metrics
+from rate_limiter import (RateLimiter, UpstreamError, RetryLater, is_retryable, request_priority, requeue_attempt,
+                          INTERACTIVE, BACKGROUND)
+
+try:
+    from osrs_highscores import Highscores
+except ImportError:
+    # Only needed by the 'osrs_highscores' backend
+    Highscores = None
 
 """List of all valid skills listed on highscores
 """
@@ -67,49 +87,640 @@ FORMATTED_BOSSES = ['Abyssal Sire', 'Alchemical Hydra', 'Artio', 'Barrows Chests
                     'Wintertodt', 'Zalcano', 'Zulrah']
 
 
-def get_user(rsn):
-    """Fetches a given user's highscores entries.
+"""Formatted name of every entry in SKILLS, ACTIVITIES and BOSSES
+"""
+FORMATTED_ENTRIES = dict(zip(SKILLS + ACTIVITIES + BOSSES, FORMATTED_SKILLS + FORMATTED_ACTIVITIES + FORMATTED_BOSSES))
+
+"""Lookups of each entry's position in SKILLS, ACTIVITIES and BOSSES
+"""
+SKILL_INDEX = {skill: i for i, skill in enumerate(SKILLS)}
+ACTIVITY_INDEX = {activity: i for i, activity in enumerate(ACTIVITIES)}
+BOSS_INDEX = {boss: i for i, boss in enumerate(BOSSES)}
+
+
+class HighscoreSnapshot:
+    """Compact copy of a player's highscores entries, built once per fetch.
+
+    Levels and XP are held in int arrays index matched with SKILLS, activity scores
+    with ACTIVITIES and boss KC with BOSSES. Entries a player isn't listed for are -1.
+    """
+    __slots__ = ('rsn', 'board', 'fetched_at', 'levels', 'xp', 'scores', 'kc')
+
+    def __init__(self, rsn, board, levels, xp, scores, kc, fetched_at=None):
+        """
+        :param rsn: String of player's OSRS username.
+        :param board: String of the highscores board the entries were fetched from.
+        :param levels: Sequence of ints index matched with SKILLS
+        :param xp: Sequence of ints index matched with SKILLS
+        :param scores: Sequence of ints index matched with ACTIVITIES
+        :param kc: Sequence of ints index matched with BOSSES
+        :param fetched_at: Optional UNIX timestamp of the fetch, defaults to now.
+        """
+        self.rsn = rsn
+        self.board = board
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+        self.levels = np.asarray(levels, dtype=np.int64)
+        self.xp = np.asarray(xp, dtype=np.int64)
+        self.scores = np.asarray(scores, dtype=np.int64)
+        self.kc = np.asarray(kc, dtype=np.int64)
+
+    @classmethod
+    def from_highscores(cls, user, rsn, board='default'):
+        """Builds a snapshot from an osrs_highscores Highscores object.
+
+        :param user: Highscores object for player
+        :param rsn: String of player's OSRS username.
+        :param board: String of the highscores board user was fetched from.
+        :return: HighscoreSnapshot
+        """
+        skills = [getattr(user, skill) for skill in SKILLS]
+        return cls(rsn, board,
+                   [int(entry.level) for entry in skills],
+                   [int(entry.xp) for entry in skills],
+                   [int(getattr(user, activity).score) for activity in ACTIVITIES],
+                   [int(getattr(user, boss).kills) for boss in BOSSES])
+
+    @classmethod
+    def from_csv(cls, text, rsn, board='default'):
+        """Builds a snapshot from the OSRS Highscores' index_lite CSV, one line per entry in
+        the order SKILLS, ACTIVITIES, BOSSES. Skill lines are 'rank,level,xp', all other
+        lines are 'rank,score'.
+
+        :param text: str CSV body
+        :param rsn: String of player's OSRS username.
+        :param board: String of the highscores board the CSV was fetched from.
+        :return: HighscoreSnapshot
+        @:raises ValueError if text has fewer lines than there are entries
+        """
+        rows = [line.split(',') for line in text.split('\n') if line]
+        if len(rows) < len(SKILLS) + len(ACTIVITIES) + len(BOSSES):
+            raise ValueError('No data loaded!')
+        skills = rows[:len(SKILLS)]
+        scores = rows[len(SKILLS):len(SKILLS) + len(ACTIVITIES)]
+        kc = rows[len(SKILLS) + len(ACTIVITIES):len(SKILLS) + len(ACTIVITIES) + len(BOSSES)]
+        return cls(rsn, board,
+                   [int(row[1]) for row in skills],
+                   [int(row[2]) for row in skills],
+                   [int(row[1]) for row in scores],
+                   [int(row[1]) for row in kc])
+
+    def to_csv(self):
+        """Converts the snapshot back to index_lite CSV, the inverse of from_csv().
+        Ranks aren't kept, so listed entries get rank 1 and unlisted entries rank -1.
+
+        :return: str CSV body
+        """
+        lines = [f'{1 if xp >= 0 else -1},{level},{xp}' for level, xp in zip(self.levels, self.xp)]
+        lines += [f'{1 if value >= 0 else -1},{value}' for value in np.concatenate((self.scores, self.kc))]
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        """Converts the snapshot to plain lists, e.g. for saving as JSON.
+
+        :return: dict with keys rsn, board, fetched_at, levels, xp, scores and kc
+        """
+        return {'rsn': self.rsn,
+                'board': self.board,
+                'fetched_at': self.fetched_at,
+                'levels': self.levels.tolist(),
+                'xp': self.xp.tolist(),
+                'scores': self.scores.tolist(),
+                'kc': self.kc.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Builds a snapshot from a dict as returned by to_dict().
+
+        :param data: dict of snapshot fields
+        :return: HighscoreSnapshot
+        """
+        return cls(data['rsn'], data['board'], data['levels'], data['xp'], data['scores'], data['kc'],
+                   fetched_at=data.get('fetched_at'))
+
+
+class SnapshotCache:
+    """Thread-safe cache of highscores lookups keyed by (rsn, board).
+
+    Entries are fresh for ttl seconds after they were fetched, and once more than
+    max_entries are held the least recently used entry is evicted. Concurrent misses
+    on the same key share one fetch rather than each making their own request.
+
+    For a further stale_ttl seconds an expired entry is still returned at once to
+    interactive lookups, while it is refreshed in the background on a pool of at most
+    refresh_workers threads. Batch and background lookups, such as group commands and the
+    tracker, wait for a fresh fetch instead, since they diff or rank what they get. If a fetch fails because the highscores are
+    unreachable, entries up to degraded_ttl seconds old are returned instead of the
+    error. Callers can tell how old a returned snapshot is from its fetched_at.
+
+    If a store is given, every fetched snapshot is also saved to it, and keys that
+    aren't held in memory or have expired are looked up in it before being fetched.
+    This way the cache survives restarts, and processes sharing a store share fetches.
+    """
+
+    def __init__(self, fetch, ttl=HS_CACHE_TTL, max_entries=HS_CACHE_SIZE, stale_ttl=HS_CACHE_STALE_TTL,
+                 degraded_ttl=HS_CACHE_DEGRADED_TTL, store=None, refresh_workers=HS_MAX_WORKERS):
+        """
+        :param fetch: Callable taking (rsn, board) which fetches a fresh HighscoreSnapshot.
+        :param ttl: Number of seconds a cached lookup stays valid for.
+        :param max_entries: Maximum number of lookups to hold at once.
+        :param stale_ttl: Number of seconds past ttl an expired lookup is returned for while it is refreshed.
+        :param degraded_ttl: Maximum age in seconds of a lookup returned while the highscores are unreachable.
+        :param store: Optional persistent store with load(rsn, board), save(snapshot) and
+        delete(rsn, board=None) methods, e.g. history_store.SnapshotStore
+        :param refresh_workers: Maximum number of background refreshes that may run at once
+        """
+        self._fetch = fetch
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self.degraded_ttl = degraded_ttl
+        self.store = store
+        self.refresh_workers = refresh_workers
+        self._refresh_pool = None
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale_hits = 0
+        self.store_hits = 0
+        self.refreshes = 0
+        self.degraded = 0
+
+    def _lookup(self, key):
+        """Returns the entry held for a key. Keys that aren't held in memory, or have expired,
+        are looked up in the store, since another process sharing it may have fetched them.
+
+        :param key: tuple (lower-cased rsn, board)
+        :return: HighscoreSnapshot, or None if nothing is cached for key
+        """
+        with self._lock:
+            user = self._entries.get(key)
+            if user is not None:
+                self._entries.move_to_end(key)
+        if self.store is None or (user is not None and time.time() - user.fetched_at < self.ttl):
+            return user
+
+        stored = self.store.load(*key)
+        if stored is None or (user is not None and stored.fetched_at <= user.fetched_at):
+            return user
+        with self._lock:
+            self.store_hits += 1
+            # Another thread may have fetched the key while the store was read
+            current = self._entries.get(key)
+            if current is None or current.fetched_at < stored.fetched_at:
+                self._insert(key, stored)
+            return self._entries[key]
+
+    def _insert(self, key, user):
+        """Holds an entry in memory, evicting the least recently used entries if needed.
+        Must be called with self._lock held.
+
+        :param key: tuple (lower-cased rsn, board)
+        :param user: HighscoreSnapshot
+        :return: None
+        """
+        self._entries[key] = user
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _complete(self, key, future, user=None, err=None):
+        """Finishes a fetch, caching its snapshot or dropping the key if the player
+        wasn't found, and passes its result on to anyone waiting on it.
+
+        :param key: tuple (lower-cased rsn, board)
+        :param future: Future other lookups of key are waiting on
+        :param user: HighscoreSnapshot if the fetch succeeded
+        :param err: Exception raised by the fetch if it failed
+        :return: None
+        """
+        with self._lock:
+            del self._in_flight[key]
+            if user is not None:
+                self._insert(key, user)
+            elif isinstance(err, ValueError):
+                self._entries.pop(key, None)
+        if self.store is not None:
+            if user is not None:
+                self.store.save(user)
+            elif isinstance(err, ValueError):
+                self.store.delete(*key)
+        if err is None:
+            future.set_result(user)
+        else:
+            future.set_exception(err)
+
+    def _revalidate(self, rsn, board, key):
+        """Refreshes an entry on the refresh pool, unless it is already being fetched.
+
+        :param rsn: String of player's OSRS username.
+        :param board: String of the highscores board to look the player up on.
+        :param key: tuple (lower-cased rsn, board)
+        :return: None
+        """
+        with self._lock:
+            if key in self._in_flight:
+                return
+            future = Future()
+            self._in_flight[key] = future
+            self.refreshes += 1
+            if self._refresh_pool is None:
+                self._refresh_pool = ThreadPoolExecutor(max_workers=self.refresh_workers,
+                                                        thread_name_prefix='hs-refresh')
+
+        def refresh():
+            # Refreshes go behind lookups that someone is waiting on. Each runs in a fresh
+            # context, so the priority doesn't leak into the pool thread's next refresh
+            request_priority.set(BACKGROUND)
+            try:
+                user = self._fetch(rsn, board)
+            except Exception as err:
+                log_message(f'Background refresh of {rsn} on {board} failed: {err!r}')
+                self._complete(key, future, err=err)
+                return
+            self._complete(key, future, user=user)
+
+        self._refresh_pool.submit(contextvars.Context().run, refresh)
+
+    def get(self, rsn, board='default'):
+        """Returns a lookup for the given player and board, fetching it if it is not cached.
+
+        :param rsn: String of player's OSRS username.
+        :param board: String of the highscores board to look the player up on.
+        :return: HighscoreSnapshot for given user.
+        @:raises ValueError if player is not found on the given board
+        """
+        key = (rsn.lower(), board)
+        cached = self._lookup(key)
+        age = time.time() - cached.fetched_at if cached is not None else None
+        if cached is not None and age < self.ttl:
+            with self._lock:
+                self.hits += 1
+            return cached
+        # Batch and background callers diff or rank what they get, so they wait for fresh data
+        if cached is not None and age < self.ttl + self.stale_ttl and request_priority.get() == INTERACTIVE:
+            with self._lock:
+                self.stale_hits += 1
+            self._revalidate(rsn, board, key)
+            return cached
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            try:
+                return future.result()
+            except RetryLater:
+                # The fetch was re-queued by its owner, callers that can't re-queue fetch it themselves
+                if requeue_attempt.get() is not None:
+                    raise
+                return self.get(rsn, board)
+
+        # This thread makes the fetch, everyone else waits on its result
+        try:
+            user = self._fetch(rsn, board)
+        except BaseException as err:
+            if cached is not None and age < self.degraded_ttl and is_retryable(err):
+                # The highscores are unreachable, so an old answer beats no answer
+                with self._lock:
+                    self.degraded += 1
+                self._complete(key, future, user=cached)
+                return cached
+            self._complete(key, future, err=err)
+            raise
+        self._complete(key, future, user=user)
+        return user
+
+    def invalidate(self, rsn, board=None):
+        """Drops cached lookups for a player, including any persisted in the store.
+
+        :param rsn: String of player's OSRS username.
+        :param board: Board to drop the lookup for, or None to drop it for all boards.
+        :return: None
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == rsn.lower() and (board is None or key[1] == board):
+                    del self._entries[key]
+        if self.store is not None:
+            self.store.delete(rsn.lower(), board)
+
+    def clear(self):
+        """Drops all cached lookups held in memory.
+
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the cache's hit/miss counters.
+
+        :return: dict of counters and the current number of cached lookups.
+        """
+        with self._lock:
+            answered = self.hits + self.stale_hits + self.coalesced
+            lookups = answered + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'coalesced': self.coalesced,
+                    'stale_hits': self.stale_hits,
+                    'store_hits': self.store_hits,
+                    'refreshes': self.refreshes,
+                    'degraded': self.degraded,
+                    'size': len(self._entries),
+                    'hit_ratio': answered / lookups if lookups else 0.0}
+
+
+"""Path segment of each highscores board in index_lite URLs
+"""
+BOARD_PATHS = {'default': 'hiscore_oldschool',
+               'ironman': 'hiscore_oldschool_ironman',
+               'hardcore_ironman': 'hiscore_oldschool_hardcore_ironman',
+               'ultimate': 'hiscore_oldschool_ultimate'}
+
+
+class CsvBackend:
+    """Fetches players' index_lite CSV straight from the highscores over one shared session,
+    so connections are kept alive and reused across lookups and threads.
+    """
+
+    def __init__(self, base_url=HS_BASE_URL, timeout=HS_REQUEST_TIMEOUT, pool_size=HS_MAX_WORKERS * 4):
+        """
+        :param base_url: str URL the highscores are served from, e.g. a local stub server for testing
+        :param timeout: Seconds to wait on a response
+        :param pool_size: Maximum number of connections kept open, enough for every lookup
+        get_game_mode may have in flight
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def fetch(self, rsn, board):
+        """Fetches one player's entries on one board.
+
+        :param rsn: String of player's OSRS username.
+        :param board: String of the highscores board to look the player up on.
+        :return: HighscoreSnapshot
+        @:raises ValueError if the player is not on the board, UpstreamError on 429 or 5xx responses
+        """
+        response = self._session.get(f'{self.base_url}/m={BOARD_PATHS[board]}/index_lite.ws',
+                                     params={'player': rsn}, timeout=self.timeout)
+        if response.status_code == 404:
+            raise ValueError(f'{rsn} not found on {board}')
+        if response.status_code == 429 or response.status_code >= 500:
+            retry_after = response.headers.get('Retry-After')
+            raise UpstreamError(response.status_code, float(retry_after) if retry_after else None)
+        response.raise_for_status()
+        return HighscoreSnapshot.from_csv(response.text, rsn, board)
+
+    def close(self):
+        """Closes the session's pooled connections.
+
+        :return: None
+        """
+        self._session.close()
+
+
+class LibraryBackend:
+    """Fetches players through the osrs-highscores package, kept as a fallback for CsvBackend.
+    """
+
+    def __init__(self):
+        if Highscores is None:
+            raise RuntimeError('The osrs_highscores backend needs the osrs-highscores package installed')
+
+    def fetch(self, rsn, board):
+        """Fetches one player's entries on one board.
+
+        :param rsn: String of player's OSRS username.
+        :param board: String of the highscores board to look the player up on.
+        :return: HighscoreSnapshot
+        @:raises ValueError if the player is not on the board
+        """
+        return HighscoreSnapshot.from_highscores(Highscores(rsn, target=board), rsn, board)
+
+    def close(self):
+        pass
+
+
+"""Backends selectable with HS_BACKEND
+"""
+BACKENDS = {'csv': CsvBackend, 'osrs_highscores': LibraryBackend}
+
+"""Backend that all requests to the OSRS Highscores are made through, see set_backend
+"""
+hs_backend = BACKENDS[HS_BACKEND]()
+
+
+def set_backend(backend):
+    """Makes all further highscores requests through a different backend.
+
+    :param backend: Object with fetch(rsn, board) and close() methods, e.g. a CsvBackend
+    pointed at a stub server
+    :return: The previous backend
+    """
+    global hs_backend
+    previous, hs_backend = hs_backend, backend
+    return previous
+
+
+"""Limiter that all requests to the OSRS Highscores go through
+"""
+hs_limiter = RateLimiter(HS_RATE_LIMIT, HS_RATE_BURST, max_retries=HS_MAX_RETRIES,
+                         base_delay=HS_RETRY_BASE_DELAY, max_delay=HS_RETRY_MAX_DELAY)
+
+
+"""Callables run with every snapshot freshly fetched from the highscores, see add_fetch_listener
+"""
+_fetch_listeners = []
+
+
+def add_fetch_listener(func):
+    """Registers a callable to be run with every snapshot fetched from the highscores,
+    e.g. to record it. Cached lookups don't trigger it.
+
+    :param func: Callable taking a HighscoreSnapshot
+    :return: func
+    """
+    _fetch_listeners.append(func)
+    return func
+
+
+def _fetch_user(rsn, board):
+    """Fetches a user's highscores entries directly from the OSRS Highscores, through hs_backend.
 
     :param rsn: String of player's OSRS username.
-    :return: Highscores object for given user.
+    :param board: String of the highscores board to look the player up on.
+    :return: HighscoreSnapshot for given user.
     """
-    return Highscores(rsn)
+    start = time.perf_counter()
+    result = 'error'
+    try:
+        snapshot = hs_limiter.call(hs_backend.fetch, rsn, board)
+        result = 'ok'
+    except ValueError:
+        result = 'not_found'
+        raise
+    finally:
+        metrics.observe('hs_fetch_seconds', time.perf_counter() - start, board=board)
+        metrics.inc('hs_fetch_total', board=board, result=result)
+    for listener in _fetch_listeners:
+        try:
+            listener(snapshot)
+        except Exception as err:
+            # A failing listener shouldn't fail the lookup itself
+            metrics.inc('hs_fetch_listener_errors_total')
+            log_message(f'Fetch listener {listener!r} failed: {err!r}')
+    return snapshot
+
+
+"""Shared cache that all highscores lookups are read through
+"""
+snapshot_cache = SnapshotCache(_fetch_user)
+
+
+def get_user(rsn, board='default'):
+    """Fetches a given user's highscores entries, reading through snapshot_cache.
+
+    :param rsn: String of player's OSRS username.
+    :param board: String of the highscores board to look the player up on ('default'
+    for the main board, 'ironman', 'hardcore_ironman' or 'ultimate')
+    :return: HighscoreSnapshot for given user.
+    @:raises ValueError if player is not found on the given board
+    """
+    return snapshot_cache.get(rsn, board)
+
+
+def format_age(seconds):
+    """Formats a number of seconds as a rough age, e.g. '3d 4h'.
+
+    :param seconds: Number of seconds
+    :return: str
+    """
+    days, hours = divmod(int(seconds // 3600), 24)
+    return f'{days}d {hours}h' if days else f'{hours}h {int(seconds % 3600 // 60)}m'
+
 
+def staleness_note(user):
+    """Returns a note for reports built from a snapshot that has outlived the cache TTL,
+    i.e. one served while it is refreshed or while the highscores are unreachable.
 
-# TODO Wrap all of these query methods into one query_entry(user, target, attr='default') method
-def query_skill_xp(user: Highscores, skill: str) -> int:
+    :param user: HighscoreSnapshot for player (as returned by get_user())
+    :return: str note ending in a newline, or '' if the snapshot is fresh
+    """
+    age = time.time() - user.fetched_at
+    if not snapshot_cache.ttl or age < snapshot_cache.ttl:
+        return ''
+    return f'(Highscores data from {format_age(age)} ago)\n'
+
+
+def cache_stats():
+    """Returns hit/miss counters for snapshot_cache.
+
+    :return: dict of cache counters
+    """
+    return snapshot_cache.stats()
+
+
+def limiter_stats():
+    """Returns queue depth, wait time and retry counters for hs_limiter.
+
+    :return: dict of limiter counters
+    """
+    return hs_limiter.stats()
+
+
+metrics.register_gauges('hs_cache', cache_stats)
+metrics.register_gauges('hs_limiter', limiter_stats)
+
+
+"""Attribute returned by query_entry for each kind of entry when attr is 'default'
+"""
+DEFAULT_ATTRS = {'skill': 'xp', 'activity': 'score', 'boss': 'kills'}
+
+
+def entry_kind(target):
+    """Returns which kind of highscores entry target is.
+
+    :param target: String name of an entry
+    :return: 'skill', 'activity' or 'boss', or None if target is not a valid entry
+    """
+    if target in SKILL_INDEX:
+        return 'skill'
+    elif target in ACTIVITY_INDEX:
+        return 'activity'
+    elif target in BOSS_INDEX:
+        return 'boss'
+    return None
+
+
+def query_entry(user: HighscoreSnapshot, target: str, attr='default') -> int:
+    """ Queries any entry listed on user's highscores page.
+
+    :param user: HighscoreSnapshot for player (as returned by get_user())
+    :param target: String specifying the entry to query, valid values are listed in
+    SKILLS, ACTIVITIES and BOSSES
+    :param attr: String specifying which value to return. 'level' or 'xp' for skills,
+    'score' for activities and 'kills' for bosses. 'default' returns XP for skills,
+    score for activities and kills for bosses.
+    :return: int of player's value for given entry.
+    @:raises AttributeError if target or attr is not valid
+    """
+    kind = entry_kind(target)
+    if kind is None:
+        print(f'Entry {target} not found!\n')
+        raise AttributeError(target)
+    i = {'skill': SKILL_INDEX, 'activity': ACTIVITY_INDEX, 'boss': BOSS_INDEX}[kind][target]
+
+    if attr == 'default':
+        attr = DEFAULT_ATTRS[kind]
+
+    if kind == 'skill' and attr == 'level':
+        return int(user.levels[i])
+    elif kind == 'skill' and attr == 'xp':
+        return int(user.xp[i])
+    elif kind == 'activity' and attr == 'score':
+        return int(user.scores[i])
+    elif kind == 'boss' and attr == 'kills':
+        return int(user.kc[i])
+    print(f'Attribute {attr} not valid for {target}!\n')
+    raise AttributeError(attr)
+
+
+def query_skill_xp(user: HighscoreSnapshot, skill: str) -> int:
     """ Queries XP listed on user's highscores page.
     :param user: User object for player (as returned by get_user())
     :param skill: String specifying the skill to query (Typically set as SKILL
     in gph_config.py)
     :return: int of player's XP in given skill.
     """
-    try:
-        skill_entry = user.__getattribute__(skill)
-    except AttributeError:
-        print(f'Skill {skill} not found!\n')
-        raise
-    else:
-        return int(skill_entry.xp)
+    return query_entry(user, skill, 'xp')
 
 
-def query_skill_level(user: Highscores, skill: str) -> int:
-    """ Queries XP listed on user's highscores page.
+def query_skill_level(user: HighscoreSnapshot, skill: str) -> int:
+    """ Queries level listed on user's highscores page.
     :param user: User object for player (as returned by get_user())
     :param skill: String specifying the skill to query (Typically set as SKILL
     in gph_config.py)
-    :return: int of player's XP in given skill.
+    :return: int of player's level in given skill.
     """
-    try:
-        skill_entry = user.__getattribute__(skill)
-    except AttributeError:
-        print(f'Skill {skill} not found!\n')
-        raise
-    else:
-        return int(skill_entry.level)
+    return query_entry(user, skill, 'level')
 
 
-def query_activity_score(user: Highscores, activity: str) -> int:
+def query_activity_score(user: HighscoreSnapshot, activity: str) -> int:
     """ Queries activity scores listed on user's highscores page.
 
         :param user: User object for player (as returned by get_user())
@@ -117,16 +728,10 @@ def query_activity_score(user: Highscores, activity: str) -> int:
         are listed in ACTIVITIES)
         :return: int of player's score in given activity.
         """
-    try:
-        activity_entry = user.__getattribute__(activity)
-    except AttributeError:
-        print(f'Activity {activity} not found!\n')
-        raise
-    else:
-        return int(activity_entry.score)
+    return query_entry(user, activity, 'score')
 
 
-def query_boss_kc(user: Highscores, boss: str) -> int:
+def query_boss_kc(user: HighscoreSnapshot, boss: str) -> int:
     """ Queries KC listed on user's highscores page.
 
     :param user: User object for player (as returned by get_user())
@@ -134,13 +739,7 @@ def query_boss_kc(user: Highscores, boss: str) -> int:
     in gph_config.py)
     :return: int of player's KC for given boss.
     """
-    try:
-        boss_entry = user.__getattribute__(boss)
-    except AttributeError:
-        print(f'Boss {boss} not found!\n')
-        raise
-    else:
-        return int(boss_entry.kills)
+    return query_entry(user, boss, 'kills')
 
 
 def fetch_all_skills(rsn, user):
@@ -153,7 +752,7 @@ def fetch_all_skills(rsn, user):
 
     msg = '{}\'s XP: \n'.format(rsn)
     for i in range(len(SKILLS)):
-        msg += '{} : {} XP\n'.format(SKILLS[i], query_skill_xp(user, SKILLS[i]))
+        msg += '{} : {} XP\n'.format(SKILLS[i], user.xp[i])
     return msg
 
 
@@ -167,7 +766,7 @@ def fetch_all_activities(rsn, user):
 
     msg = '{}\'s activity scores: \n'.format(rsn)
     for i in range(len(ACTIVITIES)):
-        msg += '{} : {} \n'.format(ACTIVITIES[i], query_activity_score(user, ACTIVITIES[i]))
+        msg += '{} : {} \n'.format(ACTIVITIES[i], user.scores[i])
     return msg
 
 
@@ -181,5 +780,5 @@ def fetch_all_bosses(rsn, user):
 
     msg = '{}\'s boss KC: \n'.format(rsn)
     for i in range(len(BOSSES)):
-        msg += '{} : {} KC\n'.format(BOSSES[i], query_boss_kc(user, BOSSES[i]))
+        msg += '{} : {} KC\n'.format(BOSSES[i], user.kc[i])
     return msg
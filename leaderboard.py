@@ -0,0 +1,254 @@
+"""leaderboard.py
+In-memory clan leaderboards for every highscores entry, plus EHB.
+
+Each leaderboard is a sorted list kept in order with bisect, so when a member's
+snapshot is fetched only that member is moved, rather than everyone being re-sorted,
+and !top and !rank are answered without fetching anything. The index is fed by every
+snapshot fetched for a clan member, and warmed from the snapshot history at startup.
+"""
+import threading
+from bisect import bisect_left, insort
+
+from config import *
+from osrs_utils import *
+from account_store import NOT_FOUND
+
+"""Derived entries ranked alongside SKILLS, ACTIVITIES and BOSSES, with their formatted names
+"""
+DERIVED_ENTRIES = {'ehb': 'EHB'}
+
+"""Every entry there is a leaderboard for
+"""
+LEADERBOARD_ENTRIES = SKILLS + ACTIVITIES + BOSSES + list(DERIVED_ENTRIES)
+
+"""Number of members without a snapshot named under a leaderboard, the rest are only counted
+so the report stays within Discord's message length limit
+"""
+MISSING_NAMES_SHOWN = 5
+
+
+class Leaderboard:
+    """Members ranked by their value for one entry, highest first. Members who aren't
+    listed for the entry (values of 0 or less) aren't ranked.
+    """
+    __slots__ = ('_keys', '_values')
+
+    def __init__(self):
+        # Sorted (-value, rsn) pairs, so the highest value comes first and ties are broken by name
+        self._keys = []
+        self._values = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def update(self, rsn, value):
+        """Sets a member's value, moving them to their new position.
+
+        :param rsn: str lower-cased RSN
+        :param value: number
+        :return: None
+        """
+        old = self._values.get(rsn)
+        if old == value:
+            return
+        if old is not None:
+            del self._keys[bisect_left(self._keys, (-old, rsn))]
+            del self._values[rsn]
+        if value > 0:
+            insort(self._keys, (-value, rsn))
+            self._values[rsn] = value
+
+    def remove(self, rsn):
+        """Stops ranking a member.
+
+        :param rsn: str lower-cased RSN
+        :return: None
+        """
+        self.update(rsn, 0)
+
+    def rsns(self):
+        """Returns every ranked member.
+
+        :return: list of str lower-cased RSNs
+        """
+        return list(self._values)
+
+    def top(self, n):
+        """Returns the n highest ranked members.
+
+        :param n: int number of members
+        :return: list of (rsn, value) tuples, highest first
+        """
+        return [(rsn, -key) for key, rsn in self._keys[:n]]
+
+    def rank(self, rsn):
+        """Returns a member's rank. Members with the same value share a rank.
+
+        :param rsn: str lower-cased RSN
+        :return: tuple (int rank starting at 1, value), or None if the member isn't ranked
+        """
+        value = self._values.get(rsn)
+        if value is None:
+            return None
+        return bisect_left(self._keys, (-value,)) + 1, value
+
+
+class LeaderboardIndex:
+    """A Leaderboard for every entry in LEADERBOARD_ENTRIES, over the clan's members.
+    """
+
+    def __init__(self, account_store, members=()):
+        """
+        :param account_store: AccountTypeStore used to find members' game modes for EHB
+        :param members: Iterable of member RSNs
+        """
+        self.account_store = account_store
+        self._boards = {entry: Leaderboard() for entry in LEADERBOARD_ENTRIES}
+        self._members = {}
+        self._indexed = set()
+        self._lock = threading.Lock()
+        self.set_members(members)
+
+    def set_members(self, members):
+        """Sets which players are ranked, dropping any that are no longer members.
+
+        :param members: Iterable of member RSNs
+        :return: None
+        """
+        with self._lock:
+            self._members = {rsn.lower(): rsn for rsn in members}
+            for board in self._boards.values():
+                for rsn in board.rsns():
+                    if rsn not in self._members:
+                        board.remove(rsn)
+            self._indexed &= set(self._members)
+
+    def update(self, user):
+        """Re-ranks a member from a new snapshot. Snapshots of non-members, and from the
+        ironman boards, are ignored. Members are only ranked for EHB once their game mode
+        is known. Suitable for use with hs_wrapper.add_fetch_listener.
+
+        :param user: HighscoreSnapshot
+        :return: boolean, True if the snapshot was indexed
+        """
+        rsn = user.rsn.lower()
+        # Ironman boards stop updating for players who de-iron, the main board never does
+        if rsn not in self._members or user.board != 'default':
+            return False
+        values = dict(zip(SKILLS, user.xp.tolist()))
+        values.update(zip(ACTIVITIES, user.scores.tolist()))
+        values.update(zip(BOSSES, user.kc.tolist()))
+        account_type = self.account_store.get(rsn)
+        if account_type is not None and account_type != NOT_FOUND:
+            values['ehb'] = round(float(calc_ehb_batch(user.kc, [GameMode(account_type)])[1][0]), 2)
+
+        with self._lock:
+            for entry, value in values.items():
+                self._boards[entry].update(rsn, value)
+            self._indexed.add(rsn)
+        return True
+
+    def warm(self, latest):
+        """Indexes every member that isn't indexed yet from their last known snapshot.
+
+        :param latest: Callable taking an RSN and returning their last known main board
+        HighscoreSnapshot or None, e.g. HistoryStore.latest
+        :return: int number of members indexed
+        """
+        count = 0
+        for rsn in self.missing():
+            user = latest(rsn)
+            # Same guard as update, snapshots from the ironman boards may be long out of date
+            if user is not None and user.board == 'default' and self.update(user):
+                count += 1
+        return count
+
+    def ranked(self, entry):
+        """Returns the number of members ranked for an entry.
+
+        :param entry: str entry from LEADERBOARD_ENTRIES
+        :return: int
+        """
+        with self._lock:
+            return len(self._boards[entry])
+
+    def top(self, entry, n):
+        """Returns the n highest ranked members for an entry.
+
+        :param entry: str entry from LEADERBOARD_ENTRIES
+        :param n: int number of members
+        :return: list of (rsn, value) tuples, highest first, with RSNs as saved in the member list
+        """
+        with self._lock:
+            return [(self._members.get(rsn, rsn), value) for rsn, value in self._boards[entry].top(n)]
+
+    def rank(self, rsn, entry):
+        """Returns a member's rank for an entry.
+
+        :param rsn: str value of a player's OSRS username
+        :param entry: str entry from LEADERBOARD_ENTRIES
+        :return: tuple (rank, value, number of ranked members), or None if the player isn't ranked
+        """
+        with self._lock:
+            board = self._boards[entry]
+            ranking = board.rank(rsn.lower())
+            if ranking is None:
+                return None
+            return ranking + (len(board),)
+
+    def missing(self):
+        """Returns the members that haven't had a snapshot fetched yet.
+
+        :return: list of str RSNs
+        """
+        with self._lock:
+            return [name for rsn, name in self._members.items() if rsn not in self._indexed]
+
+    def stats(self):
+        """Returns the number of members and how many of them have been indexed.
+
+        :return: dict of counters
+        """
+        with self._lock:
+            return {'members': len(self._members), 'indexed': len(self._indexed)}
+
+
+def entry_name(entry):
+    """Returns the formatted name of an entry.
+
+    :param entry: str entry from LEADERBOARD_ENTRIES
+    :return: str
+    """
+    return DERIVED_ENTRIES.get(entry) or FORMATTED_ENTRIES[entry]
+
+
+def entry_unit(entry):
+    """Returns the unit an entry's values are measured in.
+
+    :param entry: str entry from LEADERBOARD_ENTRIES
+    :return: str, e.g. 'XP'
+    """
+    if entry in DERIVED_ENTRIES:
+        return DERIVED_ENTRIES[entry]
+    return {'skill': 'XP', 'activity': '', 'boss': 'KC'}[entry_kind(entry)]
+
+
+def render_leaderboard(index, entry, n=10):
+    """Renders the top n members for an entry.
+
+    :param index: LeaderboardIndex
+    :param entry: str entry from LEADERBOARD_ENTRIES
+    :param n: int number of members to list
+    :return: str report
+    """
+    lines = [f'Clan top {n} for {entry_name(entry)}:\n'
+             '---------------------------------------------------\n']
+    for rank, (rsn, value) in enumerate(index.top(entry, n), 1):
+        lines.append('{:>4}. {:<12} {:>12} {}\n'.format(rank, rsn, value, entry_unit(entry)))
+    missing = index.missing()
+    if missing:
+        names = ', '.join(missing[:MISSING_NAMES_SHOWN])
+        if len(missing) > MISSING_NAMES_SHOWN:
+            names += f' and {len(missing) - MISSING_NAMES_SHOWN} more'
+        lines.append('\nNo snapshot yet for {} member(s): {}\n'.format(len(missing), names))
+    return ''.join(lines)
@@ -1,18 +1,208 @@
-"""gph_logging.py
-Implements simple logging functions for use in Gold Partyhat.
+"""logging_.py
+Implements simple logging functions for use in Clockwork Penguin.
+
+log_message only queues the record, a background writer thread batches records
+into LOG_NAME, flushing every LOG_BATCH_SIZE records or LOG_FLUSH_INTERVAL
+seconds, and rotates the file once it grows past LOG_MAX_BYTES or gets older
+than LOG_MAX_AGE. Queued records are flushed when the process exits.
+
+At most LOG_QUEUE_SIZE records are held waiting for the writer. Records logged while
+the queue is full are dropped and counted, and the count is written to the log once
+there is room again. Errors writing the file are reported on stderr, and the writer
+carries on with the next batch.
 """
-from datetime import *
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
 from config import *
 
+_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_writer = None
+_writer_lock = threading.Lock()
+
+# Number of records dropped because the queue was full, and how many of those the log has been told about
+_dropped = 0
+_dropped_reported = 0
+_dropped_lock = threading.Lock()
+
+"""Queued to tell the writer to flush and exit
+"""
+_STOP = object()
+
+
+class _LogWriter(threading.Thread):
+    """Background thread that writes queued records to the log file in batches.
+    """
+
+    def __init__(self, records, path=LOG_NAME, log_format=LOG_FORMAT, batch_size=LOG_BATCH_SIZE,
+                 flush_interval=LOG_FLUSH_INTERVAL, max_bytes=LOG_MAX_BYTES, max_age=LOG_MAX_AGE,
+                 backup_count=LOG_BACKUP_COUNT):
+        super().__init__(name='log-writer', daemon=True)
+        self.records = records
+        self.path = path
+        self.log_format = log_format
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backup_count = backup_count
+        self._file = None
+        self._opened_at = None
+
+    def run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if not batch else max(0.0, deadline - time.monotonic())
+            try:
+                record = self.records.get(timeout=timeout)
+            except queue.Empty:
+                record = None
+
+            if record is _STOP:
+                self._flush(batch)
+                if self._file is not None:
+                    self._file.close()
+                return
+
+            if record is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(record)
+            if batch and (record is None or len(batch) >= self.batch_size):
+                self._flush(batch)
+                batch = []
+
+    def _format(self, record):
+        """Formats a record as a single line.
+
+        :param record: dict with 'time' and 'msg' keys plus any extra fields
+        :return: str line
+        """
+        if self.log_format == 'json':
+            fields = dict(record, time=record['time'].isoformat())
+            return json.dumps(fields, default=str) + '\n'
+        extra = ''.join(f' {key}={value}' for key, value in record.items() if key not in ('time', 'msg'))
+        return record['time'].strftime('[%d %b %Y - %H:%M:%S] ') + record['msg'] + extra + '\n'
+
+    def _flush(self, batch):
+        """Writes a batch of records, rotating the log file first if needed. If the file
+        can't be written the batch is dropped and the error printed to stderr, so that one
+        failure doesn't stop every later record being written.
+
+        :param batch: list of records
+        :return: None
+        """
+        global _dropped_reported
+        with _dropped_lock:
+            unreported = _dropped - _dropped_reported
+            _dropped_reported = _dropped
+        if unreported:
+            batch = batch + [{'time': datetime.now(),
+                              'msg': f'Dropped {unreported} log records, the log queue was full'}]
+        if not batch:
+            return
+        try:
+            self._write(batch)
+        except Exception as err:
+            print(f'Could not write {len(batch)} records to {self.path}: {err!r}', file=sys.stderr)
+            if self._file is not None:
+                try:
+                    self._file.close()
+                except OSError:
+                    pass
+            # Reopen the file on the next batch
+            self._file = None
 
-def log_message(msg):
-    """Logs messages to file LOG_FILE set in gph_config.py
+    def _write(self, batch):
+        """Writes a batch of records, rotating the log file first if needed.
+
+        :param batch: list of records
+        :return: None
+        """
+        if self._file is None:
+            self._open()
+        elif (self._file.tell() >= self.max_bytes
+              or time.time() - self._opened_at >= self.max_age):
+            self._rotate()
+        self._file.write(''.join(self._format(record) for record in batch))
+        self._file.flush()
+
+    def _open(self):
+        """Opens the log file for appending.
+
+        :return: None
+        """
+        self._file = open(self.path, 'a')
+        # Age is counted from when this process started writing to the file
+        self._opened_at = time.time()
+
+    def _rotate(self):
+        """Moves LOG_NAME to LOG_NAME.1, LOG_NAME.1 to LOG_NAME.2 and so on, dropping the
+        oldest file beyond backup_count, then starts a new log file.
+
+        :return: None
+        """
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backup_count > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self._open()
+
+
+def log_message(msg, **fields):
+    """Logs messages to file LOG_NAME set in config.py. Returns immediately, the
+    message is written by a background thread.
 
     :param msg: String to print to logfile with timestamp.
+    :param fields: Optional extra fields to record alongside msg, e.g. cmd='!hs'
     :return: No return, prints to logfile.
     """
-    logfile = open(LOG_NAME, 'a')
-    now = datetime.now()
-    timestamp = now.strftime('[%d %b %Y - %H:%M:%S] ')
-    logfile.write(timestamp + msg + '\n')
-    logfile.close()
+    global _writer, _dropped
+    if _writer is None or not _writer.is_alive():
+        with _writer_lock:
+            if _writer is None or not _writer.is_alive():
+                _writer = _LogWriter(_queue)
+                _writer.start()
+    record = {'time': datetime.now(), 'msg': str(msg)}
+    record.update(fields)
+    try:
+        _queue.put_nowait(record)
+    except queue.Full:
+        # Never block the caller, which may be the event loop, on a slow or stuck log file
+        with _dropped_lock:
+            _dropped += 1
+
+
+def log_stats():
+    """Returns the number of records waiting to be written and dropped so far.
+
+    :return: dict of counters
+    """
+    return {'queued': _queue.qsize(), 'dropped': _dropped}
+
+
+@atexit.register
+def flush_logs():
+    """Writes out all queued messages and stops the writer thread. Any later
+    messages start a new writer.
+
+    :return: None
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            return
+        if _writer.is_alive():
+            _queue.put(_STOP)
+            _writer.join()
+        _writer = None
@@ -0,0 +1,255 @@
+"""metrics.py
+Lightweight in-process performance metrics for Clockwork Penguin.
+
+Latencies are recorded into fixed-bucket histograms, from which p50/p95/p99 are
+estimated, alongside simple counters and gauges read from callbacks (cache and
+queue stats). Everything can be rendered as a summary for !stats, or in the
+Prometheus text format served on METRICS_PORT.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiohttp import web
+
+from config import *
+
+"""Upper bounds in seconds of the histogram buckets, the last bucket catches everything else
+"""
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+
+class Histogram:
+    """Counts of observed values per bucket, plus their total count and sum.
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimates a quantile by interpolating linearly within the bucket it falls in.
+
+        :param q: float quantile between 0 and 1, e.g. 0.95
+        :return: float estimate, 0.0 if nothing has been observed
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, bucket_count in enumerate(self.counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i]
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-2]
+
+
+def _format_labels(labels, extra=()):
+    """Formats a label tuple in Prometheus syntax.
+
+    :param labels: tuple of (name, value) pairs
+    :param extra: additional (name, value) pairs to append
+    :return: str, e.g. '{command="!hs"}', or '' if there are no labels
+    """
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class MetricsRegistry:
+    """Thread-safe collection of histograms, counters and gauges, keyed by name and labels.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def observe(self, name, value, **labels):
+        """Records a value, e.g. a latency in seconds, in a histogram.
+
+        :param name: str metric name
+        :param value: float value to record
+        :param labels: label values identifying the series, e.g. command='!hs'
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        """Increments a counter.
+
+        :param name: str metric name
+        :param amount: number to add
+        :param labels: label values identifying the series
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def register_gauges(self, prefix, func):
+        """Registers a callback whose numeric results are reported as gauges when metrics are read.
+
+        :param prefix: str prefix for the gauge names, e.g. 'hs_cache'
+        :param func: Callable returning a dict of names to numbers, e.g. hs_wrapper.cache_stats
+        :return: None
+        """
+        with self._lock:
+            self._gauges[prefix] = func
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """Context manager recording how long its body takes in a histogram.
+
+        :param name: str metric name
+        :param labels: label values identifying the series
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def histograms(self, name):
+        """Returns every histogram recorded under a name.
+
+        :param name: str metric name
+        :return: dict mapping label tuples of (name, value) pairs to Histograms
+        """
+        with self._lock:
+            return {labels: histogram for (hist_name, labels), histogram in self._histograms.items()
+                    if hist_name == name}
+
+    def counter(self, name, **labels):
+        """Returns a counter's current value.
+
+        :return: number, 0 if never incremented
+        """
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def gauges(self):
+        """Reads every registered gauge callback.
+
+        :return: dict mapping gauge names to numbers
+        """
+        with self._lock:
+            callbacks = list(self._gauges.items())
+        values = {}
+        for prefix, func in callbacks:
+            for name, value in func().items():
+                if isinstance(value, (int, float)):
+                    values[f'{prefix}_{name}'] = value
+        return values
+
+    def render_prometheus(self):
+        """Renders all metrics in the Prometheus text exposition format.
+
+        :return: str
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            counters = sorted(self._counters.items(), key=lambda item: item[0])
+            hist_copies = [(key, list(h.counts), h.count, h.sum, h.buckets) for key, h in histograms]
+
+        typed = set()
+        for (name, labels), counts, count, total, buckets in hist_copies:
+            if name not in typed:
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+            cumulative = 0
+            for bucket, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                le = '+Inf' if bucket == float('inf') else repr(bucket)
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", le)])} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def render_summary(self):
+        """Renders a short human readable summary of latencies, errors and gauges for !stats.
+
+        :return: str
+        """
+        lines = []
+        for title, name in [('Commands', 'command_latency_seconds'),
+                            ('Highscores fetches', 'hs_fetch_seconds'),
+                            ('Game mode detection', 'game_mode_seconds'),
+                            ('Webhook deliveries', 'webhook_delivery_seconds')]:
+            histograms = self.histograms(name)
+            if not histograms:
+                continue
+            lines.append(f'{title} (count / p50 / p95 / p99 ms):')
+            for labels, histogram in sorted(histograms.items()):
+                label = ', '.join(str(value) for _, value in labels) or 'all'
+                lines.append('  {:<20} {:>6} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+                    label, histogram.count, histogram.quantile(0.5) * 1000,
+                    histogram.quantile(0.95) * 1000, histogram.quantile(0.99) * 1000))
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+        if counters:
+            lines.append('Counters:')
+            for (name, labels), value in counters:
+                lines.append(f'  {name}{_format_labels(labels)}: {value}')
+
+        gauges = self.gauges()
+        if gauges:
+            lines.append('Gauges:')
+            for name, value in sorted(gauges.items()):
+                lines.append(f'  {name}: {round(value, 3)}')
+        return '\n'.join(lines) + '\n'
+
+
+"""Registry that all modules record their metrics in
+"""
+metrics = MetricsRegistry()
+
+
+async def serve_metrics(port=METRICS_PORT, host='127.0.0.1'):
+    """Serves metrics in the Prometheus text format at http://host:port/metrics
+
+    :param port: int port to listen on
+    :param host: str address to listen on, local only by default
+    :return: aiohttp.web.AppRunner, call its cleanup() coroutine to stop serving
+    """
+    async def handle(request):
+        return web.Response(text=metrics.render_prometheus(), content_type='text/plain')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
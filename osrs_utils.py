@@ -1,9 +1,14 @@
 """osrs_utils.py
 Various OSRS-related utility functions.
 """
+import contextvars
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from enum import Enum
+from bisect import bisect_right
 from math import floor
 from hs_wrapper import *
+from profiler import profiler
 
 """EHB_RATES:
     Dict of bosses and their respective kills per efficient bossing hour.
@@ -84,67 +89,427 @@ def get_ehb(boss, kc, mode):
         print(f'{mode} not recognized\n')
 
 
-def calc_ehb(rsn, is_ironman=None):
-    """Calculates a player's efficient hours bossed and writes to a text file.
+class GameMode(Enum):
+    """Account game modes that can be detected from the highscores.
+    """
+    MAIN = 'main'
+    IRONMAN = 'iron'
+    HARDCORE_IRONMAN = 'hardcore'
+    ULTIMATE_IRONMAN = 'ultimate'
+
+    @property
+    def is_ironman(self):
+        """True for all ironman game modes"""
+        return self is not GameMode.MAIN
+
+    @property
+    def ehb_rates(self):
+        """Which set of EHB_RATES applies to this game mode, 'main' or 'iron'"""
+        return 'iron' if self.is_ironman else 'main'
+
+
+"""EHB_RATE_MATRIX:
+    EHB_RATES as an array of shape (len(BOSSES), 2), index matched with BOSSES.
+    Column EHB_RATE_COLUMNS[rates] holds the rates for the 'main' or 'iron' rate set.
+    EHB_MASK is True wherever boss kills count toward EHB for that rate set.
+    """
+EHB_RATE_COLUMNS = {'main': 0, 'iron': 1}
+EHB_RATE_MATRIX = np.array([EHB_RATES[boss] for boss in BOSSES], dtype=np.float64)
+EHB_MASK = EHB_RATE_MATRIX > 0
+
+
+def calc_ehb_batch(kc, modes):
+    """Calculates efficient hours bossed for many players at once.
+
+    :param kc: array-like of shape (N, len(BOSSES)) of each player's KC, index matched with BOSSES
+    :param modes: sequence of length N of each player's GameMode, or of 'main'/'iron' rate sets
+    :return: tuple (per_boss, totals), per_boss is a float array of shape (N, len(BOSSES)) holding
+    each player's EHB at each boss, and totals is a float array of shape (N,) of each player's total EHB
+    """
+    kc = np.atleast_2d(np.asarray(kc, dtype=np.float64))
+    columns = [EHB_RATE_COLUMNS[mode.ehb_rates if isinstance(mode, GameMode) else mode] for mode in modes]
+    rates = EHB_RATE_MATRIX.T[columns]
+    counts = EHB_MASK.T[columns] & (kc > 0)
+    per_boss = np.divide(kc, rates, out=np.zeros_like(kc), where=counts)
+    return per_boss, per_boss.sum(axis=1)
+
+
+def kc_matrix(users):
+    """Stacks players' boss KC into a matrix for use with calc_ehb_batch.
+
+    :param users: sequence of HighscoreSnapshots (as returned by get_user())
+    :return: int array of shape (len(users), len(BOSSES))
+    """
+    return np.vstack([user.kc for user in users])
+
+
+"""XP_TABLE:
+    Total XP needed for each level from 1 to MAX_VIRTUAL_LEVEL, XP_TABLE[level - 1] being
+    the XP needed for level. Levels past 99 are virtual levels, which the game doesn't show
+    but are commonly used to measure progress past 99.
+    """
+MAX_LEVEL = 99
+MAX_VIRTUAL_LEVEL = 126
+MAX_XP = 200_000_000
+
+
+def _build_xp_table(max_level):
+    """Builds the XP table using the game's formula, the XP for level L being
+    floor(sum(floor(l + 300 * 2^(l / 7)) for l from 1 to L - 1) / 4).
+
+    :param max_level: int highest level to include
+    :return: int array of shape (max_level,)
+    """
+    points = np.floor(np.arange(1, max_level) + 300 * 2 ** (np.arange(1, max_level) / 7))
+    return np.concatenate(([0], np.floor(np.cumsum(points) / 4))).astype(np.int64)
+
+
+XP_TABLE = _build_xp_table(MAX_VIRTUAL_LEVEL)
+
+
+def xp_for_level(level):
+    """Returns the total XP needed for a level.
+
+    :param level: int level between 1 and MAX_VIRTUAL_LEVEL
+    :return: int XP
+    """
+    return int(XP_TABLE[level - 1])
+
+
+def level_for_xp(xp, virtual=False):
+    """Returns the level a player is at with a given amount of XP, found by bisecting XP_TABLE.
+
+    :param xp: int XP
+    :param virtual: boolean, True to count virtual levels past 99
+    :return: int level
+    """
+    level = bisect_right(XP_TABLE, xp)
+    return max(1, min(level, MAX_VIRTUAL_LEVEL if virtual else MAX_LEVEL))
+
+
+def xp_to_next_level(xp, virtual=False):
+    """Returns how much more XP a player needs for their next level.
+
+    :param xp: int XP
+    :param virtual: boolean, True to count virtual levels past 99
+    :return: int XP, 0 if there is no next level
+    """
+    level = level_for_xp(xp, virtual)
+    if level >= (MAX_VIRTUAL_LEVEL if virtual else MAX_LEVEL):
+        return 0
+    return int(XP_TABLE[level]) - xp
+
+
+def virtual_levels(xp):
+    """Calculates virtual levels for an array of XP values at once.
+
+    :param xp: int array-like of XP, e.g. HighscoreSnapshot.xp
+    :return: int array of levels, the same shape as xp. Unlisted (-1) XP gives level 1.
+    """
+    return np.clip(np.searchsorted(XP_TABLE, xp, side='right'), 1, MAX_VIRTUAL_LEVEL)
+
+
+"""EHP_RATES:
+    Dict of skills and the XP per efficient hour played that can be gained in them.
+    EHP_RATES(skill) returns a tuple of length 2 as a key.
+    key[0] is the rates for main accounts, and key[1] is the rates for ironman accounts.
+    Each is a list of (start_xp, xp_per_hour) tiers, as faster methods unlock with
+    higher levels, and the first tier always starts at 0 XP.
+    A rate of 0 means XP in that skill is gained alongside other skills, so it doesn't
+    count toward EHP.
+    Rates are approximations of https://wiseoldman.net/rates/ehp
+    """
+_MELEE_MAIN = [(0, 15000), (37224, 38000), (100000, 55000), (1000000, 65000), (1986068, 82000),
+               (3000000, 95000), (5346332, 115000), (13034431, 135000)]
+_MELEE_IRON = [(0, 15000), (37224, 38000), (100000, 55000), (1000000, 65000), (1986068, 80000),
+               (3000000, 90000), (5346332, 105000), (13034431, 120000)]
+_WOODCUTTING = [(0, 7000), (2411, 16000), (13363, 35000), (41171, 49000), (302288, 62000), (737627, 75000),
+                (1986068, 85000), (5902831, 95000), (13034431, 105000)]
+_FISHING = [(0, 14000), (4470, 30000), (13363, 40000), (273742, 65000), (737627, 75000), (2421087, 80000),
+            (5902831, 85000), (13034431, 90000)]
+_MINING = [(0, 8000), (14833, 20000), (41171, 44000), (302288, 60000), (737627, 75000), (1986068, 85000),
+           (5346332, 95000)]
+_AGILITY = [(0, 6000), (13363, 15000), (449428, 50000), (2192818, 58000), (6000000, 62000), (11000000, 65000)]
+_SLAYER = [(0, 5000), (37224, 12000), (100000, 17000), (1000000, 25000), (1986068, 30000), (3000000, 32500),
+           (7195629, 35000), (13034431, 37000)]
+_RUNECRAFT = [(0, 8000), (2107, 20000), (101333, 45000), (1210421, 68000), (2421087, 78000), (5902831, 90000),
+              (13034431, 100000)]
+_HUNTER = [(0, 5000), (12031, 40000), (247886, 80000), (1986068, 110000), (3972294, 135000), (13034431, 150000)]
+EHP_RATES = {'attack': (_MELEE_MAIN, _MELEE_IRON),
+             'defence': (_MELEE_MAIN, _MELEE_IRON),
+             'strength': (_MELEE_MAIN, _MELEE_IRON),
+             'hitpoints': ([(0, 0)], [(0, 0)]),
+             'ranged': ([(0, 30000), (273742, 250000), (1210421, 500000), (6517253, 675000)],
+                        [(0, 30000), (273742, 150000), (1210421, 250000), (6517253, 300000)]),
+             'prayer': ([(0, 50000), (101333, 850000)],
+                        [(0, 50000), (101333, 250000), (737627, 500000)]),
+             'magic': ([(0, 30000), (101333, 110000), (1986068, 250000)],
+                       [(0, 30000), (101333, 90000), (1986068, 150000)]),
+             'cooking': ([(0, 40000), (7842, 130000), (37224, 175000), (737627, 450000)],
+                         [(0, 40000), (7842, 70000), (37224, 120000), (737627, 200000)]),
+             'woodcutting': (_WOODCUTTING, _WOODCUTTING),
+             'fletching': ([(0, 30000), (969, 45000), (33648, 150000), (166636, 250000), (737627, 2500000)],
+                           [(0, 30000), (969, 45000), (33648, 100000), (166636, 150000), (737627, 250000)]),
+             'fishing': (_FISHING, _FISHING),
+             'firemaking': ([(0, 45000), (13363, 132660), (61512, 198990), (273742, 298485), (1210421, 447801)],
+                            [(0, 45000), (13363, 100000), (273742, 200000), (1210421, 300000)]),
+             'crafting': ([(0, 57000), (300000, 170000), (362000, 285000), (496254, 360000)],
+                          [(0, 57000), (300000, 120000), (496254, 200000)]),
+             'smithing': ([(0, 40000), (37224, 129000), (605032, 234000), (2000000, 390000)],
+                          [(0, 40000), (37224, 100000), (605032, 150000), (2000000, 200000)]),
+             'mining': (_MINING, _MINING),
+             'herblore': ([(0, 60000), (27473, 200000), (2192818, 400000)],
+                          [(0, 60000), (27473, 120000), (2192818, 180000)]),
+             'agility': (_AGILITY, _AGILITY),
+             'thieving': ([(0, 15000), (61512, 60000), (166636, 100000), (449428, 240000), (5902831, 270000)],
+                          [(0, 15000), (61512, 60000), (166636, 100000), (449428, 200000), (5902831, 250000)]),
+             'slayer': (_SLAYER, _SLAYER),
+             'farming': ([(0, 10000), (2411, 50000), (13524, 80000), (61512, 150000), (273742, 350000),
+                          (1210421, 1500000)],
+                         [(0, 10000), (2411, 50000), (13524, 80000), (61512, 150000), (273742, 300000),
+                          (1210421, 1000000)]),
+             'runecraft': (_RUNECRAFT, _RUNECRAFT),
+             'hunter': (_HUNTER, _HUNTER),
+             'construction': ([(0, 20000), (18247, 100000), (101333, 230000), (1096278, 410000)],
+                              [(0, 20000), (18247, 60000), (101333, 150000), (1096278, 250000)])}
+
+
+def _ehp_tier_arrays(column):
+    """Lays out one rate set of EHP_RATES as arrays of shape (len(SKILLS), tiers), index
+    matched with SKILLS. Overall and unused trailing tiers are empty tiers at MAX_XP.
+
+    :param column: int 0 for main rates, 1 for ironman rates
+    :return: tuple of float arrays (starts, ends, hours_per_xp)
+    """
+    tiers = max(len(rates[column]) for rates in EHP_RATES.values())
+    starts = np.full((len(SKILLS), tiers), MAX_XP, dtype=np.float64)
+    ends = np.full((len(SKILLS), tiers), MAX_XP, dtype=np.float64)
+    hours_per_xp = np.zeros((len(SKILLS), tiers), dtype=np.float64)
+    for skill, rates in EHP_RATES.items():
+        i = SKILL_INDEX[skill]
+        for t, (start, rate) in enumerate(rates[column]):
+            starts[i, t] = start
+            ends[i, t] = rates[column][t + 1][0] if t + 1 < len(rates[column]) else MAX_XP
+            hours_per_xp[i, t] = 1 / rate if rate > 0 else 0.0
+    return starts, ends, hours_per_xp
+
+
+"""EHP_TIER_STARTS, EHP_TIER_ENDS, EHP_HOURS_PER_XP:
+    EHP_RATES as arrays of shape (2, len(SKILLS), tiers). The first axis is indexed by
+    EHB_RATE_COLUMNS, so EHP_TIER_STARTS[EHB_RATE_COLUMNS['iron']] holds the ironman tiers.
+    """
+EHP_TIER_STARTS, EHP_TIER_ENDS, EHP_HOURS_PER_XP = (np.stack(arrays) for arrays in
+                                                    zip(_ehp_tier_arrays(0), _ehp_tier_arrays(1)))
+
+
+def calc_ehp_batch(xp, modes):
+    """Calculates efficient hours played for many players at once. The XP within each
+    tier is found for all players, skills and tiers at once and divided by that tier's rate.
+
+    :param xp: array-like of shape (N, len(SKILLS)) of each player's XP, index matched with SKILLS
+    :param modes: sequence of length N of each player's GameMode, or of 'main'/'iron' rate sets
+    :return: tuple (per_skill, totals), per_skill is a float array of shape (N, len(SKILLS)) holding
+    each player's EHP in each skill (0 for overall), and totals is a float array of shape (N,)
+    of each player's total EHP
+    """
+    xp = np.clip(np.atleast_2d(np.asarray(xp, dtype=np.float64)), 0, MAX_XP)
+    columns = [EHB_RATE_COLUMNS[mode.ehb_rates if isinstance(mode, GameMode) else mode] for mode in modes]
+    starts = EHP_TIER_STARTS[columns]
+    in_tier = np.clip(xp[:, :, np.newaxis] - starts, 0, EHP_TIER_ENDS[columns] - starts)
+    per_skill = (in_tier * EHP_HOURS_PER_XP[columns]).sum(axis=2)
+    return per_skill, per_skill.sum(axis=1)
+
+
+def xp_matrix(users):
+    """Stacks players' XP into a matrix for use with calc_ehp_batch.
+
+    :param users: sequence of HighscoreSnapshots (as returned by get_user())
+    :return: int array of shape (len(users), len(SKILLS))
+    """
+    return np.vstack([user.xp for user in users])
+
+
+"""Pool used to query the highscores boards checked by get_game_mode concurrently
+"""
+_board_pool = ThreadPoolExecutor(max_workers=HS_MAX_WORKERS * 4, thread_name_prefix='hs-board')
+
+
+def _on_board(rsn, board):
+    """Checks if a player is listed on a given highscores board.
 
     :param rsn: str value of a player's OSRS username
-    :param is_ironman: Optional boolean value to indicate the player is an ironman.
-    :return: None, creates file {rsn}_ehb.txt to be sent as message attachment
+    :param board: str highscores board to check
+    :return: boolean, True if the player is listed on board
     """
-    if is_ironman is None:
-        try:
-            iron = is_iron(rsn)
-        except ValueError:
-            print(f'User {rsn} not found!')
-            return -1.0
-    else:
-        iron = is_ironman
+    try:
+        get_user(rsn, board)
+        return True
+    except ValueError:
+        return False
+
 
-    if iron:
-        mode = 'iron'
+def _decide_game_mode(found):
+    """Decides a player's game mode from the boards they have been checked against so far.
+
+    :param found: dict mapping board names to whether the player is listed on that board
+    :return: GameMode, or None if more boards need to be checked first
+    @:raises ValueError if player is not found on highscores
+    """
+    # Every account is listed on the main board, so if they aren't there they don't exist
+    if found.get('default') is False:
+        raise ValueError
+    if found.get('ultimate'):
+        return GameMode.ULTIMATE_IRONMAN
+    if found.get('hardcore_ironman'):
+        return GameMode.HARDCORE_IRONMAN
+    if found.get('ironman') is False and found.get('default'):
+        return GameMode.MAIN
+    if found.get('ironman') and found.get('ultimate') is False and found.get('hardcore_ironman') is False:
+        return GameMode.IRONMAN
+    return None
+
+
+def _check_boards(rsn, boards, found):
+    """Checks a player against several boards concurrently, until the boards checked so far
+    are enough to decide their game mode. Lookups that haven't started by then are cancelled.
+
+    :param rsn: str value of a player's OSRS username
+    :param boards: list of str highscores boards to check
+    :param found: dict mapping board names to whether the player is listed on that board,
+    updated with the boards checked
+    :return: GameMode, or None if the boards checked aren't enough to decide
+    @:raises ValueError if player is not found on highscores
+    """
+    # Each lookup runs in a copy of the caller's context so it keeps the caller's request priority
+    futures = {_board_pool.submit(contextvars.copy_context().run, profiler.run, _on_board, rsn, board): board
+               for board in boards}
+    try:
+        for future in as_completed(futures):
+            found[futures[future]] = future.result()
+            mode = _decide_game_mode(found)
+            if mode is not None:
+                return mode
+        return None
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def get_game_mode(rsn):
+    """Detects a player's game mode. The main and ironman boards are checked concurrently
+    first, and only players on the ironman board are checked against the hardcore ironman
+    and ultimate ironman boards, so most players take two lookups.
+
+    :param rsn: str value of a player's OSRS username
+    :return: GameMode of player's account
+    @:raises ValueError if player is not found on highscores
+    """
+    with metrics.timed('game_mode_seconds'):
+        found = {}
+        mode = _check_boards(rsn, ['default', 'ironman'], found)
+        if mode is None:
+            mode = _check_boards(rsn, ['hardcore_ironman', 'ultimate'], found)
+        return mode
+
+
+def render_ehb(rsn, mode=None, user=None):
+    """Renders a player's efficient hours bossed report in memory.
+
+    :param rsn: str value of a player's OSRS username
+    :param mode: Optional GameMode of the player's account, detected if not given.
+    :param user: Optional HighscoreSnapshot for player, fetched with get_user() if not given
+    :return: str report of player's EHB at each boss they have kills at
+    @:raises ValueError if player is not found on highscores
+    """
+    if mode is None:
+        mode = get_game_mode(rsn)
+
+    if mode.is_ironman:
         mode_str = 'Using Ironman EHB rates\n'
     else:
-        mode = 'main'
         mode_str = 'Using main account EHB rates\n'
-    total_ehb = 0.0
-    outfile = rsn + '_ehb.txt'
-    user = get_user(rsn)
-    with open(outfile, 'w') as file:
-        file.write(f'{rsn}\'s OSRS efficient hours bossed:\n'
-                   f'{mode_str}'
-                   f'----------------------------------------------------------\n')
+    user = get_user(rsn) if user is None else user
+    per_boss, totals = calc_ehb_batch(user.kc, [mode])
+    per_boss = per_boss[0]
+    lines = [f'{rsn}\'s OSRS efficient hours bossed:\n'
+             f'{staleness_note(user)}'
+             f'{mode_str}'
+             f'----------------------------------------------------------\n']
+
+    for i in np.flatnonzero(per_boss > 0):
+        lines.append(f'{FORMATTED_BOSSES[i]:<34}: {user.kc[i]:>7} KC {round(float(per_boss[i]), 1):>7} EHB\n')
+
+    lines.append('Total: {:>7} EHB\n'.format(round(float(totals[0]), 2)))
+    return ''.join(lines)
+
+
+def render_ehp(rsn, mode=None, user=None):
+    """Renders a player's efficient hours played report in memory.
+
+    :param rsn: str value of a player's OSRS username
+    :param mode: Optional GameMode of the player's account, detected if not given.
+    :param user: Optional HighscoreSnapshot for player, fetched with get_user() if not given
+    :return: str report of player's EHP in each skill they have XP in
+    @:raises ValueError if player is not found on highscores
+    """
+    if mode is None:
+        mode = get_game_mode(rsn)
 
-        for i in range(len(BOSSES)):
-            kc = query_boss_kc(user, BOSSES[i])
-            ehb = get_ehb(BOSSES[i], kc, mode)
-            if (kc > 0) & (ehb > 0):
-                file.write(f'{FORMATTED_BOSSES[i]:<34}: {kc:>7} KC {round(ehb, 1):>7} EHB\n')
-                total_ehb += ehb
+    if mode.is_ironman:
+        mode_str = 'Using Ironman EHP rates\n'
+    else:
+        mode_str = 'Using main account EHP rates\n'
+    user = get_user(rsn) if user is None else user
+    per_skill, totals = calc_ehp_batch(user.xp, [mode])
+    per_skill = per_skill[0]
+    lines = [f'{rsn}\'s OSRS efficient hours played:\n'
+             f'{staleness_note(user)}'
+             f'{mode_str}'
+             f'----------------------------------------------------------\n']
+
+    for i in np.flatnonzero(per_skill > 0):
+        lines.append(f'{FORMATTED_SKILLS[i]:<15}: {user.xp[i]:>11} XP {round(float(per_skill[i]), 1):>8} EHP\n')
 
-        file.write('Total: {:>7} EHB\n'.format(round(total_ehb, 2)))
+    lines.append('Total: {:>8} EHP\n'.format(round(float(totals[0]), 2)))
+    return ''.join(lines)
 
-        file.close()
+
+def calc_ehb(rsn, mode=None, is_ironman=None):
+    """Calculates a player's efficient hours bossed and writes to a text file.
+
+    :param rsn: str value of a player's OSRS username
+    :param mode: Optional GameMode of the player's account, detected if not given. For
+    backwards compatibility a boolean is also accepted, True for an ironman.
+    :param is_ironman: Deprecated optional boolean value to indicate the player is an ironman,
+    used if mode isn't given.
+    :return: None, creates file {rsn}_ehb.txt to be sent as message attachment
+    """
+    if mode is None:
+        mode = is_ironman
+    if isinstance(mode, bool):
+        # EHB rates only distinguish ironmen from mains, so any ironman mode will do
+        mode = GameMode.IRONMAN if mode else GameMode.MAIN
+    try:
+        report = render_ehb(rsn, mode)
+    except ValueError:
+        print(f'User {rsn} not found!')
+        return -1.0
+    _write_report(rsn + '_ehb.txt', report)
 
 
 def is_iron(rsn):
-    """Checks if a given player is an Ironman account.
+    """Checks if a given player is an Ironman account of any kind.
 
     :param rsn: str value of a player's OSRS username
     :return: boolean, True if user is an ironman, False if not
     @:raises ValueError if player is not found on highscores
     """
-    # If we find a user on the Ironman highscores, we know they're an ironman.
-    # Otherwise, we check to make sure the user exists on the main highscore board
-    # This isn't a great solution but it's really the only way to check an account's status
-    try:
-        user = Highscores(rsn, target='ironman')
-        return True
-    except ValueError:
-        try:
-            user = Highscores(rsn)
-            return False
-        except ValueError:
-            raise ValueError
+    return get_game_mode(rsn).is_ironman
+
+
+"""Skills that contribute to combat level, in the order calc_cmb_lvl returns them
+"""
+COMBAT_SKILLS = ['attack', 'defence', 'strength', 'hitpoints', 'ranged', 'prayer', 'magic']
 
 
 def calc_cmb_lvl(rsn):
@@ -154,72 +519,253 @@ def calc_cmb_lvl(rsn):
     :return: array levels of length 8 containing player's combat level and all related levels
     """
     try:
-        user = Highscores(rsn)
+        user = get_user(rsn)
     except ValueError:
         return [-1]
+    return cmb_levels(user)
 
-    attack = user.attack.level
-    defence = user.defence.level
-    strength = user.strength.level
-    hitpoints = user.hitpoints.level
-    ranged = user.ranged.level
-    prayer = user.prayer.level
-    magic = user.magic.level
 
-    if ((attack == -1) or (defence == -1) or (strength == -1) or (hitpoints == -1) or
-            (ranged == -1) or (prayer == -1) or (magic == -1)):
-        return [-2]
+"""Position of each of COMBAT_SKILLS in SKILLS
+"""
+COMBAT_INDEX = np.array([SKILL_INDEX[skill] for skill in COMBAT_SKILLS])
 
-    base_lvl = round((0.25 * (float(defence) + float(hitpoints) + floor((float(prayer) * 0.5)))), 4)
-    melee_lvl = round((13 / 40) * (float(attack) + float(strength)), 4)
-    range_lvl = round((13 / 40) * floor((float(ranged) * (3 / 2))), 4)
-    mage_lvl = round((13 / 40) * floor((float(magic) * (3 / 2))), 4)
 
-    final_lvl = floor(base_lvl + max(melee_lvl, range_lvl, mage_lvl))
+def combat_matrix(users):
+    """Stacks players' combat skill levels into a matrix for use with calc_cmb_batch.
 
-# Partial combat levels as seen in Runelite
-#    final_lvl = base_lvl + max(melee_lvl, range_lvl, mage_lvl)
+    :param users: sequence of HighscoreSnapshots (as returned by get_user())
+    :return: int array of shape (len(users), len(COMBAT_SKILLS))
+    """
+    return np.vstack([user.levels[COMBAT_INDEX] for user in users])
 
-    levels = [final_lvl, attack, defence, strength, hitpoints, ranged, prayer, magic]
-    return levels
 
+def calc_cmb_batch(levels, partial=False):
+    """Calculates combat levels for many players at once.
+
+    :param levels: array-like of shape (N, len(COMBAT_SKILLS)) of each player's combat skill
+    levels, in the order of COMBAT_SKILLS
+    :param partial: boolean, True to return partial combat levels as seen in Runelite
+    :return: array of shape (N,) of combat levels, ints unless partial is True.
+    Players who aren't listed for every combat skill get -2.
+    """
+    levels = np.atleast_2d(np.asarray(levels, dtype=np.float64))
+    attack, defence, strength, hitpoints, ranged, prayer, magic = levels.T
+    base_lvl = np.round(0.25 * (defence + hitpoints + np.floor(prayer * 0.5)), 4)
+    melee_lvl = np.round((13 / 40) * (attack + strength), 4)
+    range_lvl = np.round((13 / 40) * np.floor(ranged * (3 / 2)), 4)
+    mage_lvl = np.round((13 / 40) * np.floor(magic * (3 / 2)), 4)
+
+    combat = base_lvl + np.maximum(melee_lvl, np.maximum(range_lvl, mage_lvl))
+    if not partial:
+        combat = np.floor(combat).astype(np.int64)
+    return np.where((levels == -1).any(axis=1), -2, combat)
+
+
+def cmb_levels(user):
+    """Calculates combat level from an already fetched snapshot.
+
+    :param user: HighscoreSnapshot for player (as returned by get_user())
+    :return: array levels of length 8 containing player's combat level and all related levels,
+    or [-2] if not all combat skills are listed on the highscores
+    """
+    levels = user.levels[COMBAT_INDEX]
+    final_lvl = int(calc_cmb_batch(levels)[0])
+    if final_lvl == -2:
+        return [-2]
+    return [final_lvl] + [int(level) for level in levels]
 
-def get_hs(rsn):
-    """Writes all highscores entries for a player to file {rsn}.txt
+
+def calc_cmb_next_batch(levels):
+    """Works out how many levels each player needs in each combat skill, on its own, to
+    reach their next combat level. Every possible increase of every skill is tried at once.
+
+    :param levels: array-like of shape (N, len(COMBAT_SKILLS)) as for calc_cmb_batch
+    :return: int array of shape (N, len(COMBAT_SKILLS)) of the levels needed in each skill,
+    0 where levelling that skill alone can't reach the next combat level
+    """
+    levels = np.atleast_2d(np.asarray(levels, dtype=np.int64))
+    target = calc_cmb_batch(levels) + 1
+    increases = np.arange(1, MAX_LEVEL)
+    needed = np.zeros(levels.shape, dtype=np.int64)
+    for k in range(len(COMBAT_SKILLS)):
+        # Shape (N, 98, len(COMBAT_SKILLS)): every player with skill k raised by 1 to 98 levels
+        raised = np.repeat(levels[:, np.newaxis, :], len(increases), axis=1)
+        raised[:, :, k] = np.minimum(raised[:, :, k] + increases, MAX_LEVEL)
+        reached = calc_cmb_batch(raised.reshape(-1, len(COMBAT_SKILLS))).reshape(len(levels), -1) >= target[:, None]
+        reached &= raised[:, :, k] > levels[:, None, k]
+        needed[:, k] = np.where(reached.any(axis=1), reached.argmax(axis=1) + 1, 0)
+    return np.where(target[:, None] > 0, needed, 0)
+
+
+def render_cmb_next(rsn, user=None):
+    """Renders what a player needs for their next combat level in memory.
 
     :param rsn: str value of a player's OSRS username
-    :return: None, writes to file {rsn}.txt
+    :param user: Optional HighscoreSnapshot for player, fetched with get_user() if not given
+    :return: str report, or None if not all of the player's combat skills are listed
+    @:raises ValueError if player is not found on highscores
+    """
+    user = get_user(rsn) if user is None else user
+    levels = user.levels[COMBAT_INDEX]
+    combat = calc_cmb_batch(levels, partial=True)[0]
+    if combat == -2:
+        return None
+    needed = calc_cmb_next_batch(levels)[0]
+
+    lines = [f'{rsn} is combat level {floor(combat)} ({combat:.2f}).']
+    if staleness_note(user):
+        lines.append(staleness_note(user).rstrip('\n'))
+    if floor(combat) >= 126:
+        lines.append('They are already max combat!')
+        return '\n'.join(lines) + '\n'
+    lines.append(f'To reach level {floor(combat) + 1} they need any one of:')
+    for i in np.flatnonzero(needed > 0):
+        skill = COMBAT_SKILLS[i]
+        lines.append(f'  {needed[i]:>2} {FORMATTED_SKILLS[SKILL_INDEX[skill]]} '
+                     f'level{"s" if needed[i] > 1 else ""} ({levels[i]} -> {levels[i] + needed[i]})')
+    return '\n'.join(lines) + '\n'
+
+
+def _render_levels(user):
+    """Renders one line per skill the user is listed on the highscores for.
+
+    :param user: User object for player (as returned by get_user())
+    :return: list of str lines
+    """
+    return ['{:<12}: Level: {:>5} XP: {:>10}\n'.format(FORMATTED_SKILLS[i], user.levels[i], user.xp[i])
+            for i in np.flatnonzero(user.levels > 0)]
+
+
+def _render_skill_details(user):
+    """Renders one line per skill the user is listed on the highscores for, with their
+    virtual level and the XP they need for their next (virtual) level.
+
+    :param user: HighscoreSnapshot for player (as returned by get_user())
+    :return: list of str lines
+    """
+    levels = virtual_levels(user.xp)
+    to_next = np.where(levels < MAX_VIRTUAL_LEVEL, XP_TABLE[np.minimum(levels, MAX_VIRTUAL_LEVEL - 1)] - user.xp, 0)
+    lines = []
+    for i in np.flatnonzero(user.levels > 0):
+        if SKILLS[i] == 'overall':
+            # Virtual levels and XP to next level only make sense for individual skills
+            lines.append('{:<12}: Level: {:>5} Virtual: {:>5} XP: {:>10}\n'.format(
+                FORMATTED_SKILLS[i], user.levels[i], levels[1:][user.levels[1:] > 0].sum(), user.xp[i]))
+        else:
+            lines.append('{:<12}: Level: {:>5} Virtual: {:>5} XP: {:>10} To next: {:>9}\n'.format(
+                FORMATTED_SKILLS[i], user.levels[i], levels[i], user.xp[i], to_next[i]))
+    return lines
+
+
+def _render_activities(user):
+    """Renders one line per activity the user is listed on the highscores for.
+
+    :param user: User object for player (as returned by get_user())
+    :return: list of str lines
+    """
+    return ['{:<24}: {:>6}\n'.format(FORMATTED_ACTIVITIES[i], user.scores[i])
+            for i in np.flatnonzero(user.scores > 0)]
+
+
+def _render_bosses(user):
+    """Renders one line per boss the user is listed on the highscores for.
+
+    :param user: User object for player (as returned by get_user())
+    :return: list of str lines
+    """
+    return ['{:<34}: {:>7} KC\n'.format(FORMATTED_BOSSES[i], user.kc[i])
+            for i in np.flatnonzero(user.kc > 0)]
+
+
+def _write_report(outfile, report):
+    """Writes a rendered report to a text file.
+
+    :param outfile: str path of file to write
+    :param report: str report as returned by one of the render_* functions
+    :return: None
     """
-    outfile = rsn + '.txt'
-    user = get_user(rsn)
     with open(outfile, 'w') as file:
-        file.write('{}\'s OSRS Highscores:\n'
-                   '\nLevels:\n'
-                   '---------------------------------------------------\n'.format(rsn))
+        file.write(report)
 
-        for i in range(len(SKILLS)):
-            lvl = query_skill_level(user, SKILLS[i])
-            xp = query_skill_xp(user, SKILLS[i])
-            if lvl > 0:
-                file.write('{:<12}: Level: {:>5} XP: {:>10}\n'.format(FORMATTED_SKILLS[i], lvl, xp))
 
-        file.write('\nActivities:\n'
-                   '---------------------------------------------------\n')
+def render_hs(rsn, user=None):
+    """Renders all highscores entries for a player in memory.
+
+    :param rsn: str value of a player's OSRS username
+    :param user: Optional HighscoreSnapshot for player, fetched with get_user() if not given
+    :return: str report
+    """
+    user = get_user(rsn) if user is None else user
+    lines = ['{}\'s OSRS Highscores:\n'
+             '{}'
+             '\nLevels:\n'
+             '---------------------------------------------------\n'.format(rsn, staleness_note(user))]
+    lines += _render_levels(user)
+    lines.append('\nActivities:\n'
+                 '---------------------------------------------------\n')
+    lines += _render_activities(user)
+    lines.append('\nBosses:\n'
+                 '---------------------------------------------------\n')
+    lines += _render_bosses(user)
+    return ''.join(lines)
+
+
+def render_skills(rsn, user=None):
+    """Renders all of a player's levels in memory, provided each level is listed
+    on the OSRS Highscores.
+
+    :param rsn: str value of a player's OSRS username
+    :param user: Optional HighscoreSnapshot for player, fetched with get_user() if not given
+    :return: str report
+    """
+    user = get_user(rsn) if user is None else user
+    lines = ['{}\'s OSRS Skillss:\n'
+             '{}'
+             '\nLevels:\n'
+             '---------------------------------------------------\n'.format(rsn, staleness_note(user))]
+    lines += _render_skill_details(user)
+    return ''.join(lines)
 
-        for i in range(len(ACTIVITIES)):
-            score = query_activity_score(user, ACTIVITIES[i])
-            if score > 0:
-                file.write('{:<24}: {:>6}\n'.format(FORMATTED_ACTIVITIES[i], score))
 
-        file.write('\nBosses:\n'
-                   '---------------------------------------------------\n')
+def render_activities(rsn, user=None):
+    """Renders all of a player's activity scores in memory, provided they are
+    listed on the OSRS Highscores for each activity.
 
-        for i in range(len(BOSSES)):
-            kc = query_boss_kc(user, BOSSES[i])
-            if kc > 0:
-                file.write('{:<34}: {:>7} KC\n'.format(FORMATTED_BOSSES[i], kc))
+    :param rsn: str value of a player's OSRS username
+    :param user: Optional HighscoreSnapshot for player, fetched with get_user() if not given
+    :return: str report
+    """
+    user = get_user(rsn) if user is None else user
+    lines = ['{}\'s OSRS Activities:\n'
+             '{}'
+             '---------------------------------------------------\n'.format(rsn, staleness_note(user))]
+    lines += _render_activities(user)
+    return ''.join(lines)
 
-        file.close()
+
+def render_bosses(rsn, user=None):
+    """Renders all of a player's boss kill counts in memory, provided they are
+    listed on the OSRS Highscores for each boss.
+
+    :param rsn: str value of a player's OSRS username
+    :param user: Optional HighscoreSnapshot for player, fetched with get_user() if not given
+    :return: str report
+    """
+    user = get_user(rsn) if user is None else user
+    lines = ['{}\'s OSRS Boss KC:\n'
+             '{}'
+             '---------------------------------------------------\n'.format(rsn, staleness_note(user))]
+    lines += _render_bosses(user)
+    return ''.join(lines)
+
+
+def get_hs(rsn):
+    """Writes all highscores entries for a player to file {rsn}.txt
+
+    :param rsn: str value of a player's OSRS username
+    :return: None, writes to file {rsn}.txt
+    """
+    _write_report(rsn + '.txt', render_hs(rsn))
 
 
 def get_skills(rsn):
@@ -229,20 +775,7 @@ def get_skills(rsn):
     :param rsn: str value of a player's OSRS username
     :return: None, writes to file {rsn}.txt
     """
-    outfile = rsn + '.txt'
-    user = get_user(rsn)
-    with open(outfile, 'w') as file:
-        file.write('{}\'s OSRS Skillss:\n'
-                   '\nLevels:\n'
-                   '---------------------------------------------------\n'.format(rsn))
-
-        for i in range(len(SKILLS)):
-            lvl = query_skill_level(user, SKILLS[i])
-            xp = query_skill_xp(user, SKILLS[i])
-            if lvl > 0:
-                file.write('{:<12}: Level: {:>5} XP: {:>10}\n'.format(FORMATTED_SKILLS[i], lvl, xp))
-
-        file.close()
+    _write_report(rsn + '.txt', render_skills(rsn))
 
 
 def get_activities(rsn):
@@ -252,18 +785,7 @@ def get_activities(rsn):
     :param rsn: str value of a player's OSRS username
     :return: None, writes to file {rsn}.txt
     """
-    outfile = rsn + '.txt'
-    user = get_user(rsn)
-    with open(outfile, 'w') as file:
-        file.write('{}\'s OSRS Activities:\n'
-                   '---------------------------------------------------\n'.format(rsn))
-
-        for i in range(len(ACTIVITIES)):
-            score = query_activity_score(user, ACTIVITIES[i])
-            if score > 0:
-                file.write('{:<24}: {:>6}\n'.format(FORMATTED_ACTIVITIES[i], score))
-
-        file.close()
+    _write_report(rsn + '.txt', render_activities(rsn))
 
 
 def get_bosses(rsn):
@@ -273,18 +795,7 @@ def get_bosses(rsn):
     :param rsn: str value of a player's OSRS username
     :return: None, writes to file {rsn}.txt
     """
-    outfile = rsn + '.txt'
-    user = get_user(rsn)
-    with open(outfile, 'w') as file:
-        file.write('{}\'s OSRS Boss KC:\n'
-                   '---------------------------------------------------\n'.format(rsn))
-
-        for i in range(len(BOSSES)):
-            kc = query_boss_kc(user, BOSSES[i])
-            if kc > 0:
-                file.write('{:<34}: {:>7} KC\n'.format(FORMATTED_BOSSES[i], kc))
-
-        file.close()
+    _write_report(rsn + '.txt', render_bosses(rsn))
 
 
 def partyhat():
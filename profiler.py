@@ -0,0 +1,416 @@
+"""profiler.py
+On-demand profiling of commands, for finding out why a command is slow in production
+without attaching a debugger.
+
+Admins arm a session with !profile, or sessions are armed at startup from
+PROFILE_COMMANDS, and the next N invocations of the chosen command are profiled. The
+command router runs each of those invocations inside Profiler.invocation(). Work the
+command hands off to the lookup pools is profiled in the worker thread it runs on, so
+time spent in osrs_utils and hs_wrapper is included. Webhook posts are delivered by
+webhook_handler's own task, outside the invocation, so only queueing them is profiled,
+not sending them. Each session is written to PROFILE_DIR once its last invocation
+finishes, in a format that depends on its mode:
+
+    cpu     cProfile, written as .pstats (e.g. flameprof or snakeviz turn it into a flame graph)
+    sample  stacks sampled every PROFILE_SAMPLE_INTERVAL seconds, written as collapsed
+            stacks in .collapsed (for flamegraph.pl or speedscope)
+    memory  tracemalloc, the lines that allocated the most written as .txt
+
+Profiles of the event loop thread also pick up any other commands running on it at
+the same time, so profile while the bot is quiet for the cleanest results.
+"""
+import contextlib
+import contextvars
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+
+from config import *
+from logging_ import log_message
+
+"""Profiling modes, see module docstring
+"""
+PROFILE_MODES = ('cpu', 'sample', 'memory')
+
+"""File extension profiles are written with in each mode
+"""
+PROFILE_EXTENSIONS = {'cpu': 'pstats', 'sample': 'collapsed', 'memory': 'txt'}
+
+"""Number of lines written to memory profiles
+"""
+MEMORY_TOP_LINES = 50
+
+"""Allocations made by tracemalloc itself, left out of memory profiles
+"""
+_TRACEMALLOC_FILTERS = [tracemalloc.Filter(False, tracemalloc.__file__)]
+
+"""Session profiling the invocation running in the current context, if any
+"""
+_current_session = contextvars.ContextVar('profile_session', default=None)
+
+
+def _collapse(frame):
+    """Formats a stack as one line of a collapsed stack file, outermost frame first.
+
+    :param frame: Innermost frame of the stack
+    :return: str frames separated by ';'
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class ProfileSession:
+    """Profiles of the next count invocations of one command, merged together.
+    """
+
+    def __init__(self, command, count, mode):
+        """
+        :param command: str command name including prefix, e.g. '!hs'
+        :param count: int number of invocations to profile
+        :param mode: str one of PROFILE_MODES
+        """
+        self.command = command
+        self.count = count
+        self.mode = mode
+        self.remaining = count
+        self.started = 0
+        self.finished = 0
+        self._lock = threading.Lock()
+        self._stats = None
+        self._stacks = Counter()
+        self._allocations = Counter()
+
+    def add_profile(self, profile):
+        """Merges a finished cProfile.Profile into the session.
+
+        :param profile: cProfile.Profile
+        :return: None
+        """
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    def add_stack(self, stack):
+        """Counts one sample of a collapsed stack.
+
+        :param stack: str as returned by _collapse
+        :return: None
+        """
+        with self._lock:
+            self._stacks[stack] += 1
+
+    def add_allocations(self, differences):
+        """Adds the memory allocated during one invocation.
+
+        :param differences: list of tracemalloc.StatisticDiff, grouped by line
+        :return: None
+        """
+        with self._lock:
+            for difference in differences:
+                if difference.size_diff > 0:
+                    frame = difference.traceback[0]
+                    self._allocations[f'{frame.filename}:{frame.lineno}'] += difference.size_diff
+
+    def write(self, directory):
+        """Writes the session's merged profile.
+
+        :param directory: str directory to write the profile in, created if needed
+        :return: str path of the written file, or None if nothing was recorded
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{self.command.lstrip("!")}-{time.strftime("%Y%m%d-%H%M%S")}-'
+                                       f'{self.mode}.{PROFILE_EXTENSIONS[self.mode]}')
+        with self._lock:
+            if self.mode == 'cpu':
+                if self._stats is None:
+                    return None
+                self._stats.dump_stats(path)
+                return path
+            if self.mode == 'sample':
+                lines = [f'{stack} {count}\n' for stack, count in self._stacks.items()]
+            else:
+                lines = [f'{self.command} x{self.finished}: bytes allocated by line, not counting memory freed\n']
+                lines += [f'{size:>12} B  {location}\n'
+                          for location, size in self._allocations.most_common(MEMORY_TOP_LINES)]
+        if not lines:
+            return None
+        with open(path, 'w') as file:
+            file.writelines(lines)
+        return path
+
+    def describe(self):
+        """Describes the session's progress.
+
+        :return: str
+        """
+        return f'{self.command} ({self.mode}): {self.finished}/{self.count} profiled'
+
+
+class Profiler:
+    """Armed sessions by command name, and the machinery that profiles their invocations.
+    """
+
+    def __init__(self, directory=PROFILE_DIR, sample_interval=PROFILE_SAMPLE_INTERVAL):
+        """
+        :param directory: str directory profiles are written to
+        :param sample_interval: Number of seconds between stack samples in 'sample' mode
+        """
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self._sessions = {}
+        self._running = set()
+        self._sampled = {}
+        self._sampler = None
+        self._tracing = 0
+        self._started_tracing = False
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.written = deque(maxlen=10)
+
+    def arm(self, command, count, mode='cpu'):
+        """Profiles the next count invocations of a command, replacing any session already
+        armed for it.
+
+        :param command: str command name including prefix, e.g. '!hs'
+        :param count: int number of invocations to profile
+        :param mode: str one of PROFILE_MODES
+        :return: ProfileSession
+        @:raises ValueError if mode isn't one of PROFILE_MODES
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'Unknown profiling mode {mode}')
+        session = ProfileSession(command, count, mode)
+        with self._lock:
+            self._sessions[command] = session
+        return session
+
+    def disarm(self, command):
+        """Stops profiling a command, writing out whatever its session has recorded once
+        any invocations being profiled finish.
+
+        :param command: str command name including prefix
+        :return: boolean, False if no session was armed for command
+        """
+        with self._lock:
+            session = self._sessions.pop(command, None)
+            if session is None:
+                return False
+            session.remaining = 0
+            done = session.finished == session.started
+            if done:
+                self._running.discard(session)
+        if done:
+            self._write(session)
+        return True
+
+    def sessions(self):
+        """Returns the armed sessions, and those whose invocations are still being profiled.
+
+        :return: list of ProfileSession
+        """
+        with self._lock:
+            return list(self._sessions.values()) + [session for session in self._running
+                                                    if session not in self._sessions.values()]
+
+    def _claim(self, command):
+        """Takes one of the invocations a command's session has left, if one is armed.
+
+        :param command: str command name including prefix
+        :return: ProfileSession, or None if the invocation shouldn't be profiled
+        """
+        with self._lock:
+            session = self._sessions.get(command)
+            if session is None or session.remaining <= 0:
+                return None
+            session.remaining -= 1
+            session.started += 1
+            self._running.add(session)
+            if session.remaining == 0:
+                del self._sessions[command]
+            return session
+
+    def _finish(self, session):
+        """Marks one of a session's invocations finished, writing the session out after its last.
+
+        :param session: ProfileSession
+        :return: None
+        """
+        with self._lock:
+            session.finished += 1
+            done = session.remaining == 0 and session.finished == session.started
+            if done:
+                self._running.discard(session)
+        if done:
+            self._write(session)
+
+    def _write(self, session):
+        try:
+            path = session.write(self.directory)
+        except OSError as err:
+            log_message(f'Could not write profile of {session.command}: {err!r}')
+            return
+        if path is not None:
+            self.written.append(path)
+            log_message(f'Wrote profile of {session.finished} {session.command} invocations to {path}')
+
+    @contextlib.asynccontextmanager
+    async def invocation(self, command):
+        """Profiles one invocation of a command if a session is armed for it. The command's
+        handler should be awaited inside this.
+
+        :param command: str command name including prefix
+        :return: async context manager
+        """
+        session = self._claim(command)
+        if session is None:
+            yield
+            return
+        token = _current_session.set(session)
+        try:
+            if session.mode == 'memory':
+                with self._tracing_allocations(session):
+                    yield
+            else:
+                with self._profiling(session):
+                    yield
+        finally:
+            _current_session.reset(token)
+            self._finish(session)
+
+    def run(self, func, *args, **kwargs):
+        """Runs a callable, profiling it if it was handed off by an invocation being profiled.
+        Used by the lookup pools to run work in worker threads.
+
+        :param func: Callable to run
+        :param args: Positional arguments passed to func
+        :param kwargs: Keyword arguments passed to func
+        :return: Return value of func
+        """
+        session = _current_session.get()
+        # Memory profiles are taken process wide by the invocation itself
+        if session is None or session.mode == 'memory':
+            return func(*args, **kwargs)
+        with self._profiling(session):
+            return func(*args, **kwargs)
+
+    @contextlib.contextmanager
+    def _profiling(self, session):
+        """Profiles the current thread for a session, unless it is already being profiled.
+
+        :param session: ProfileSession in 'cpu' or 'sample' mode
+        :return: context manager
+        """
+        # Only one profiler can be active per thread, so nested and overlapping profiles are skipped
+        if getattr(self._local, 'active', False):
+            yield
+            return
+        self._local.active = True
+        try:
+            if session.mode == 'cpu':
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError:
+                    # Another profiler, e.g. python -m cProfile, is already running
+                    profile = None
+                if profile is None:
+                    yield
+                    return
+                try:
+                    yield
+                finally:
+                    profile.disable()
+                    session.add_profile(profile)
+            else:
+                ident = threading.get_ident()
+                self._start_sampling(ident, session)
+                try:
+                    yield
+                finally:
+                    self._stop_sampling(ident)
+        finally:
+            self._local.active = False
+
+    @contextlib.contextmanager
+    def _tracing_allocations(self, session):
+        """Records the memory allocated while a block runs, in every thread.
+
+        :param session: ProfileSession in 'memory' mode
+        :return: context manager
+        """
+        with self._lock:
+            if self._tracing == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            self._tracing += 1
+        try:
+            before = tracemalloc.take_snapshot().filter_traces(_TRACEMALLOC_FILTERS)
+            yield
+            after = tracemalloc.take_snapshot().filter_traces(_TRACEMALLOC_FILTERS)
+            session.add_allocations(after.compare_to(before, 'lineno'))
+        finally:
+            with self._lock:
+                self._tracing -= 1
+                # Leave tracing on if something else, e.g. python -X tracemalloc, turned it on
+                if self._tracing == 0 and self._started_tracing:
+                    tracemalloc.stop()
+                    self._started_tracing = False
+
+    def _start_sampling(self, ident, session):
+        """Starts sampling a thread's stack for a session, starting the sampler if needed.
+
+        :param ident: int thread identifier
+        :param session: ProfileSession in 'sample' mode
+        :return: None
+        """
+        with self._lock:
+            self._sampled[ident] = session
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name='profile-sampler', daemon=True)
+                self._sampler.start()
+
+    def _stop_sampling(self, ident):
+        with self._lock:
+            self._sampled.pop(ident, None)
+
+    def _sample(self):
+        """Samples the stacks of every thread being profiled until there are none left.
+
+        :return: None
+        """
+        while True:
+            with self._lock:
+                if not self._sampled:
+                    self._sampler = None
+                    return
+                sampled = dict(self._sampled)
+            frames = sys._current_frames()
+            for ident, session in sampled.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    session.add_stack(_collapse(frame))
+            time.sleep(self.sample_interval)
+
+    def stats(self):
+        """Returns the number of armed sessions and profiles written.
+
+        :return: dict of counters
+        """
+        with self._lock:
+            return {'armed': len(self._sessions), 'running': len(self._running), 'written': len(self.written)}
+
+
+"""Profiler all commands are run through
+"""
+profiler = Profiler()
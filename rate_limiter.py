@@ -0,0 +1,215 @@
+"""rate_limiter.py
+Token bucket rate limiter with a prioritized wait queue, used to limit how hard
+the bot hits the OSRS Highscores.
+
+Callers waiting on a token are served in priority order, so interactive commands
+go ahead of batch and background refreshes. When a request fails with a retryable
+error the whole bucket is paused for an exponential backoff with jitter, so every
+caller backs off together rather than each one hitting the highscores again, and the
+request is retried.
+
+Callers running under executor.run_blocking don't wait out the pause in a pool worker:
+RetryLater is raised instead, and run_blocking re-queues the lookup once the pause is
+over, so the workers stay free for lookups that can be answered from the cache.
+"""
+import contextvars
+import heapq
+import itertools
+import random
+import threading
+import time
+
+import requests
+
+"""Request priorities, lower values are served first
+"""
+INTERACTIVE = 0
+BATCH = 1
+BACKGROUND = 2
+
+"""Priority of requests made from the current context. Group commands and
+background tasks set this before making their lookups.
+"""
+request_priority = contextvars.ContextVar('request_priority', default=INTERACTIVE)
+
+"""Number of times the lookup running in the current context has already been re-queued,
+or None if it can't be re-queued and must wait out backoffs where it is. Set by
+executor.run_blocking.
+"""
+requeue_attempt = contextvars.ContextVar('requeue_attempt', default=None)
+
+
+class UpstreamError(Exception):
+    """Raised when the highscores respond with an error status.
+    """
+
+    def __init__(self, status, retry_after=None):
+        """
+        :param status: int HTTP status code of the response
+        :param retry_after: Optional number of seconds the server asked us to wait before retrying
+        """
+        super().__init__(f'Highscores responded with status {status}')
+        self.status = status
+        self.retry_after = retry_after
+
+
+class RetryLater(Exception):
+    """Raised instead of waiting out a backoff in a context that can re-queue the request,
+    see requeue_attempt.
+    """
+
+    def __init__(self, delay, error):
+        """
+        :param delay: Number of seconds to wait before retrying
+        :param error: Exception the request failed with
+        """
+        super().__init__(f'Retry in {delay:.1f}s after {error!r}')
+        self.delay = delay
+        self.error = error
+
+
+def is_retryable(err):
+    """Checks if a failed request is worth retrying.
+
+    :param err: Exception raised by the request
+    :return: boolean, True for 429 and 5xx responses, connection errors and timeouts
+    """
+    if isinstance(err, RetryLater):
+        return True
+    if isinstance(err, UpstreamError):
+        return err.status == 429 or err.status >= 500
+    return isinstance(err, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+class RateLimiter:
+    """Thread-safe token bucket. Tokens refill at rate per second up to burst, and each
+    request takes one token.
+    """
+
+    def __init__(self, rate, burst, max_retries=0, base_delay=1.0, max_delay=30.0):
+        """
+        :param rate: Number of requests allowed per second on average
+        :param burst: Maximum number of requests that may be made at once after an idle period
+        :param max_retries: Number of times call() retries a request that failed with a retryable error
+        :param base_delay: Seconds to back off for after the first failure, doubled for each further failure
+        :param max_delay: Maximum number of seconds to back off for
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._seq = itertools.count()
+        self.granted = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _refill(self):
+        """Adds the tokens accrued since the last refill. Must be called with self._cond held.
+
+        :return: None
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority=None):
+        """Blocks until a token is available and this caller is first in line for it.
+
+        :param priority: Optional request priority, defaults to request_priority in the current context
+        :return: float number of seconds spent waiting
+        """
+        if priority is None:
+            priority = request_priority.get()
+        start = time.monotonic()
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                self._refill()
+                now = time.monotonic()
+                if self._waiting[0] != ticket:
+                    self._cond.wait()
+                elif now < self._paused_until:
+                    self._cond.wait(self._paused_until - now)
+                elif self._tokens < 1:
+                    self._cond.wait((1 - self._tokens) / self.rate)
+                else:
+                    break
+            heapq.heappop(self._waiting)
+            self._tokens -= 1
+            waited = time.monotonic() - start
+            self.granted += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            # Let the next caller in line check if it can go
+            self._cond.notify_all()
+        return waited
+
+    def pause(self, delay):
+        """Stops handing out tokens for delay seconds, and empties the bucket so that requests
+        resume at rate afterwards rather than in a burst.
+
+        :param delay: Number of seconds to pause for
+        :return: None
+        """
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self._tokens = 0.0
+            self._cond.notify_all()
+
+    def call(self, func, *args, **kwargs):
+        """Calls func once a token is available, retrying while it fails with a retryable
+        error. Each failure pauses the whole bucket for an exponential backoff with full jitter,
+        and the retry queues for a token again behind any higher priority requests.
+
+        :param func: Callable making a single upstream request
+        :param args: Positional arguments passed to func
+        :param kwargs: Keyword arguments passed to func
+        :return: Return value of func
+        @:raises RetryLater if func failed and the current context can re-queue the request
+        """
+        requeued = requeue_attempt.get()
+        attempt = requeued or 0
+        while True:
+            self.acquire()
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                if not is_retryable(err):
+                    raise
+                if attempt >= self.max_retries:
+                    # Out of retries on an upstream error
+                    with self._cond:
+                        self.failures += 1
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if getattr(err, 'retry_after', None):
+                    delay = max(delay, err.retry_after)
+                self.pause(delay)
+                with self._cond:
+                    self.retries += 1
+                if requeued is not None:
+                    raise RetryLater(delay, err) from err
+                attempt += 1
+
+    def stats(self):
+        """Returns the limiter's queue and wait time counters.
+
+        :return: dict of counters
+        """
+        with self._cond:
+            return {'queue_depth': len(self._waiting),
+                    'paused': max(0.0, self._paused_until - time.monotonic()),
+                    'granted': self.granted,
+                    'retries': self.retries,
+                    'failures': self.failures,
+                    'avg_wait': self.total_wait / self.granted if self.granted else 0.0,
+                    'max_wait': self.max_wait}
@@ -0,0 +1,100 @@
+"""resource_registry.py
+In-memory registry of the bot's static resources (images in resources/).
+
+Every file is read once when the registry is created, and attachments are then
+served from memory with no per-request disk reads.
+"""
+import asyncio
+import io
+import os
+from types import MappingProxyType
+
+from config import *
+from executor import run_blocking
+from logging_ import log_message
+
+
+class ResourceRegistry:
+    """Holds the contents of every file in a directory as immutable bytes, keyed by filename.
+    """
+
+    def __init__(self, directory=RESOURCE_DIR):
+        """
+        :param directory: str path of directory to load
+        """
+        self.directory = directory
+        self._resources = MappingProxyType({})
+        self._mtimes = {}
+        self.reload()
+
+    def _scan(self):
+        """Lists the files in the directory along with their modification times.
+
+        :return: dict mapping filenames to modification times
+        """
+        with os.scandir(self.directory) as entries:
+            return {entry.name: entry.stat().st_mtime for entry in entries if entry.is_file()}
+
+    def reload(self):
+        """Reads every file in the directory, replacing the loaded set in one step
+        so readers never see a partial reload.
+
+        :return: None
+        """
+        mtimes = self._scan()
+        resources = {}
+        for name in mtimes:
+            with open(os.path.join(self.directory, name), 'rb') as file:
+                resources[name] = file.read()
+        self._resources = MappingProxyType(resources)
+        self._mtimes = mtimes
+
+    def reload_if_changed(self):
+        """Reloads the directory if any file was added, removed or modified since the last load.
+
+        :return: boolean, True if the directory was reloaded
+        """
+        if self._scan() == self._mtimes:
+            return False
+        self.reload()
+        log_message(f'Reloaded {len(self._resources)} resources from {self.directory}')
+        return True
+
+    async def watch(self, interval=RESOURCE_RELOAD_INTERVAL):
+        """Checks the directory for changes every interval seconds, forever.
+
+        :param interval: Number of seconds between checks
+        :return: None
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                # Reading changed files is disk I/O, so keep it off the event loop
+                await run_blocking(self.reload_if_changed, timeout=None)
+            except Exception as err:
+                log_message(f'Could not reload resources from {self.directory}: {err!r}')
+
+    def get(self, name):
+        """Returns a resource's contents.
+
+        :param name: str filename of resource, e.g. 'birdman.png'
+        :return: bytes
+        @:raises KeyError if no such resource was loaded
+        """
+        return self._resources[name]
+
+    def open(self, name):
+        """Returns a resource as a new in-memory file object, e.g. for use with discord.File
+
+        :param name: str filename of resource, e.g. 'birdman.png'
+        :return: io.BytesIO
+        @:raises KeyError if no such resource was loaded
+        """
+        return io.BytesIO(self._resources[name])
+
+    def names(self):
+        """Returns the filenames of all loaded resources.
+
+        :return: list of str
+        """
+        return list(self._resources)
@@ -12,12 +12,160 @@ AVATAR_URL = 'https://github.com/cdfisher/clockwork-penguin/blob/master/resource
 BOT_NAME = 'Clockwork Penguin'
 # Name to be used for log files
 LOG_NAME = 'clockwork-penguin-log.txt'
+# Log record format, 'text' for timestamped lines or 'json' for JSON lines
+LOG_FORMAT = 'text'
+# Queued log records are written once this many are waiting, or after this many seconds
+LOG_BATCH_SIZE = 64
+LOG_FLUSH_INTERVAL = 1.0
+# The log file is rotated once it is larger than this many bytes or older than this many seconds
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_MAX_AGE = 7 * 24 * 60 * 60
+# Number of rotated log files to keep
+LOG_BACKUP_COUNT = 5
+# Maximum number of log records waiting to be written, further records are dropped and counted
+LOG_QUEUE_SIZE = 10000
+
+# Highscores lookups
+# Maximum number of highscores lookups that may run at once
+HS_MAX_WORKERS = 8
+# Seconds to wait on a single highscores lookup before giving up
+HS_REQUEST_TIMEOUT = 30
+# Backend highscores lookups are made through: 'csv' fetches index_lite directly over pooled
+# keep-alive connections, 'osrs_highscores' uses the osrs-highscores package
+HS_BACKEND = 'csv'
+# Base URL the 'csv' backend fetches from, point it at a local stub server for testing
+HS_BASE_URL = 'https://secure.runescape.com'
+# Seconds a highscores lookup is cached for before it is fetched again
+HS_CACHE_TTL = 300
+# Maximum number of highscores lookups to keep cached
+HS_CACHE_SIZE = 1024
+# Seconds past HS_CACHE_TTL an expired lookup is still answered from while it is refreshed in
+# the background (stale-while-revalidate), 0 to always wait for a fresh lookup
+HS_CACHE_STALE_TTL = 60 * 60
+# Seconds old a cached lookup may be and still be served while the highscores are unreachable
+# (one day), 0 to fail instead
+HS_CACHE_DEGRADED_TTL = 24 * 60 * 60
+# SQLite database cached lookups are persisted in, so the cache survives restarts.
+# Set to '' to keep the cache in memory only
+HS_CACHE_DB_NAME = 'clockwork-penguin-hs-cache.db'
+# Average number of requests per second allowed to the highscores, and how many may be made at once
+HS_RATE_LIMIT = 5
+HS_RATE_BURST = 10
+# Number of times a request is retried after a 429/5xx response or connection error
+HS_MAX_RETRIES = 3
+# Seconds to back off for after the first failed request, doubled for each further failure
+HS_RETRY_BASE_DELAY = 1.0
+HS_RETRY_MAX_DELAY = 30.0
+
+# Account type store
+# SQLite database used to cache players' account types
+ACCOUNT_DB_NAME = 'clockwork-penguin.db'
+# Seconds a player's account type is cached for (one week)
+ACCOUNT_TYPE_TTL = 7 * 24 * 60 * 60
+# Seconds a player who couldn't be found on the highscores is cached for
+NOT_FOUND_TTL = 60 * 60
+
+# Snapshot history
+# SQLite database every fetched highscores snapshot is recorded in, for !gains and !kc-gains
+HISTORY_DB_NAME = 'clockwork-penguin-history.db'
+# Seconds every recorded snapshot is kept for (two days)
+HISTORY_FULL_RESOLUTION = 2 * 24 * 60 * 60
+# Older snapshots are thinned to one per hour until they're this many seconds old (30 days),
+# then to one per day
+HISTORY_HOURLY_UNTIL = 30 * 24 * 60 * 60
+# Seconds after which snapshots are deleted (one year), 0 to keep them forever
+HISTORY_MAX_AGE = 365 * 24 * 60 * 60
+# Seconds between downsampling passes over the history
+HISTORY_DOWNSAMPLE_INTERVAL = 60 * 60
+# Periods !gains and !kc-gains use when none is given
+GAINS_DEFAULT_PERIOD = '7d'
+KC_GAINS_DEFAULT_PERIOD = '30d'
+
+# Group commands
+# File listing the clan's members, one RSN per line
+MEMBER_LIST_NAME = 'members.txt'
+# Maximum number of members a group command fetches at once. Keep this below HS_MAX_WORKERS
+# so that other commands can still run while a group command is in progress.
+GROUP_CONCURRENCY = 4
+# Minimum number of seconds between progress updates on a group command
+GROUP_PROGRESS_INTERVAL = 5
+# Maximum number of each single player lookup command (!hs, !ehb, ...) that may run at once,
+# and how many seconds a user must wait between uses of the same one
+LOOKUP_CONCURRENCY = 6
+LOOKUP_COOLDOWN = 3
+# Maximum number of each group command that may run at once, and how many seconds a user
+# must wait between uses of the same one
+GROUP_COMMAND_CONCURRENCY = 1
+GROUP_COMMAND_COOLDOWN = 60
+# Number of members !top lists by default, and the most it will list
+TOP_DEFAULT = 10
+TOP_MAX = 25
+
+# Tracker
+# Set to True to refresh clan members in the background and announce their level ups,
+# 99s and boss KC milestones through the webhook
+TRACKER_ENABLED = False
+# Seconds between refreshes of a member whose highscores are changing, doubled after each
+# refresh that finds no changes up to TRACKER_MAX_INTERVAL
+TRACKER_MIN_INTERVAL = 15 * 60
+TRACKER_MAX_INTERVAL = 6 * 60 * 60
+# Maximum number of members refreshed at once
+TRACKER_CONCURRENCY = 2
+# Seconds between checks for members that are due a refresh
+TRACKER_TICK = 30
+
+# Discord user IDs allowed to use admin commands such as !stats
+ADMIN_IDS = []
+
+# Profiling, see !profile
+# Directory profiles of commands are written to
+PROFILE_DIR = 'profiles'
+# Commands to profile from startup, mapped to how many invocations to profile, e.g. {'!hs': 10}
+PROFILE_COMMANDS = {}
+# Default profiling mode: 'cpu' for cProfile .pstats files, 'sample' for collapsed stacks that
+# flame graph tools read, or 'memory' for the lines that allocated the most memory
+PROFILE_MODE = 'cpu'
+# Seconds between stack samples in 'sample' mode
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# Local port metrics are served on in the Prometheus text format at /metrics, 0 to disable
+METRICS_PORT = 0
 
 DISCORD_TOKEN = ''
 DISCORD_GUILD = ''
 
+# Multi-guild mode
+# Set to True to serve any number of Discord servers instead of DISCORD_GUILD alone. Each server
+# sets its own command prefix, webhook and member list with !prefix, !webhook-set and !members-add
+MULTI_GUILD = False
+# Total number of shards in multi-guild mode, 0 to use the number Discord recommends
+SHARD_COUNT = 0
+# Shards this process runs, empty to run all of them. Setting them needs SHARD_COUNT too. To split
+# the bot across processes, start each with a different set, e.g.
+# python discord_bot.py --shard-ids 0 1 --shard-count 4.
+# Processes must share the same database files so their caches stay consistent, and
+# HS_RATE_LIMIT is split between them so they don't hit the highscores any harder together
+SHARD_IDS = []
+# SQLite database of each server's settings and member list in multi-guild mode
+GUILD_DB_NAME = 'clockwork-penguin-guilds.db'
+# Seconds a server's settings are cached in memory for
+GUILD_CONFIG_TTL = 60
+# Maximum length of a server's command prefix. !prefix also always works with the default '!'
+# prefix, so a server can reset a prefix it can't type
+MAX_PREFIX_LENGTH = 3
+# Maximum number of players on each server's member list in multi-guild mode, since every member
+# is tracked against the shared HS_RATE_LIMIT
+MAX_CLAN_MEMBERS = 500
+
 # Webhooks
 WEBHOOK = ''
+# Number of times a rate limited webhook post is retried
+WEBHOOK_MAX_RETRIES = 5
+
+# Directory of images served by the bot, loaded into memory at startup
+RESOURCE_DIR = 'resources'
+# Seconds between checks of RESOURCE_DIR for changed files, 0 to disable reloading
+RESOURCE_RELOAD_INTERVAL = 0
 
 BIRDMAN_AVATAR = 'https://github.com/cdfisher/clockwork-penguin/blob/master/resources/kreearra.png?raw=true'
 
@@ -0,0 +1,205 @@
+"""tracker.py
+Background tracker that refreshes the clan's members and announces their level ups,
+99s and boss KC milestones through the webhook.
+
+Each member is refreshed on their own schedule: every TRACKER_MIN_INTERVAL seconds
+while their highscores keep changing, backing off up to TRACKER_MAX_INTERVAL while
+they don't, so the number of requests scales with how active the clan is. New
+members are given staggered start times so refreshes are spread out rather than all
+due at once. Lookups run at BACKGROUND priority, at most TRACKER_CONCURRENCY at a time.
+"""
+import asyncio
+import random
+import time
+
+import numpy as np
+
+from config import *
+from hs_wrapper import *
+from group_utils import load_members, fetch_group
+from logging_ import log_message
+from rate_limiter import BACKGROUND
+
+"""Boss KC at which milestones are announced
+"""
+KC_MILESTONES = [50, 100, 250, 500, 1000, 2000, 3000, 4000, 5000, 10000]
+
+"""Longest message Discord accepts
+"""
+MAX_MESSAGE_LENGTH = 2000
+
+
+def diff_snapshots(rsn, old, new):
+    """Lists the level ups, 99s and boss KC milestones between two snapshots of a player.
+
+    :param rsn: str value of a player's OSRS username
+    :param old: HighscoreSnapshot from the previous refresh
+    :param new: HighscoreSnapshot from this refresh
+    :return: list of str announcements, empty if there is nothing to announce
+    """
+    announcements = []
+    # Overall is skipped, and skills that weren't listed before have no level to compare to
+    for i in np.flatnonzero((new.levels[1:] > old.levels[1:]) & (old.levels[1:] > 0)) + 1:
+        if new.levels[i] == 99:
+            announcements.append(f'{rsn} has achieved 99 {FORMATTED_SKILLS[i]}!')
+        else:
+            announcements.append(f'{rsn} has reached level {new.levels[i]} {FORMATTED_SKILLS[i]}.')
+
+    for i in np.flatnonzero(new.kc > old.kc):
+        crossed = [milestone for milestone in KC_MILESTONES if max(int(old.kc[i]), 0) < milestone <= new.kc[i]]
+        if crossed:
+            announcements.append(f'{rsn} has reached {crossed[-1]} {FORMATTED_BOSSES[i]} KC!')
+    return announcements
+
+
+class _TrackedPlayer:
+    """A member's refresh schedule and the snapshot from their last refresh.
+    """
+    __slots__ = ('rsn', 'interval', 'due', 'last')
+
+    def __init__(self, rsn, interval, due):
+        self.rsn = rsn
+        self.interval = interval
+        self.due = due
+        self.last = None
+
+
+class Tracker:
+    """Refreshes members as they fall due and announces changes in batches.
+    """
+
+    def __init__(self, webhook, members=load_members, concurrency=TRACKER_CONCURRENCY,
+                 min_interval=TRACKER_MIN_INTERVAL, max_interval=TRACKER_MAX_INTERVAL, tick=TRACKER_TICK,
+                 route=None):
+        """
+        :param webhook: WebhookHandler announcements are sent through
+        :param members: Callable returning the list of RSNs to track
+        :param concurrency: Maximum number of members refreshed at once
+        :param min_interval: Number of seconds between refreshes of a member whose highscores are changing
+        :param max_interval: Longest number of seconds between refreshes of a member
+        :param tick: Number of seconds between checks for members that are due
+        :param route: Optional callable taking an RSN and returning the list of WebhookHandlers
+        that player's announcements are sent through, e.g. one per clan they are in. Defaults
+        to sending everything through webhook
+        """
+        self.webhook = webhook
+        self.route = route if route is not None else lambda rsn: [self.webhook]
+        self.members = members
+        self.concurrency = concurrency
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.tick = tick
+        self._players = {}
+        self.refreshes = 0
+        self.announcements = 0
+
+    def _sync_members(self, now):
+        """Starts tracking new members and stops tracking removed ones.
+
+        :param now: UNIX timestamp
+        :return: None
+        """
+        members = {rsn.lower(): rsn for rsn in self.members()}
+        for key in list(self._players):
+            if key not in members:
+                del self._players[key]
+        for key, rsn in members.items():
+            if key not in self._players:
+                # Spread first refreshes over one interval so they don't all fall due together
+                self._players[key] = _TrackedPlayer(rsn, self.min_interval,
+                                                    now + random.uniform(0, self.min_interval))
+
+    def _reschedule(self, player, changed, now):
+        """Sets a member's next refresh, resetting their interval if their highscores
+        changed and doubling it if not.
+
+        :param player: _TrackedPlayer
+        :param changed: boolean, True if the member's highscores changed since their last refresh
+        :param now: UNIX timestamp
+        :return: None
+        """
+        if changed:
+            player.interval = self.min_interval
+        else:
+            player.interval = min(player.interval * 2, self.max_interval)
+        # Jitter keeps members that were refreshed together from staying in lockstep
+        player.due = now + player.interval * random.uniform(0.9, 1.1)
+
+    async def refresh(self, now=None):
+        """Refreshes every member that is due and announces what changed.
+
+        :param now: Optional UNIX timestamp, defaults to now
+        :return: list of str announcements made
+        """
+        now = time.time() if now is None else now
+        self._sync_members(now)
+        due = [player for player in self._players.values() if player.due <= now]
+        if not due:
+            return []
+
+        results, failures = await fetch_group([player.rsn for player in due], get_user,
+                                              concurrency=self.concurrency, priority=BACKGROUND)
+        self.refreshes += len(results)
+        announcements = []
+        routed = {}
+        for player in due:
+            snapshot = results.get(player.rsn)
+            if snapshot is None:
+                # Back off from players that can't be fetched, e.g. after a name change
+                self._reschedule(player, False, now)
+                continue
+            changed = player.last is None or not np.array_equal(player.last.xp, snapshot.xp) \
+                or not np.array_equal(player.last.kc, snapshot.kc)
+            if player.last is not None:
+                diffs = diff_snapshots(player.rsn, player.last, snapshot)
+                if diffs:
+                    announcements += diffs
+                    for webhook in self.route(player.rsn):
+                        routed.setdefault(webhook, []).extend(diffs)
+            player.last = snapshot
+            self._reschedule(player, changed, now)
+
+        for webhook, webhook_announcements in routed.items():
+            self.announce(webhook_announcements, webhook)
+        return announcements
+
+    def announce(self, announcements, webhook=None):
+        """Sends announcements through a webhook, packed into as few messages as possible.
+
+        :param announcements: list of str announcements
+        :param webhook: Optional WebhookHandler to send through, defaults to self.webhook
+        :return: None
+        """
+        webhook = self.webhook if webhook is None else webhook
+        message = ''
+        for announcement in announcements:
+            if message and len(message) + len(announcement) + 1 > MAX_MESSAGE_LENGTH:
+                webhook.send_message(message)
+                message = ''
+            message += announcement + '\n'
+        if message:
+            webhook.send_message(message)
+        self.announcements += len(announcements)
+
+    async def run(self):
+        """Refreshes members as they fall due, forever.
+
+        :return: None
+        """
+        while True:
+            try:
+                await self.refresh()
+            except Exception as err:
+                log_message(f'Tracker refresh failed: {err!r}')
+            await asyncio.sleep(self.tick)
+
+    def stats(self):
+        """Returns the number of tracked members and how much work the tracker has done.
+
+        :return: dict of counters
+        """
+        now = time.time()
+        return {'tracked': len(self._players),
+                'due': sum(1 for player in self._players.values() if player.due <= now),
+                'refreshes': self.refreshes,
+                'announcements': self.announcements}
@@ -2,73 +2,226 @@
 Class-based solution for handling the sending of messages and images
 to Discord via webhooks.
 
+Messages are queued and delivered in the background, in order, over one keep-alive
+connection, so sending never blocks the event loop. Consecutive text messages from
+the same sender are batched into one post where they fit, and 429 responses are
+retried after the retry_after Discord asks for.
+
 Thanks to Bals2oo8 for giving me a hand with getting
 file sending working.
 """
+import asyncio
 import json
-import requests
-import datetime
+import os
+import time
+from collections import deque
+
+import aiohttp
 
 from config import *
 from logging_ import log_message
+from metrics import metrics
 
 if TEST_MODE:
     wh_url = TEST_WEBHOOK
 else:
     wh_url = WEBHOOK
 
+"""Maximum length of a Discord message, batched messages are kept below this
+"""
+MAX_CONTENT_LENGTH = 2000
 
-class WebhookHandler:
-    _files = {}
-    webhook_data = {}
 
-    def __int__(self):
-        self._files = {}
-        self.webhook_data = {}
+class _Payload:
+    """A single queued message and the future resolved once it has been delivered.
+    """
+    __slots__ = ('content', 'username', 'avatar', 'files', 'future')
 
-    def add_file(self, file: bytes, filename: str) -> None:
-        self._files[f"_{filename}"] = (filename, file)
+    def __init__(self, content, username, avatar, files, future):
+        self.content = content
+        self.username = username
+        self.avatar = avatar
+        self.files = files
+        self.future = future
 
-    def config_webhook(self, content: str, username: str) -> None:
-        self.webhook_data["content"] = content
-        self.webhook_data["username"] = username
 
-    def make_post_request(self, url: str, data: dict, _files: dict) -> requests.post:
-        if not bool(self._files):
-            return requests.post(url, json=data)
+class WebhookHandler:
+    def __init__(self, url=wh_url, max_retries=WEBHOOK_MAX_RETRIES):
+        """
+        :param url: str webhook URL to send to
+        :param max_retries: Number of times a rate limited post is retried
+        """
+        self.url = url
+        self.max_retries = max_retries
+        self._session = None
+        self._pending = deque()
+        self._in_flight = []
+        self._wakeup = None
+        self._worker = None
+
+    def _enqueue(self, content, username, avatar, files):
+        """Queues a message, starting the delivery worker if it isn't running.
+        Must be called from within the event loop.
 
-        self._files["payload_json"] = (None, json.dumps(data))
-        return requests.post(url, files=self._files)
+        :return: asyncio.Future resolved with True once delivered, or False if delivery failed
+        """
+        loop = asyncio.get_event_loop()
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        self._pending.append(_Payload(content, username, avatar, files, future))
+        self._wakeup.set()
+        return future
 
     def send_message(self, msg: str, name=BOT_NAME, avatar=AVATAR_URL):
-        self.config_webhook(msg, name)
-        self.webhook_data["avatar_url"] = avatar
-        response = self.make_post_request(wh_url, self.webhook_data, self._files)
-        try:
-            response.raise_for_status()
-        except requests.exceptions.HTTPError as err:
-            log_message(err)
-        else:
-            now = datetime.datetime.now()
-            timestamp = now.strftime('%d %b %Y - %H:%M:%S ')
-            log_message(f'Text payload delivered with code {response.status_code} '
-                        f'at {timestamp}')
-            self.webhook_data = {}
-            self._files = {}
-
-    def send_file(self, msg: str, filename: str, name=BOT_NAME, avatar=AVATAR_URL):
-        self.config_webhook(msg, name)
-        self.webhook_data["avatar_url"] = avatar
-        self.add_file(open(filename, 'rb'), filename)
-        response = self.make_post_request(wh_url, self.webhook_data, self._files)
+        """Queues a text message.
+
+        :param msg: str message content
+        :param name: str username to post as
+        :param avatar: str URL of avatar to post with
+        :return: asyncio.Future resolved with True once delivered, or False if delivery failed
+        """
+        return self._enqueue(msg, name, avatar, [])
+
+    def send_file(self, msg: str, filename: str, name=BOT_NAME, avatar=AVATAR_URL, content=None):
+        """Queues a message with a file attached.
+
+        :param msg: str message content
+        :param filename: str path of file to attach, or just its name if content is given
+        :param name: str username to post as
+        :param avatar: str URL of avatar to post with
+        :param content: Optional bytes of the file, e.g. from a ResourceRegistry. If not given
+        the file is read from disk.
+        :return: asyncio.Future resolved with True once delivered, or False if delivery failed
+        """
+        if content is None:
+            with open(filename, 'rb') as file:
+                content = file.read()
+        return self._enqueue(msg, name, avatar, [(os.path.basename(filename), content)])
+
+    def _can_batch(self, batch, payload):
+        """Checks if payload can be merged into the same post as batch.
+
+        :return: boolean
+        """
+        first = batch[0]
+        length = sum(len(queued.content) + 1 for queued in batch) + len(payload.content)
+        return (not first.files and not payload.files and first.username == payload.username
+                and first.avatar == payload.avatar and length <= MAX_CONTENT_LENGTH)
+
+    async def _run(self):
+        """Delivers queued messages until cancelled by close().
+
+        :return: None
+        """
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            batch = [self._pending.popleft()]
+            while self._pending and self._can_batch(batch, self._pending[0]):
+                batch.append(self._pending.popleft())
+            self._in_flight = batch
+            start = time.perf_counter()
+            try:
+                delivered = await self._deliver(batch)
+            except Exception as err:
+                # Never let one bad post stop the worker, or everything queued behind it would hang
+                log_message(f'Webhook delivery failed: {err!r}')
+                delivered = False
+            metrics.observe('webhook_delivery_seconds', time.perf_counter() - start)
+            metrics.inc('webhook_posts_total', result='ok' if delivered else 'failed')
+            self._in_flight = []
+            for payload in batch:
+                if not payload.future.done():
+                    payload.future.set_result(delivered)
+
+    async def _post(self, batch):
+        """Makes a single post for a batch of messages.
+
+        :return: aiohttp.ClientResponse
+        """
+        data = {'content': '\n'.join(payload.content for payload in batch),
+                'username': batch[0].username,
+                'avatar_url': batch[0].avatar}
+        if not batch[0].files:
+            return await self._session.post(self.url, json=data)
+
+        form = aiohttp.FormData()
+        form.add_field('payload_json', json.dumps(data), content_type='application/json')
+        for i, (filename, content) in enumerate(batch[0].files):
+            form.add_field(f'files[{i}]', content, filename=filename)
+        return await self._session.post(self.url, data=form)
+
+    async def _deliver(self, batch):
+        """Posts a batch of messages, waiting out any rate limits.
+
+        :return: boolean, True if delivered
+        """
+        if self._session is None or self._session.closed:
+            # Posts are made one at a time to keep messages in order, so one connection is enough
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=1))
+
+        kind = 'File' if batch[0].files else 'Text'
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with await self._post(batch) as response:
+                    status = response.status
+                    if status == 429:
+                        retry_after = await self._retry_after(response)
+                    else:
+                        response.raise_for_status()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                log_message(f'{kind} payload of {len(batch)} message(s) failed: {err!r}')
+                return False
+
+            if status != 429:
+                log_message(f'{kind} payload of {len(batch)} message(s) delivered with code {status}')
+                return True
+            if attempt < self.max_retries:
+                log_message(f'Webhook rate limited, retrying in {retry_after}s')
+                await asyncio.sleep(retry_after)
+
+        log_message(f'{kind} payload of {len(batch)} message(s) dropped after {self.max_retries} retries')
+        return False
+
+    @staticmethod
+    async def _retry_after(response):
+        """Reads how long Discord asked us to wait from a 429 response, from its JSON body or
+        failing that its Retry-After header, since proxies may answer with a non-JSON body.
+
+        :param response: aiohttp.ClientResponse with status 429
+        :return: float number of seconds
+        """
         try:
-            response.raise_for_status()
-        except requests.exceptions.HTTPError as err:
-            log_message(err)
-        else:
-            now = datetime.datetime.now()
-            timestamp = now.strftime('%d %b %Y - %H:%M:%S ')
-            log_message(f'File payload delivered with code {response.status_code}'
-                        f' at {timestamp}')
-        self.webhook_data = {}
-        self._files = {}
+            body = await response.json(content_type=None)
+            return float(body['retry_after'])
+        except (ValueError, TypeError, KeyError):
+            try:
+                return float(response.headers.get('Retry-After', 1))
+            except ValueError:
+                return 1.0
+
+    def stats(self):
+        """Returns the number of messages waiting to be delivered.
+
+        :return: dict of queue counters
+        """
+        return {'queue_depth': len(self._pending) + len(self._in_flight)}
+
+    async def close(self):
+        """Waits for queued messages to be delivered, then closes the session.
+
+        :return: None
+        """
+        queued = self._in_flight + list(self._pending)
+        if queued:
+            await asyncio.gather(*(payload.future for payload in queued))
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None